@@ -0,0 +1,84 @@
+"""
+Локальные заглушки внешних HTTP сервисов для бенчмарков: ЦБ РФ (XML_daily.asp) и Telegram Bot API (sendMessage).
+Задержка ответа настраивается, число запросов считается.
+"""
+import asyncio
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+CBR_XML = """<?xml version="1.0" encoding="windows-1251"?>
+<ValCurs Date="{date}" name="Foreign Currency Market">
+<Valute ID="R01235"><NumCode>840</NumCode><CharCode>USD</CharCode><Nominal>1</Nominal><Name>Доллар США</Name><Value>81,5000</Value></Valute>
+<Valute ID="R01239"><NumCode>978</NumCode><CharCode>EUR</CharCode><Nominal>1</Nominal><Name>Евро</Name><Value>94,2000</Value></Valute>
+<Valute ID="R01375"><NumCode>156</NumCode><CharCode>CNY</CharCode><Nominal>1</Nominal><Name>Китайский юань</Name><Value>11,3000</Value></Valute>
+<Valute ID="R01335"><NumCode>398</NumCode><CharCode>KZT</CharCode><Nominal>100</Nominal><Name>Казахстанских тенге</Name><Value>15,4000</Value></Valute>
+</ValCurs>"""
+
+
+class FakeServer:
+    """aiohttp сервер на свободном порту 127.0.0.1"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = Counter()
+        self.app = web.Application()
+        self._runner = None
+        self.base_url = None
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f'http://{host}:{port}'
+        return self
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _delay(self, name: str):
+        self.requests[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeCBRServer(FakeServer):
+    """GET /scripts/XML_daily.asp?date_req=ДД/ММ/ГГГГ - четыре валюты в формате ЦБ"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.app.router.add_get('/scripts/XML_daily.asp', self.xml_daily)
+
+    async def xml_daily(self, request: web.Request):
+        await self._delay('XML_daily')
+        date_req = request.query.get('date_req', time.strftime('%d/%m/%Y')).replace('/', '.')
+        return web.Response(body=CBR_XML.format(date=date_req).encode('windows-1251'), content_type='application/xml')
+
+
+class FakeTelegramServer(FakeServer):
+    """POST /bot{token}/sendMessage - ответ как у Bot API; сообщения сохраняются в sent"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.sent = []
+        self.app.router.add_post('/bot{token}/{method}', self.bot_method)
+
+    async def bot_method(self, request: web.Request):
+        method = request.match_info['method']
+        await self._delay(method)
+        data = dict(await request.post()) if request.content_type != 'application/json' else await request.json()
+        if method != 'sendMessage':
+            return web.json_response({'ok': True, 'result': True})
+        self.sent.append(data)
+        return web.json_response({'ok': True, 'result': {
+            'message_id': len(self.sent),
+            'date': int(time.time()),
+            'chat': {'id': int(data.get('chat_id', 0)), 'type': 'supergroup'},
+            'text': data.get('text', ''),
+        }})
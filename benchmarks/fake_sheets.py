@@ -0,0 +1,220 @@
+"""
+Таблица Google Sheets в памяти для бенчмарков: листы Ledger и Balances, задержка на каждое обращение
+и счетчик обращений по методам. Подменяет GoogleSheetsManager (get_spreadsheet / get_worksheet).
+"""
+import asyncio
+import random
+from collections import Counter
+from typing import Dict, List
+
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
+from gspread.worksheet import ValueRange
+
+
+LEDGER_HEADERS = ['Дата', 'Сумма', 'Валюта', 'Куда', 'Откуда', 'Статья', 'Проект', 'Комментарий',
+                  'Эквивалент У.Е', 'USD / RUB', 'Автор', 'Чат', 'Баланс']
+INSTANCES = ['Карта Тинькофф', 'Карта Сбер', 'Наличные', 'Касса офиса', 'Счет ООО', 'Binance', 'Счет ИП']
+CURRENCIES = ['RUB', 'USD', 'EUR', 'USDT']
+ARTICLES = ['Аренда', 'Зарплата', 'Еда', 'Транспорт', 'Связь', 'Реклама', 'Налоги', 'Обмен']
+PROJECTS = ['Проект A', 'Проект B', 'Проект C', 'Общее']
+
+
+def _format_number(value) -> str:
+    return value if isinstance(value, str) else '{:,.2f}'.format(value).replace(',', ' ').replace('.', ',')
+
+
+class FakeWorksheet:
+    """Лист: строки хранятся как списки строк, как их отдает get_all_values"""
+
+    def __init__(self, spreadsheet: 'FakeSpreadsheet', title: str, rows: List[List[str]]):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.rows = rows
+
+    async def _api(self, method: str):
+        await self.spreadsheet.api_call(method)
+
+    def _column(self, col: int) -> List[str]:
+        values = [row[col - 1] if col - 1 < len(row) else '' for row in self.rows]
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    def _set(self, row: int, col: int, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col - 1] = _format_number(value)
+
+    async def row_values(self, row: int):
+        await self._api('row_values')
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    async def col_values(self, col: int):
+        await self._api('col_values')
+        return self._column(col)
+
+    async def get_all_values(self):
+        await self._api('get_all_values')
+        return [list(row) for row in self.rows]
+
+    async def get(self, range_name: str):
+        await self._api('get')
+        start, end = range_name.split(':')
+        first_row, first_col = a1_to_rowcol(start)
+        last_col = a1_to_rowcol(end + '1')[1]
+        rows = [row[first_col - 1:last_col] for row in self.rows[first_row - 1:]]
+        while rows and not any(rows[-1]):
+            rows.pop()
+        return rows
+
+    async def batch_get(self, ranges: List[str], major_dimension=None):
+        await self._api('batch_get')
+        result = []
+        for range_name in ranges:
+            col = a1_to_rowcol(range_name.split(':')[1] + '1')[1]
+            values = self._column(col)
+            result.append(ValueRange.from_json({
+                'range': range_name, 'majorDimension': 'COLUMNS', **({'values': [values]} if values else {})
+            }))
+        return result
+
+    async def acell(self, label: str):
+        await self._api('acell')
+        row, col = a1_to_rowcol(label)
+        cells = self.rows[row - 1] if row <= len(self.rows) else []
+        return type('Cell', (), {'value': cells[col - 1] if col <= len(cells) else ''})()
+
+    async def update_acell(self, label: str, value):
+        await self._api('update_acell')
+        self._set(*a1_to_rowcol(label), value)
+
+    async def update(self, values, range_name: str = None, **kwargs):
+        await self._api('update')
+        row, col = a1_to_rowcol(range_name.split(':')[0])
+        for i, row_values in enumerate(values):
+            for j, value in enumerate(row_values):
+                self._set(row + i, col + j, value)
+
+    async def append_rows(self, values, value_input_option='RAW', insert_data_option=None, table_range=None, **kwargs):
+        """Как values.append: пишет с первой пустой строки не выше table_range"""
+        await self._api('append_rows')
+        first = a1_to_rowcol(table_range)[0] if table_range else len(self.rows) + 1
+        while first <= len(self.rows) and any(self.rows[first - 1]):
+            first += 1
+        for i, row_values in enumerate(values):
+            for j, value in enumerate(row_values):
+                self._set(first + i, j + 1, value)
+        last_col = rowcol_to_a1(1, max(len(row) for row in values))[:-1]
+        return {'updates': {'updatedRange': f"'{self.title}'!A{first}:{last_col}{first + len(values) - 1}"}}
+
+    async def insert_row(self, values, index: int, **kwargs):
+        await self._api('insert_row')
+        self.rows.insert(index - 1, [str(value) for value in values])
+
+    async def insert_cols(self, values, col: int, **kwargs):
+        await self._api('insert_cols')
+        for row in self.rows:
+            if len(row) >= col - 1:
+                row.insert(col - 1, '')
+
+    async def format(self, *args, **kwargs):
+        await self._api('format')
+
+
+class _FakeSyncSpreadsheet:
+    """Синхронная часть (spreadsheet.ss): values_batch_update раскладывает изменения по листам"""
+
+    def __init__(self, spreadsheet: 'FakeSpreadsheet'):
+        self.spreadsheet = spreadsheet
+
+    def values_batch_update(self, body: dict):
+        for change in body['data']:
+            sheet_name, range_name = change['range'].split('!')
+            worksheet = self.spreadsheet.sheets[sheet_name.strip("'")]
+            row, col = a1_to_rowcol(range_name.split(':')[0])
+            for i, row_values in enumerate(change['values']):
+                for j, value in enumerate(row_values):
+                    worksheet._set(row + i, col + j, value)
+        return {'totalUpdatedCells': sum(len(change['values']) for change in body['data'])}
+
+
+class _FakeClientManager:
+    """Заменяет agcm: SheetsTransaction вызывает через него values_batch_update"""
+
+    def __init__(self, spreadsheet: 'FakeSpreadsheet'):
+        self.spreadsheet = spreadsheet
+
+    async def _call(self, method, *args, **kwargs):
+        await self.spreadsheet.api_call(method.__name__)
+        return method(*args, **kwargs)
+
+
+class FakeSpreadsheet:
+    def __init__(self, sheets: Dict[str, List[List[str]]], latency: float = 0.0):
+        """
+        :param sheets: Листы: название -> строки
+        :param latency: Задержка каждого обращения к "API" (сек)
+        """
+        self.latency = latency
+        self.calls = Counter()
+        self.sheets = {title: FakeWorksheet(self, title, rows) for title, rows in sheets.items()}
+        self.ss = _FakeSyncSpreadsheet(self)
+        self.agcm = _FakeClientManager(self)
+
+    async def api_call(self, method: str):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def worksheet(self, title: str):
+        await self.api_call('worksheet')
+        return self.sheets[title]
+
+
+class FakeSheetsManager:
+    """То же, что GoogleSheetsManager, но с таблицей в памяти"""
+
+    def __init__(self, spreadsheet: FakeSpreadsheet):
+        self.spreadsheet = spreadsheet
+
+    async def get_spreadsheet(self):
+        return self.spreadsheet
+
+    async def get_worksheet(self, title: str):
+        return self.spreadsheet.sheets[title]
+
+    async def warm_up(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+def ledger_rows(count: int, seed: int = 1) -> List[List[str]]:
+    """Заголовок и count строк Ledger со случайными значениями из небольших справочников"""
+    rnd = random.Random(seed)
+    rows = [list(LEDGER_HEADERS)]
+    for i in range(count):
+        source, target = rnd.sample(INSTANCES, 2)
+        rows.append([
+            f'{1 + i % 28:02d}.{1 + i % 12:02d}.2025', _format_number(rnd.randint(100, 500000)),
+            rnd.choice(CURRENCIES), target, source, rnd.choice(ARTICLES), rnd.choice(PROJECTS),
+            f'Комментарий {i % 500}', '', '', 'bench', '✓ в чат', '✓ баланс'
+        ])
+    return rows
+
+
+def balances_rows() -> List[List[str]]:
+    """Лист Balances: заголовок 'Инстанс', строка валют, инстансы и итог 'Всего'"""
+    rows = [['', ''], ['', 'Инстанс', ''], ['', ''] + CURRENCIES]
+    for instance in INSTANCES:
+        rows.append(['', instance] + [_format_number(1000000) for _ in CURRENCIES])
+    rows.append(['', 'Всего'] + [_format_number(1000000 * len(INSTANCES)) for _ in CURRENCIES])
+    return rows
+
+
+def make_spreadsheet(ledger_size: int, latency: float = 0.0) -> FakeSpreadsheet:
+    return FakeSpreadsheet({'Ledger': ledger_rows(ledger_size), 'Balances': balances_rows()}, latency=latency)
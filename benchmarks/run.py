@@ -0,0 +1,221 @@
+"""
+Нагрузочный прогон API без Google, ЦБ и Telegram.
+
+Google Sheets подменяется таблицей в памяти (benchmarks.fake_sheets) с задержкой на каждое обращение,
+ЦБ РФ и Telegram Bot API - локальными заглушками (benchmarks.fake_servers). Запросы идут в приложение
+напрямую через ASGI (httpx.ASGITransport), без сети и uvicorn.
+
+Для каждого размера Ledger, эндпоинта и числа одновременных запросов печатает p50/p99, запросы в секунду
+и обращения к Sheets API: в ответе на запрос (X-Sheets-Api-Calls) и всего, вместе с фоновыми (очереди, прогрев).
+
+/api/add-to-sheet и /api/send-to-chat работают через очереди в Postgres - они прогоняются только с --with-db
+и DATABASE_URL отдельной тестовой базы (в ней создаются задания и сообщения очереди).
+
+Запуск:
+    python -m benchmarks.run [--sizes 1000,10000,100000] [--concurrency 1,10,50] [--requests 200]
+                             [--sheets-latency 0.1] [--cbr-latency 0.05] [--telegram-latency 0.05] [--with-db]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+
+ENDPOINTS = ['read_GoogleTable', 'table-structure', 'exchange-rates', 'add-to-sheet', 'send-to-chat']
+DB_ENDPOINTS = {'add-to-sheet', 'send-to-chat'}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Размеры Ledger (строк) через запятую')
+    parser.add_argument('--concurrency', default='1,10,50', help='Числа одновременных запросов через запятую')
+    parser.add_argument('--requests', type=int, default=200, help='Запросов на каждый прогон')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='Эндпоинты через запятую')
+    parser.add_argument('--sheets-latency', type=float, default=0.1, help='Задержка обращения к Sheets API (сек)')
+    parser.add_argument('--cbr-latency', type=float, default=0.05, help='Задержка ответа ЦБ (сек)')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='Задержка ответа Bot API (сек)')
+    parser.add_argument('--with-db', action='store_true', help='Прогонять эндпоинты с очередями в Postgres')
+    parser.add_argument('--verbose', action='store_true', help='Не глушить вывод приложения')
+    return parser.parse_args()
+
+
+def percentile(sorted_values, q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+class Bench:
+    def __init__(self, args, main, cbr, telegram):
+        self.args = args
+        self.main = main
+        self.cbr = cbr
+        self.telegram = telegram
+        self.spreadsheet = None
+
+    async def install(self, spreadsheet):
+        """Свежие сервисы приложения поверх таблицы в памяти: пустые кэши, как после перезапуска"""
+        from handlers.balance_formation import GoogleSheetsBalanceUpdater
+        from handlers.work_with_GoogleTable import GoogleSheetsService
+        from service.exchange_rates import ExchangeRatesService
+        from service.shared_cache import LocalCache
+        from benchmarks.fake_sheets import FakeSheetsManager
+
+        main = self.main
+        manager = FakeSheetsManager(spreadsheet)
+        cache = LocalCache()  # снимки прошлой таблицы не должны попасть в новый прогон
+        await main.exchange_rates_service.close()
+        main.service_GoogleSheet_Ledger = GoogleSheetsService(manager=manager, cache=cache)
+        main.service_GoogleSheet_Balances = GoogleSheetsBalanceUpdater(manager=manager, cache=cache)
+        main.exchange_rates_service = ExchangeRatesService(base_url=self.cbr.base_url)
+        main.telegram_outbox.ledger = main.service_GoogleSheet_Ledger
+        # как в lifespan: прогрев до первого запроса
+        started = time.perf_counter()
+        await main.service_GoogleSheet_Ledger.warm_up()
+        await main.service_GoogleSheet_Balances.initialize()
+        self.spreadsheet = spreadsheet
+        return sum(spreadsheet.calls.values()), time.perf_counter() - started
+
+    def request_for(self, endpoint: str, i: int):
+        """Метод, путь и тело i-го запроса"""
+        from benchmarks.fake_sheets import ARTICLES, CURRENCIES, INSTANCES, PROJECTS
+
+        if endpoint == 'read_GoogleTable':
+            return 'GET', '/api/read_GoogleTable/', None
+        if endpoint == 'table-structure':
+            return 'GET', '/api/table-structure', None
+        if endpoint == 'exchange-rates':
+            return 'GET', '/api/exchange-rates', None
+        if endpoint == 'add-to-sheet':
+            return 'POST', '/api/add-to-sheet', {
+                'Дата': '01.01.2025', 'Сумма': 100 + i, 'Валюта': CURRENCIES[i % len(CURRENCIES)],
+                'Куда': INSTANCES[i % len(INSTANCES)], 'Откуда': INSTANCES[(i + 1) % len(INSTANCES)],
+                'Статья': ARTICLES[i % len(ARTICLES)], 'Проект': PROJECTS[i % len(PROJECTS)],
+                'Комментарий': f'benchmark {i}', 'Автор': 'bench',
+            }
+        if endpoint == 'send-to-chat':
+            return 'POST', '/api/send-to-chat', {
+                'Сумма': 100 + i, 'Статья': ARTICLES[i % len(ARTICLES)], 'номер строки': 2 + i,
+            }
+        raise ValueError(endpoint)
+
+    async def run_scenario(self, client, endpoint: str, concurrency: int) -> dict:
+        total = self.args.requests
+        semaphore = asyncio.Semaphore(concurrency)
+        timings = []
+        header_calls = 0
+        errors = 0
+        calls_before = sum(self.spreadsheet.calls.values())
+        sent_before = len(self.telegram.sent)
+
+        async def one(i: int):
+            nonlocal header_calls, errors
+            method, path, body = self.request_for(endpoint, i)
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.request(method, path, json=body)
+                timings.append(time.perf_counter() - started)
+            header_calls += int(response.headers.get('X-Sheets-Api-Calls', 0))
+            if response.status_code >= 400 or '"error"' in response.text[:200]:
+                errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        wall = time.perf_counter() - started
+
+        drain = None
+        if endpoint == 'send-to-chat':
+            # ответ не ждет Telegram: отдельно меряем, за сколько очередь разошлет сообщения
+            while len(self.telegram.sent) - sent_before < total and time.perf_counter() - started < 300:
+                await asyncio.sleep(0.05)
+            drain = time.perf_counter() - started
+
+        timings.sort()
+        return {
+            'p50': statistics.median(timings) * 1000,
+            'p99': percentile(timings, 0.99) * 1000,
+            'rps': total / wall,
+            'calls': header_calls / total,
+            'all_calls': (sum(self.spreadsheet.calls.values()) - calls_before) / total,
+            'errors': errors,
+            'drain': drain,
+        }
+
+
+async def bench(args):
+    from benchmarks.fake_servers import FakeCBRServer, FakeTelegramServer
+
+    cbr = await FakeCBRServer(latency=args.cbr_latency).start()
+    telegram = await FakeTelegramServer(latency=args.telegram_latency).start()
+
+    # адреса заглушек должны быть в окружении до импорта приложения
+    os.environ['CBR_BASE_URL'] = cbr.base_url
+    os.environ['TELEGRAM_API_BASE'] = telegram.base_url
+    os.environ.setdefault('TOKEN_Lora', '123456:benchmark')
+    os.environ.setdefault('telegram_chat_id', '-1001')
+    # лимиты Telegram на чат не дают измерить саму очередь - в бенчмарке их снимаем
+    os.environ.setdefault('TELEGRAM_CHAT_MESSAGES_PER_MINUTE', '100000')
+    os.environ.setdefault('TELEGRAM_CHAT_BURST', '1000')
+    os.environ.setdefault('TELEGRAM_MESSAGES_PER_SECOND', '100000')
+    os.environ.setdefault('TELEGRAM_OUTBOX_POLL_INTERVAL', '0.1')
+    os.environ.setdefault('SHEET_JOBS_POLL_INTERVAL', '0.1')
+    if not args.with_db:
+        # движок создается при импорте моделей, но без эндпоинтов с очередями к базе не подключается
+        os.environ.setdefault('DATABASE_URL', 'postgresql+asyncpg://benchmark@localhost/benchmark')
+
+    import httpx
+    import main
+    from benchmarks.fake_sheets import make_spreadsheet
+    from models.models import engine, init_db
+
+    engine.sync_engine.echo = False
+    endpoints = [e for e in args.endpoints.split(',') if e]
+    if not args.with_db:
+        skipped = [e for e in endpoints if e in DB_ENDPOINTS]
+        if skipped:
+            print(f"🟡 Пропущены (нужны --with-db и тестовая база): {', '.join(skipped)}")
+        endpoints = [e for e in endpoints if e not in DB_ENDPOINTS]
+    else:
+        await init_db()
+        main.telegram_outbox.start()
+        main.add_to_sheet_jobs.start()
+
+    bench = Bench(args, main, cbr, telegram)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    print(f"Задержки: Sheets {args.sheets_latency * 1000:.0f} мс, ЦБ {args.cbr_latency * 1000:.0f} мс, "
+          f"Telegram {args.telegram_latency * 1000:.0f} мс; запросов на прогон: {args.requests}")
+    print(f"{'эндпоинт':18} {'строк':>7} {'conc':>5} {'p50 мс':>9} {'p99 мс':>9} {'rps':>8} "
+          f"{'sheets/запр':>11} {'sheets всего':>12} {'ошибки':>7} {'очередь с':>9}")
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=300) as client:
+            for size in (int(s) for s in args.sizes.split(',')):
+                warm_up = None
+                for endpoint in endpoints:
+                    for concurrency in (int(c) for c in args.concurrency.split(',')):
+                        with quiet:
+                            installed = await bench.install(make_spreadsheet(size, latency=args.sheets_latency))
+                            result = await bench.run_scenario(client, endpoint, concurrency)
+                        if warm_up is None:
+                            warm_up = installed
+                            print(f"Ledger {size} строк: прогрев - {warm_up[0]} обращений к Sheets, {warm_up[1] * 1000:.0f} мс")
+                        drain = f"{result['drain']:9.2f}" if result['drain'] is not None else f"{'-':>9}"
+                        print(f"{endpoint:18} {size:7} {concurrency:5} {result['p50']:9.1f} {result['p99']:9.1f} "
+                              f"{result['rps']:8.1f} {result['calls']:11.2f} {result['all_calls']:12.2f} "
+                              f"{result['errors']:7} {drain}")
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            await main.add_to_sheet_jobs.close()
+            await main.telegram_outbox.close()
+            await main.exchange_rates_service.close()
+            await main.bot.session.close()
+        await cbr.close()
+        await telegram.close()
+        await engine.dispose()
+    print(f"Запросов к заглушкам: ЦБ {dict(cbr.requests)}, Telegram {dict(telegram.requests)}")
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(bench(parse_args())))
@@ -0,0 +1,106 @@
+"""
+Сравнение запросов портфеля на большой синтетической истории users_wallets.
+
+Создает тестового пользователя с TOKENS токенами по SNAPSHOTS снимков на каждый, измеряет
+старый запрос (GROUP BY + соединение по (token, created_at)), DISTINCT ON и запрос приложения
+(рекурсивный перебор токенов + LATERAL LIMIT 1), печатает p50/p99 и план запроса приложения,
+затем удаляет тестовые данные.
+
+Запуск (нужна отдельная база, DATABASE_URL как у приложения):
+    python -m benchmarks.wallet_history [TOKENS] [SNAPSHOTS] [REPEATS]
+"""
+import asyncio
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select, text
+
+from handlers.requests import wallet_latest_query
+from models.models import async_session, engine, init_db, UserAuth, UserWallet
+
+
+def legacy_query(user_id):
+    """Запрос get_wallet_user до перехода на DISTINCT ON"""
+    subq = (select(UserWallet.token, func.max(UserWallet.created_at).label("max_created_at"))
+            .where(UserWallet.user_id == user_id)
+            .group_by(UserWallet.token)
+            .subquery())
+    return (select(UserWallet)
+            .join(subq, (UserWallet.token == subq.c.token) &
+                  (UserWallet.created_at == subq.c.max_created_at))
+            .where(UserWallet.user_id == user_id)
+            .order_by(UserWallet.token))
+
+
+def distinct_on_query(user_id):
+    """DISTINCT ON по индексу (user_id, token, created_at DESC): читает все снимки пользователя"""
+    return (select(UserWallet)
+            .where(UserWallet.user_id == user_id)
+            .distinct(UserWallet.token)
+            .order_by(UserWallet.token, UserWallet.created_at.desc()))
+
+
+async def fill_history(user_id: int, tokens: int, snapshots: int, batch_size: int = 5000):
+    start = datetime.utcnow() - timedelta(minutes=snapshots)
+    rows = [
+        {
+            'full_name': 'benchmark', 'token': f'TKN{t:03d}', 'quantity': 1, 'resalt_of_quantity': 1,
+            'price_of_token': s, 'resalt': s, 'created_at': start + timedelta(minutes=s), 'user_id': user_id
+        }
+        for s in range(snapshots) for t in range(tokens)
+    ]
+    async with async_session() as session:
+        for i in range(0, len(rows), batch_size):
+            await session.execute(insert(UserWallet), rows[i:i + batch_size])
+        await session.commit()
+        await session.execute(text('ANALYZE public.users_wallets'))
+        await session.commit()
+
+
+async def measure(query, repeats: int):
+    timings = []
+    async with async_session() as session:
+        for _ in range(repeats):
+            started = time.perf_counter()
+            rows = (await session.execute(query)).scalars().all()
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return len(rows), statistics.median(timings), timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+
+async def main(tokens: int = 20, snapshots: int = 5000, repeats: int = 50):
+    engine.sync_engine.echo = False  # иначе лог каждого запроса заглушит результаты
+    await init_db()
+    async with async_session() as session:
+        user = UserAuth(full_name='benchmark', id_telegram='', login='benchmark-wallet-history')
+        session.add(user)
+        await session.commit()
+        user_id = user.id
+
+    try:
+        print(f"История: {tokens} токенов x {snapshots} снимков = {tokens * snapshots} строк")
+        await fill_history(user_id, tokens, snapshots)
+
+        for name, query in (('GROUP BY + JOIN', legacy_query(user_id)),
+                            ('DISTINCT ON', distinct_on_query(user_id)),
+                            ('токены + LATERAL', wallet_latest_query(user_id))):
+            count, p50, p99 = await measure(query, repeats)
+            print(f"{name:16} строк {count:4}  p50 {p50:8.2f} мс  p99 {p99:8.2f} мс")
+
+        async with async_session() as session:
+            compiled = wallet_latest_query(user_id).compile(
+                dialect=session.bind.dialect, compile_kwargs={'literal_binds': True}
+            )
+            plan = await session.execute(text(f'EXPLAIN ANALYZE {compiled}'))
+            print('\n'.join(row[0] for row in plan))
+    finally:
+        async with async_session() as session:
+            await session.execute(delete(UserWallet).where(UserWallet.user_id == user_id))
+            await session.execute(delete(UserAuth).where(UserAuth.id == user_id))
+            await session.commit()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*(int(arg) for arg in sys.argv[1:])))
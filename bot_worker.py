@@ -0,0 +1,20 @@
+"""
+Бот Lora в отдельном процессе: long polling без API (BOT_MODE=worker у процессов API).
+
+Запуск:
+    python bot_worker.py
+"""
+import asyncio
+
+from service.telegram_bot import bot, dp
+
+
+async def main():
+    # пока у бота зарегистрирован webhook, getUpdates отвечает ошибкой
+    await bot.delete_webhook()
+    print("✅ Бот Lora: long polling в отдельном процессе")
+    await dp.start_polling(bot)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
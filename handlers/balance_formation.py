@@ -1,35 +1,144 @@
-from service.google_table_authorization import GoogleSheetsManager
-
-from typing import Dict, Optional
+from service.google_table_authorization import GoogleSheetsManager, shared_sheets_manager
+from service.shared_cache import LocalCache, shared_cache
+from service.request_stats import sheets_call
+from service.sheets_transaction import SheetsTransaction
+
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional, Tuple
 from gspread.utils import a1_to_rowcol, rowcol_to_a1
 
 
+# Как часто (сек) перечитывать лист Balances целиком, чтобы подхватить ручные правки в таблице
+BALANCES_RESYNC_INTERVAL = float(os.getenv('BALANCES_RESYNC_INTERVAL', 300))
+
+
 class GoogleSheetsBalanceUpdater:
-    def __init__(self):
-        self.manager = GoogleSheetsManager()
+    """
+    Обновление листа Balances.
+
+    Лист загружается в память одним запросом (матрица инстанс × валюта), транзакция применяется
+    к матрице локально, а измененная ячейка и итог "Всего" записываются одним values_batch_update.
+    Матрица периодически перечитывается из таблицы (BALANCES_RESYNC_INTERVAL).
+
+    Запись ведет один писатель: задания (транзакции одного вызова и изменения других листов), пришедшие
+    пока идет запись, копятся в очереди, суммы по одному (инстанс, валюта) складываются, и вся очередь
+    уходит следующим запросом. Задание записывается целиком или не записывается совсем.
+
+    Матрица хранится и в общем кэше воркеров: писатель один на все воркеры (общая блокировка),
+    перед записью берет матрицу последнего писателя, после записи кладет свою и сбрасывает ее у остальных.
+    """
+
+    def __init__(self, manager: Optional[GoogleSheetsManager] = None, cache: Optional[LocalCache] = None):
+        self.manager = manager or shared_sheets_manager
+        self.cache = cache or shared_cache
+        self.cache_key = 'balances:matrix'
         self.sheet_name = 'Balances'
         self.spreadsheet = None
         self.worksheet = None
+        self._matrix: List[List[str]] = []  # значения листа, как их отдает get_all_values
+        self._loaded_at: Optional[float] = None
+        self._matrix_at = 0.0  # time.time(), на который матрица совпадает с таблицей
+        self._totals: Dict[str, float] = {}  # итог "Всего" по валюте, ведется инкрементально
+        self._instance_rows: Dict[str, int] = {}  # инстанс -> номер строки
+        self._currency_cols: Dict[str, int] = {}  # валюта -> номер колонки
+        # задания, ожидающие записи: транзакции, изменения других листов (SheetsTransaction) и future с сообщениями
+        self._pending: List[Tuple[List[Dict], Optional[SheetsTransaction], asyncio.Future]] = []
+        self._writer_lock = asyncio.Lock()
+        self.cache.add_listener(self._on_shared_invalidate)
+
+    def _on_shared_invalidate(self, key: Optional[str], at: float):
+        """Другой воркер записал Balances - матрицу возьмем из общего кэша при следующем обращении"""
+        if key is None or key == self.cache_key:
+            self._loaded_at = None
+
+    def _mark_diverged(self):
+        """Матрица могла разойтись с таблицей - перечитаем лист (не из общего кэша) при следующем обновлении"""
+        self._loaded_at = None
+        self._matrix_at = time.time()
 
     async def initialize(self):
-        """Инициализация подключения к таблице"""
+        """Инициализация подключения к таблице и загрузка листа в память"""
         if not self.spreadsheet:
             self.spreadsheet = await self.manager.get_spreadsheet()
-            self.worksheet = await self.spreadsheet.worksheet(self.sheet_name)
-            await self._detect_table_structure()
+            self.worksheet = await self.manager.get_worksheet(self.sheet_name)
+
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > BALANCES_RESYNC_INTERVAL:
+            await self._load_matrix()
+
+    async def _call(self, method: str, *args, **kwargs):
+        """Обращение к листу через gspread_asyncio с учетом в счетчике запросов к Sheets API"""
+        return await sheets_call(self.worksheet, method, *args, **kwargs)
+
+    async def _load_matrix(self):
+        """
+        Загружает лист Balances: из общего кэша, если матрица там не старше BALANCES_RESYNC_INTERVAL
+        и не старше нашей, иначе целиком одним запросом к таблице
+        """
+        if await self._load_shared_matrix(max_age=BALANCES_RESYNC_INTERVAL):
+            return
+        started = time.time()
+        self._apply_matrix(await self._call('get_all_values'), started)
+        await self._check_totals()
+        try:
+            await self.cache.set(self.cache_key, self._matrix, stored_at=started)
+        except Exception as e:
+            print(f"🟡 Матрица Balances не сохранена в общий кэш: {e}")
+
+    async def _load_shared_matrix(self, max_age: float = float('inf')) -> bool:
+        """Берет матрицу из общего кэша, если ее записал другой воркер после нашей"""
+        try:
+            entry = await self.cache.get(self.cache_key)
+        except Exception as e:
+            print(f"🟡 Общий кэш недоступен для Balances: {e}")
+            return False
+        if entry is None:
+            return False
+        matrix, stored_at = entry
+        if stored_at <= self._matrix_at and self._loaded_at is not None:
+            return False  # наша матрица не старше
+        if stored_at < self._matrix_at or time.time() - stored_at > max_age:
+            return False
+        self._apply_matrix(matrix, stored_at)
+        return True
+
+    def _apply_matrix(self, matrix: List[List[str]], stored_at: float):
+        self._matrix = matrix
+        self._detect_table_structure()
+        self._build_indexes()
+        self._totals = {}  # итоги пересчитаются по свежей матрице при первом обращении
+        self._matrix_at = stored_at
+        self._loaded_at = time.monotonic() - max(time.time() - stored_at, 0)
+
+    async def _publish_matrix(self):
+        """После записи: матрица - в общий кэш, у остальных воркеров - сброс"""
+        self._matrix_at = time.time()
+        try:
+            await self.cache.set(self.cache_key, self._matrix, stored_at=self._matrix_at)
+            await self.cache.invalidate(self.cache_key, self._matrix_at)
+        except Exception as e:
+            print(f"🟡 Матрица Balances не сохранена в общий кэш: {e}")
+
+    def _find_cell(self, value: str) -> Optional[tuple]:
+        """Ищет ячейку с точным значением в загруженной матрице, возвращает (строка, колонка) с 1"""
+        for row_num, row in enumerate(self._matrix, 1):
+            for col_num, cell_value in enumerate(row, 1):
+                if cell_value == value:
+                    return row_num, col_num
+        return None
 
-    async def _detect_table_structure(self):
+    def _detect_table_structure(self):
         """Определение структуры таблицы"""
         # Находим заголовок "Инстанс" (может быть с опечаткой)
         header = "Инстанс"
 
-        try:
-            cell = await self.worksheet.find(header)
-            self.instance_col = rowcol_to_a1(1, cell.col)[0]  # Буква колонки
+        cell = self._find_cell(header)
+        if cell:
+            self.instance_header_row, self.instance_header_col = cell  # Цифра колонки для вставки новой валюты колонки
+            self.instance_col = rowcol_to_a1(1, self.instance_header_col)[:-1]  # Буква колонки
             print(f"Буква колонки {self.instance_col}")
-            self.instance_header_row = cell.row
-            self.instance_header_col= cell.col # Цифра колонки для вставки новой валюты колонки
-        except Exception:
+        else:
             print("Не удалось найти заголовок с инстансами")
         # Строка с валютами (на 1 строку ниже)
         self.currency_header_row = self.instance_header_row + 1
@@ -39,79 +148,233 @@ class GoogleSheetsBalanceUpdater:
         # для сохранения сущестующего форматирования ячеек
 
         # Находим строку "Всего"
-        try:
-            total_cell = await self.worksheet.find("Всего")
-            self.total_row = total_cell.row
-        except Exception:
-            self.total_row = None
+        total_cell = self._find_cell("Всего")
+        self.total_row = total_cell[0] if total_cell else None
+
+    def _build_indexes(self):
+        """Строит индексы инстанс -> строка и валюта -> колонка по матрице (берется первое вхождение)"""
+        self._instance_rows = {}
+        for row_num, row in enumerate(self._matrix, 1):
+            if len(row) >= self.instance_header_col and row[self.instance_header_col - 1]:
+                self._instance_rows.setdefault(row[self.instance_header_col - 1], row_num)
+
+        self._currency_cols = {}
+        for col_num, currency in enumerate(self._matrix[self.currency_header_row - 1], 1):
+            if currency.strip():
+                self._currency_cols.setdefault(currency.strip(), col_num)
+
+    def _shift_rows(self, insert_row: int):
+        """Сдвигает индексы строк после вставки строки на позицию insert_row"""
+        for name, row_num in self._instance_rows.items():
+            if row_num >= insert_row:
+                self._instance_rows[name] = row_num + 1
+        if self.total_row and self.total_row >= insert_row:
+            self.total_row += 1
+        # новая строка вставляется на место первой строки данных и сама становится первой строкой данных,
+        # поэтому first_data_row сдвигается только при вставке выше нее
+        if self.first_data_row > insert_row:
+            self.first_data_row += 1
+
+    def _shift_cols(self, insert_col: int):
+        """Сдвигает индексы колонок после вставки колонки на позицию insert_col"""
+        for currency, col_num in self._currency_cols.items():
+            if col_num >= insert_col:
+                self._currency_cols[currency] = col_num + 1
+        if self.instance_header_col >= insert_col:
+            self.instance_header_col += 1
+            self.instance_col = rowcol_to_a1(1, self.instance_header_col)[:-1]
+
+    def _cell_value(self, row_num: int, col_num: int) -> str:
+        """Значение ячейки из матрицы (пустая строка, если ячейки нет)"""
+        if row_num <= len(self._matrix) and col_num <= len(self._matrix[row_num - 1]):
+            return self._matrix[row_num - 1][col_num - 1]
+        return ""
+
+    def _set_cell_value(self, row_num: int, col_num: int, value: str):
+        """Записывает значение ячейки в матрицу, расширяя ее при необходимости"""
+        while len(self._matrix) < row_num:
+            self._matrix.append([])
+        row = self._matrix[row_num - 1]
+        while len(row) < col_num:
+            row.append("")
+        row[col_num - 1] = value
+
+    @staticmethod
+    def _format_number(num: float) -> str:
+        """Число в виде, как его показывает таблица: "-35 000,00" """
+        return "{:,.2f}".format(num).replace(","," ").replace(".",",")
 
 
     async def update_balance(self, transaction: Dict) -> str:
         """Обновляет баланс в таблице"""
-
-        await self.initialize()
         print(f"******** работает update_balance. transaction = {transaction}")
-        # Получаем список валют
-        currencies = await self.worksheet.row_values(self.currency_header_row)
+        messages = await self._submit([transaction])
+        return messages[0]
 
-        if currencies and (transaction['Валюта'] not in currencies):
-            currency_name = transaction['Валюта'].strip()
-            # Добавляем новую колонку после 'Инстанс'
-            await self._add_new_column_currency(currency_name)
+
+    async def update_balances(self, transactions: List[Dict], sheets_tx: SheetsTransaction) -> List[str]:
+        """
+        Обновляет балансы по транзакциям и записывает их вместе с изменениями других листов из sheets_tx
+        одним запросом (например, строка Ledger с отметкой о балансе + 'Куда' + 'Откуда' + итоги).
+
+        Транзакции и sheets_tx записываются целиком или не записываются: если хоть одну транзакцию применить
+        нельзя, ни одна из них и ни одно изменение sheets_tx в таблицу не попадут (задание можно повторить).
+
+        :return: Сообщения по каждой транзакции
+        """
+        print(f"******** работает update_balances. transactions = {transactions}")
+        return await self._submit(transactions, sheets_tx)
+
+
+    async def _submit(self, transactions: List[Dict], sheets_tx: Optional[SheetsTransaction] = None) -> List[str]:
+        """Ставит задание в очередь и ждет, пока его запишет этот или предыдущий писатель"""
+        job = (list(transactions), sheets_tx, asyncio.get_running_loop().create_future())
+        self._pending.append(job)
         try:
-            # Находим колонку для валюты
-            currencies = await self.worksheet.row_values(self.currency_header_row)
-            currency_col = rowcol_to_a1(1, currencies.index(transaction['Валюта']) + 1)[0]
-            print(f"колонка для валюты {(transaction['Валюта'])} - {currency_col}")
-
-            # Проверяем существование инстанса
-            instance_row = await self._find_instance_row(transaction['Инстанс'])
-
-            if instance_row is None:
-                # Добавляем новый инстанс перед старыми
-                 await self._add_new_instance(transaction, currency_col)
-
-                # Обновляем существующий балан
-            instance_row = await self._find_instance_row(transaction['Инстанс'])
-            return await self._update_existing_balance(
-                transaction,
-                instance_row,
+            # shield: если клиент отключился, задание из очереди все равно будет записано
+            await asyncio.shield(self._drain())
+        except Exception:
+            # писатель не запустился (например, недоступна общая блокировка) - задание не должно записаться позже
+            if job in self._pending:
+                self._pending.remove(job)
+                raise
+        return await job[2]
+
+
+    async def _drain(self):
+        """
+        Записывает все накопленные задания одним запросом к API: одна запись на (инстанс, валюта),
+        итоги "Всего" и изменения других листов из sheets_tx заданий
+        """
+        async with self._writer_lock, self.cache.lock('balances:writer'):
+            jobs, self._pending = self._pending, []
+            if not jobs:
+                return  # наши задания уже записал предыдущий писатель
+            try:
+                results = await self._write(jobs)
+            except Exception as e:
+                # не записано ни одно задание, матрица могла разойтись с таблицей - перечитаем при следующем обновлении
+                self._mark_diverged()
+                message = f"❌ Ошибка при обновлении баланса: {str(e)}"
+                results = [[message] * max(len(transactions), 1) for transactions, _, _ in jobs]
+
+            for (_, _, future), messages in zip(jobs, results):
+                if not future.done():
+                    future.set_result(messages)
+
+
+    async def _write(self, jobs: List[Tuple[List[Dict], Optional[SheetsTransaction], asyncio.Future]]) -> List[List[str]]:
+        """
+        Применяет задания к матрице и записывает их одним values_batch_update
+
+        :return: Сообщения по каждой транзакции каждого задания
+        """
+        # предыдущим писателем мог быть другой воркер - берем его матрицу
+        if self._loaded_at is not None:
+            await self._load_shared_matrix()
+        await self.initialize()
+
+        # Все задания проверяются до первой вставки строк и колонок. Задание с ошибкой в данных не пишется
+        # целиком - ни его балансы, ни его изменения других листов; остальные задания записываются
+        results: List[Optional[List[str]]] = [None] * len(jobs)
+        for i, (transactions, _, _) in enumerate(jobs):
+            try:
+                transactions[:] = [self._check_transaction(transaction) for transaction in transactions]
+            except Exception as e:
+                results[i] = [f"❌ Ошибка при обновлении баланса: {str(e)}"] * max(len(transactions), 1)
+        accepted = [i for i in range(len(jobs)) if results[i] is None]
+
+        # Сначала все вставки строк и колонок (новые инстансы и валюты), затем значения: вставка сдвигает
+        # строки и колонки, поэтому адреса ячеек считаем только по итоговой матрице.
+        # Ошибка вставки прерывает всю запись: неизвестно, применилась ли она в таблице
+        for i in accepted:
+            for transaction in jobs[i][0]:
+                await self._prepare_structure(transaction)
+
+        # Группируем по (инстанс, валюта), сохраняя порядок поступления
+        groups: Dict[tuple, List[Tuple[int, int, Dict]]] = {}
+        for i in accepted:
+            results[i] = [""] * len(jobs[i][0])
+            for n, transaction in enumerate(jobs[i][0]):
+                groups.setdefault((transaction['Инстанс'], transaction['Валюта']), []).append((i, n, transaction))
+
+        sheets_tx = SheetsTransaction()
+        for (instance, currency), items in groups.items():
+            currency_col = rowcol_to_a1(1, self._currency_cols[currency])[:-1]
+            messages, changes = await self._update_existing_balance(
+                [t for _, _, t in items],
+                self._find_instance_row(instance),
                 currency_col
             )
+            for change in changes:
+                # для итога "Всего" остается последнее значение
+                sheets_tx.set(self.sheet_name, change['range'], change['values'])
+            for (i, n, _), message in zip(items, messages):
+                results[i][n] = message
+
+        # Изменения других листов и действия после записи - только у принятых заданий
+        for i in accepted:
+            if jobs[i][1] is not None:
+                sheets_tx.merge(jobs[i][1])
+
+        # Балансы, итоги и изменения других листов записываем одним запросом
+        await sheets_tx.commit(self.spreadsheet)
+        if groups:
+            await self._publish_matrix()
+        return results
+
+
+    def _check_transaction(self, transaction: Dict) -> Dict:
+        """Проверка данных транзакции до любых изменений листа, возвращает транзакцию с валютой без пробелов по краям"""
+        if not transaction['Инстанс'] or not isinstance(transaction['Валюта'], str) or not transaction['Валюта'].strip():
+            raise ValueError("Не указан инстанс или валюта")
+        if not isinstance(transaction['Сумма'], (int, float)):
+            raise ValueError(f"Сумма должна быть числом: {transaction['Сумма']}")
+        if not self._currency_cols:
+            raise ValueError("Не найдена строка валют на листе Balances")
+        # колонка добавляется и ищется по одному и тому же имени: ' CNY' и 'CNY' - одна валюта
+        return {**transaction, 'Валюта': transaction['Валюта'].strip()}
+
+
+    async def _prepare_structure(self, transaction: Dict):
+        """Добавляет колонку валюты и строку инстанса транзакции, если их еще нет"""
+        # Проверяем валюту по индексу колонок (имя уже нормализовано в _check_transaction)
+        if transaction['Валюта'] not in self._currency_cols:
+            # Добавляем новую колонку после 'Инстанс'
+            await self._add_new_column_currency(transaction['Валюта'])
 
-        except Exception as e:
-            return f"❌ Ошибка при обновлении баланса: {str(e)}"
+        # Проверяем существование инстанса
+        if self._find_instance_row(transaction['Инстанс']) is None:
+            # Добавляем новый инстанс перед старыми
+            await self._add_new_instance(transaction)
 
 
-    async def _find_instance_row(self, instance_name: str) -> Optional[int]:
+    def _find_instance_row(self, instance_name: str) -> Optional[int]:
         """Находит строку с указанным инстансом"""
-        instances = await self.worksheet.col_values(a1_to_rowcol(f'{self.instance_col}1')[1])
-        for i, value in enumerate(instances, 1):
-            if value == instance_name:
-                return i
-        return None
+        return self._instance_rows.get(instance_name)
 
 
-    async def _add_new_instance(self, transaction: dict, currency_col: str) -> str:
+    async def _add_new_instance(self, transaction: dict) -> str:
         """Добавляет новый инстанс перед существующими записями"""
         # Определяем позицию для вставки (после заголовков и перед старыми данными)
         insert_row = self.first_data_row
 
         # Подготавливаем новую строку
-        currencies = await self.worksheet.row_values(self.currency_header_row)
-        new_row = [""] * len(currencies)
-        new_row[1] = transaction['Инстанс']  # В колонке инстансов
+        currencies = self._matrix[self.currency_header_row - 1]
+        new_row = [""] * max(len(currencies), self.instance_header_col)
+        new_row[self.instance_header_col - 1] = transaction['Инстанс']  # В колонке инстансов
 
         # Вставляем новую строку
-        await self.worksheet.insert_row(
+        await self._call(
+            'insert_row',
             values=new_row,
             index=insert_row
         )
+        self._matrix.insert(insert_row - 1, new_row)
 
-        # Обновляем позицию "Всего", если она была
-
-        total_cell = await self.worksheet.find("Всего")
-        self.total_row = total_cell.row
+        # Сдвигаем индексы строк (в том числе "Всего") и добавляем новый инстанс
+        self._shift_rows(insert_row)
+        self._instance_rows[transaction['Инстанс']] = insert_row
         print(f"self.total_row = {self.total_row}")
 
         return f"✅ Добавлен новый инстанс '{transaction['Инстанс']}' с суммой {transaction['Сумма']} {transaction['Валюта']}"
@@ -120,28 +383,35 @@ class GoogleSheetsBalanceUpdater:
     async def _add_new_column_currency(self,  currency: str) -> str:
         """Добавляет новую валюту после колонки 'Инстанс'"""
         # Определяем позицию для вставки (после первой валюты для сохранения форматированияи )
-        try:
-            insert_col = self.instance_header_col + 2
+        insert_col = self.instance_header_col + 2
+        column_letter = rowcol_to_a1(1, insert_col)[:-1]
 
-            # Вставляем новую колонку
+        # Вставляем новую колонку
 
-            await self.worksheet.insert_cols([[]], insert_col, value_input_option='USER_ENTERED') # self.insert_col
-            # Устанавливаем заголовок во второй строке
-            await self.worksheet.update('D3', [[currency]])  # C - третья колонка
-            column_range = f"{'D'}:{'D'}" # устанавливаем пользовательский формат для всей колонки, иначе устанавливает
-            # таблица, без разделения на тысячи
+        await self._call('insert_cols', [[]], insert_col, value_input_option='USER_ENTERED') # self.insert_col
+        # Устанавливаем заголовок во второй строке
+        await self._call('update', [[currency]], f'{column_letter}{self.currency_header_row}')
+        column_range = f"{column_letter}:{column_letter}" # устанавливаем пользовательский формат для всей колонки, иначе устанавливает
+        # таблица, без разделения на тысячи
 
-            # Устанавливаем кастомный числовой формат
-            await self.worksheet.format(column_range, {
-                "numberFormat": {
-                    "type": "NUMBER",
-                    "pattern": "#,##0.00"  # Кастомный формат с пробелами
-                }
-            })
+        # Устанавливаем кастомный числовой формат
+        await self._call('format', column_range, {
+            "numberFormat": {
+                "type": "NUMBER",
+                "pattern": "#,##0.00"  # Кастомный формат с пробелами
+            }
+        })
 
-            return print(f"✅ Добавлена новая колонка валюты  {currency} ")
-        except Exception as e:
-            return f"❌ Ошибка добавления колонки: {str(e)}"
+        # Повторяем вставку в матрице
+        for row in self._matrix:
+            if len(row) >= insert_col - 1:
+                row.insert(insert_col - 1, "")
+        self._set_cell_value(self.currency_header_row, insert_col, currency)
+        self._shift_cols(insert_col)
+        self._currency_cols[currency] = insert_col
+
+        print(f"✅ Добавлена новая колонка валюты  {currency} ")
+        return f"✅ Добавлена новая колонка валюты {currency}"
 
 
 
@@ -165,57 +435,99 @@ class GoogleSheetsBalanceUpdater:
 
     async def _update_existing_balance(
             self,
-            transaction: dict,
+            transactions: List[Dict],
             row_num: int,
             currency_col: str
-    ) -> str:
-        """Обновляет баланс существующего инстанса"""
+    ) -> Tuple[List[str], List[dict]]:
+        """Обновляет баланс существующего инстанса суммой всех транзакций одной записью"""
+        transaction = transactions[0]
+        col_num = a1_to_rowcol(f'{currency_col}1')[1]
         cell_ref = f'{currency_col}{row_num}'
-        cell = await self.worksheet.acell(cell_ref)
-        current_value = await self._reFormatting(cell.value.strip() if cell.value else "0")
-
-        current_num = float(current_value)
+        cell_value = self._cell_value(row_num, col_num)
+        current_value = await self._reFormatting(cell_value.strip() if cell_value else "0")
 
-        #current_num = float(current_value)
-        sum_num = transaction['Сумма']
+        current_num = float(current_value or 0)
 
-        #sum_num = float(sum_value)
-        new_value = current_num + sum_num
+        # Каждая транзакция получает свое "было → стало", записывается только итоговое значение
+        messages = []
+        new_value = current_num
+        for t in transactions:
+            old_value, new_value = new_value, new_value + t['Сумма']
+            messages.append(f"✅ Обновлен баланс 'Balances'\n {t['Инстанс']}: {old_value} → {new_value} {t['Валюта']}")
+        sum_num = new_value - current_num
 
-        print(f"*********  работает  _update_existing_balance , current_num = {current_num}, sum_num = {sum_num}, new_value = {new_value}")
-        #formatted_new_value = "{:,.2f}".format(new_value).replace(","," ").replace(".",",")
+        print(f"*********  работает  _update_existing_balance , current_num = {current_num}, sum_num = {sum_num}, new_value = {new_value}, транзакций: {len(transactions)}")
 
-        await self.worksheet.update_acell(cell_ref, new_value)
+        self._set_cell_value(row_num, col_num, self._format_number(new_value))
+        changes = [{'range': cell_ref, 'values': [[new_value]]}]
 
         # Обновляем итоги
-        await self._update_totals(currency_col)
+        total_change = await self._update_totals(currency_col, transaction['Валюта'], sum_num)
+        if total_change:
+            changes.append(total_change)
 
-        return f"✅ Обновлен баланс 'Balances'\n {transaction['Инстанс']}: {current_num} → {new_value} {transaction['Валюта']}"
+        return messages, changes
 
 
-    async def _update_totals(self, currency_col: str) -> str:
-        """Пересчитывает итоги по указанной валюте"""
+    async def _update_totals(self, currency_col: str, currency: str, delta: float) -> Optional[dict]:
+        """
+        Обновляет итог по валюте на сумму транзакции (старый итог + delta), возвращает изменение ячейки итога.
+
+        Полный пересчет колонки делается только после загрузки листа (в том числе периодической,
+        BALANCES_RESYNC_INTERVAL, со сверкой с ячейкой итога в _check_totals): ручная правка
+        в таблице до перечитывания не учитывается.
+        """
+        if not self.total_row:
+            print("❌ Строка 'Всего' не найдена")
+            return None
+        col_num = a1_to_rowcol(f'{currency_col}1')[1]
+
+        total = self._totals.get(currency)
+        if total is None:
+            # баланс инстанса в матрице уже обновлен, поэтому пересчет включает delta
+            total = await self._recompute_total(col_num)
+        else:
+            total += delta
+        self._totals[currency] = total
+
+        formatted_total = self._format_number(total)
+        print(f'итого в: {currency_col}{self.total_row} , значение: {formatted_total}')
+        self._set_cell_value(self.total_row, col_num, formatted_total)
+        return {'range': f'{currency_col}{self.total_row}', 'values': [[formatted_total]]}
+
+
+    async def _check_totals(self):
+        """
+        Сверяет итоги "Всего" в только что прочитанном листе с суммами колонок валют.
+        Расхождение (ручная правка итога или балансов) выводится в лог, итог берется пересчитанный
+        и запишется в таблицу при следующем обновлении этой валюты
+        """
         if not self.total_row:
-            return "❌ Строка 'Всего' не найдена"
-        print(f"_update_totals self.total_row={self.total_row}, currency_col={currency_col}")
-        values = await self.worksheet.col_values(a1_to_rowcol(f'{currency_col}1')[1])
-        print(f"values = {values}")
+            return
+        for currency, col_num in self._currency_cols.items():
+            total = await self._recompute_total(col_num)
+            self._totals[currency] = total
+            sheet_total = self._cell_value(self.total_row, col_num)
+            try:
+                matches = abs(float(await self._reFormatting(sheet_total.strip()) or 0) - total) < 0.005
+            except ValueError:
+                matches = False
+            if not matches:
+                print(f"🟡 Итог 'Всего' по {currency} в таблице ({sheet_total}) не совпадает "
+                      f"с суммой колонки ({self._format_number(total)}), будет записан пересчитанный")
+
+
+    async def _recompute_total(self, col_num: int) -> float:
+        """Полный пересчет итога по колонке валюты по матрице"""
+        print(f"Пересчет итога по колонке {col_num}")
         total = 0.0
 
-        for i, value in enumerate(values, 1):
-            if i != self.total_row and i >= self.first_data_row:
+        for i in range(self.first_data_row, len(self._matrix) + 1):
+            if i != self.total_row:
                 try:
-                    cleaned_value = await self._reFormatting(value.strip())  #re.sub(r'[^0-9-]', '', value) if value else '0'
+                    cleaned_value = await self._reFormatting(self._cell_value(i, col_num).strip())
                     total += float(cleaned_value)
-                    print(f"value = {value}, cleaned_value = {cleaned_value}, total = {total}")
                 except ValueError:
                     continue
 
-        formatted_total = "{:,.2f}".format(total).replace(","," ").replace(".",",")
-        print(f'итого в: {currency_col}{self.total_row} , значение: {formatted_total}')
-        await self.worksheet.update_acell(f'{currency_col}{self.total_row}', formatted_total)
-        return print("✅ Итоги обновлены")
-
-
-
-
+        return total
@@ -0,0 +1,159 @@
+import asyncio
+import os
+from datetime import date, timedelta
+from typing import Dict, List, Optional
+
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from models.models import async_session, init_db, ExchangeRate
+from service.exchange_rates import ExchangeRatesService
+
+
+load_dotenv(find_dotenv())
+
+# Сколько дат запрашивать у ЦБ одновременно при заполнении истории
+BACKFILL_CONCURRENCY = int(os.getenv('EXCHANGE_RATES_BACKFILL_CONCURRENCY', 5))
+# Сколько строк (дата, валюта) записывать одним INSERT ... ON CONFLICT
+BACKFILL_BATCH_SIZE = int(os.getenv('EXCHANGE_RATES_BACKFILL_BATCH_SIZE', 1000))
+# Сколько дней загружать и записывать за один шаг: прерванная загрузка продолжится с недописанного шага
+BACKFILL_CHUNK_DAYS = int(os.getenv('EXCHANGE_RATES_BACKFILL_CHUNK_DAYS', 31))
+
+
+def _days(date_from: date, date_to: date) -> List[date]:
+    return [date_from + timedelta(days=i) for i in range((date_to - date_from).days + 1)]
+
+
+async def save_rates(rows: List[dict], batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """
+    Записывает курсы пачками (upsert по дате и валюте)
+
+    :param rows: Список словарей {'rate_date': date, 'char_code': str, 'rate': float}
+    :return: Количество записанных строк
+    """
+    if not rows:
+        return 0
+    async with async_session() as session:
+        for start in range(0, len(rows), batch_size):
+            stmt = insert(ExchangeRate).values(rows[start:start + batch_size])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[ExchangeRate.rate_date, ExchangeRate.char_code],
+                set_={'rate': stmt.excluded.rate, 'loaded_at': stmt.excluded.loaded_at}
+            )
+            await session.execute(stmt)
+        await session.commit()
+    return len(rows)
+
+
+async def get_stored_dates(date_from: date, date_to: date) -> set:
+    """Даты из диапазона, за которые курсы уже есть в базе"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(ExchangeRate.rate_date)
+            .where(ExchangeRate.rate_date.between(date_from, date_to))
+            .distinct()
+        )
+        return set(result.scalars().all())
+
+
+async def backfill_exchange_rates(rates_service: ExchangeRatesService, date_from: date, date_to: date,
+                                  concurrency: int = BACKFILL_CONCURRENCY, overwrite: bool = False,
+                                  chunk_days: int = BACKFILL_CHUNK_DAYS) -> dict:
+    """
+    Заполняет историю курсов ЦБ РФ за период
+
+    Период проходится шагами по chunk_days дней: даты шага запрашиваются параллельно
+    (не более concurrency запросов к ЦБ одновременно) и записываются в базу до перехода к следующему шагу,
+    так что в памяти лежат курсы только одного шага, а при обрыве загруженное уже сохранено.
+    Уже загруженные даты пропускаются, если не задан overwrite.
+
+    :return: Словарь со статистикой: сколько дат загружено, пропущено, с ошибкой, сколько строк записано
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = []
+    loaded = skipped = saved = 0
+
+    async def fetch(day: date) -> List[dict]:
+        async with semaphore:
+            try:
+                rates = await rates_service.fetch_rates(day)
+            except Exception as e:
+                print(f"❌ Курсы на {day.isoformat()} не загружены: {e}")
+                failed.append(day.isoformat())
+                return []
+        return [{'rate_date': day, 'char_code': code, 'rate': rate} for code, rate in rates.items()]
+
+    chunk_from = date_from
+    while chunk_from <= date_to:
+        chunk_to = min(chunk_from + timedelta(days=chunk_days - 1), date_to)
+        stored = set() if overwrite else await get_stored_dates(chunk_from, chunk_to)
+        missing = [day for day in _days(chunk_from, chunk_to) if day not in stored]
+
+        failed_before = len(failed)
+        rows = []
+        for day_rows in await asyncio.gather(*(fetch(day) for day in missing)):
+            rows.extend(day_rows)
+        saved += await save_rates(rows)
+        loaded += len(missing) - (len(failed) - failed_before)
+        skipped += len(stored)
+        chunk_from = chunk_to + timedelta(days=1)
+
+    print(f"✅ Курсы за {date_from.isoformat()} - {date_to.isoformat()}: загружено дат {loaded}, "
+          f"пропущено {skipped}, ошибок {len(failed)}, записано строк {saved}")
+    return {
+        'loaded_dates': loaded,
+        'skipped_dates': skipped,
+        'failed_dates': sorted(failed),
+        'saved_rows': saved
+    }
+
+
+async def get_stored_rates(date_from: date, date_to: Optional[date] = None) -> Dict[str, Dict[str, float]]:
+    """
+    Курсы из базы за дату или период одним запросом (по индексу дата + валюта)
+
+    :return: Словарь {дата ISO: {код валюты: курс}}, даты без курсов в базе отсутствуют
+    """
+    date_to = date_to or date_from
+    async with async_session() as session:
+        result = await session.execute(
+            select(ExchangeRate.rate_date, ExchangeRate.char_code, ExchangeRate.rate)
+            .where(ExchangeRate.rate_date.between(date_from, date_to))
+            .order_by(ExchangeRate.rate_date, ExchangeRate.char_code)
+        )
+        rates: Dict[str, Dict[str, float]] = {}
+        for rate_date, char_code, rate in result.all():
+            rates.setdefault(rate_date.isoformat(), {})[char_code] = float(rate)
+        return rates
+
+
+async def get_rates_on_date(rates_service: ExchangeRatesService, on_date: date) -> Dict[str, float]:
+    """Курсы на дату: из базы, а если их там нет - у ЦБ с сохранением в базу"""
+    stored = await get_stored_rates(on_date)
+    if on_date.isoformat() in stored:
+        return stored[on_date.isoformat()]
+
+    rates = await rates_service.get_rates(on_date)
+    # курсы на сегодня ЦБ может еще обновить, в историю пишем только прошедшие даты
+    if on_date < date.today():
+        await save_rates([{'rate_date': on_date, 'char_code': code, 'rate': rate} for code, rate in rates.items()])
+    return rates
+
+
+async def _main():
+    import sys
+
+    date_from = date.fromisoformat(sys.argv[1])
+    date_to = date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else date.today()
+    await init_db()
+    rates_service = ExchangeRatesService()
+    try:
+        await backfill_exchange_rates(rates_service, date_from, date_to)
+    finally:
+        await rates_service.close()
+
+
+if __name__ == '__main__':
+    # python -m handlers.exchange_rates_history 2024-01-01 [2024-12-31]
+    asyncio.run(_main())
@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from dotenv import find_dotenv, load_dotenv
+from gspread.utils import rowcol_to_a1
+from sqlalchemy import delete, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from models.models import async_session, LedgerEntry, LedgerSyncState
+
+
+load_dotenv(find_dotenv())
+
+# Копия Ledger в Postgres: чтение выпадающих списков и колонок из базы вместо Sheets API
+LEDGER_MIRROR_ENABLED = os.getenv('LEDGER_MIRROR_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# Как часто (сек) дочитывать новые строки листа и полностью перечитывать лист (ручные правки старых строк)
+LEDGER_MIRROR_SYNC_INTERVAL = float(os.getenv('LEDGER_MIRROR_SYNC_INTERVAL', 60))
+LEDGER_MIRROR_FULL_SYNC_INTERVAL = float(os.getenv('LEDGER_MIRROR_FULL_SYNC_INTERVAL', 6 * 3600))
+LEDGER_MIRROR_BATCH_SIZE = int(os.getenv('LEDGER_MIRROR_BATCH_SIZE', 1000))
+
+
+class LedgerMirror:
+    """
+    Копия листа Ledger в таблице ledger_entries.
+
+    - первый раз лист загружается целиком (get_all_values), номер последней перенесенной строки
+      хранится в ledger_sync_state;
+    - дальше раз в LEDGER_MIRROR_SYNC_INTERVAL дочитываются только строки после этого номера
+      (один небольшой get), раз в LEDGER_MIRROR_FULL_SYNC_INTERVAL лист перечитывается целиком;
+    - строки и отметки, которые пишет само приложение, сразу применяются к копии;
+    - с несколькими воркерами синхронизацию ведет один: под общей блокировкой (service.shared_cache),
+      остальные видят свежую отметку synced_at в ledger_sync_state и пропускают проход;
+    - для колонок выпадающих списков создаются индексы по выражению cells ->> 'заголовок',
+      уникальные значения читаются по индексу (loose index scan), а не полным проходом по JSON.
+    """
+
+    def __init__(self, ledger):
+        """:param ledger: GoogleSheetsService листа Ledger"""
+        self.ledger = ledger
+        self.sheet_name = ledger.sheet_name
+        self._state: Optional[dict] = None  # last_row, headers, full_synced_at
+        self._sync_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._indexed_headers = set()  # заголовки, для которых индекс по выражению уже создан
+
+    @property
+    def ready(self) -> bool:
+        """Копия загружена и ей можно отвечать на чтение"""
+        return self._state is not None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                # синхронизирует один воркер, остальные дождутся блокировки и увидят свежий synced_at
+                async with self.ledger.cache.lock('ledger_mirror'):
+                    await self.sync(skip_if_fresh=True)
+            except Exception as e:
+                print(f"🔴 Синхронизация Ledger с базой: {e}")
+            await asyncio.sleep(LEDGER_MIRROR_SYNC_INTERVAL)
+
+    async def _load_state(self) -> Optional[dict]:
+        async with async_session() as session:
+            state = await session.get(LedgerSyncState, self.sheet_name)
+            if state is None:
+                return None
+            return {'last_row': state.last_row, 'headers': state.headers or [], 'full_synced_at': state.full_synced_at,
+                    'synced_at': state.synced_at}
+
+    async def sync(self, skip_if_fresh: bool = False):
+        """
+        Полная загрузка, если копии нет или она давно не сверялась, иначе - дочитывание новых строк
+
+        :param skip_if_fresh: Не синхронизировать, если копию недавно обновил другой воркер
+        """
+        async with self._sync_lock:
+            # копию мог обновить другой воркер - состояние берем из базы
+            self._state = await self._load_state() or self._state
+            state = self._state
+            if (skip_if_fresh and state is not None and state.get('synced_at') is not None
+                    and (datetime.utcnow() - state['synced_at']).total_seconds() < LEDGER_MIRROR_SYNC_INTERVAL / 2):
+                return
+            if (state is None or state['full_synced_at'] is None
+                    or (datetime.utcnow() - state['full_synced_at']).total_seconds() > LEDGER_MIRROR_FULL_SYNC_INTERVAL):
+                await self._full_load()
+            else:
+                await self._sync_new_rows()
+
+    async def _full_load(self):
+        await self.ledger.initialize()
+        all_values = await self.ledger._call('get_all_values')
+        headers = [header.strip() for header in (all_values[0] if all_values else [])]
+        entries = [
+            {'row_number': row_number, 'cells': self._cells(headers, row), 'synced_at': datetime.utcnow()}
+            for row_number, row in enumerate(all_values[1:], 2)
+        ]
+        now = datetime.utcnow()
+        async with async_session() as session:
+            # копия заменяется целиком одной транзакцией: читатели видят либо старую, либо новую
+            await session.execute(delete(LedgerEntry))
+            for start in range(0, len(entries), LEDGER_MIRROR_BATCH_SIZE):
+                await session.execute(insert(LedgerEntry).values(entries[start:start + LEDGER_MIRROR_BATCH_SIZE]))
+            await self._save_state(session, max(len(all_values), 1), headers, full_synced_at=now)
+            await session.commit()
+        self._state = {'last_row': max(len(all_values), 1), 'headers': headers, 'full_synced_at': now, 'synced_at': now}
+        print(f"✅ Ledger загружен в базу целиком: {len(entries)} строк")
+
+    async def _sync_new_rows(self):
+        last_row = self._state['last_row']
+        headers = self._state['headers']
+        last_col = rowcol_to_a1(1, max(len(headers), 1))[:-1]
+        await self.ledger.initialize()
+        rows = await self.ledger._call('get', f"A{last_row + 1}:{last_col}")
+        if not rows:
+            async with async_session() as session:
+                await self._save_state(session, last_row, headers)  # отметка synced_at для других воркеров
+                await session.commit()
+            return
+        rows = list(rows)
+        await self._upsert_rows(last_row + 1, rows, headers)
+        async with async_session() as session:
+            await self._save_state(session, last_row + len(rows), headers)
+            await session.commit()
+        self._state['last_row'] = last_row + len(rows)
+        print(f"Ledger: в базу перенесено новых строк {len(rows)}, последняя строка {self._state['last_row']}")
+
+    async def _save_state(self, session, last_row: int, headers: List[str], full_synced_at: Optional[datetime] = None):
+        values = {'sheet_name': self.sheet_name, 'last_row': last_row, 'headers': headers, 'synced_at': datetime.utcnow()}
+        if full_synced_at is not None:
+            values['full_synced_at'] = full_synced_at
+        stmt = insert(LedgerSyncState).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[LedgerSyncState.sheet_name],
+            set_={key: value for key, value in values.items() if key != 'sheet_name'}
+        )
+        await session.execute(stmt)
+
+    @staticmethod
+    def _cells(headers: List[str], row: List) -> Dict[str, object]:
+        # в копии все значения - строки, как их отдает get_all_values
+        return {header: (str(row[i]) if i < len(row) else '') for i, header in enumerate(headers) if header}
+
+    async def _upsert_rows(self, first_row: int, rows: List[List], headers: List[str]):
+        # пустые строки тоже хранятся: column_values должен отдавать пустые значения внутри колонки, как col_values
+        entries = [
+            {'row_number': first_row + i, 'cells': self._cells(headers, row), 'synced_at': datetime.utcnow()}
+            for i, row in enumerate(rows)
+        ]
+        if not entries:
+            return
+        async with async_session() as session:
+            for start in range(0, len(entries), LEDGER_MIRROR_BATCH_SIZE):
+                stmt = insert(LedgerEntry).values(entries[start:start + LEDGER_MIRROR_BATCH_SIZE])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[LedgerEntry.row_number],
+                    set_={'cells': stmt.excluded.cells, 'synced_at': stmt.excluded.synced_at}
+                )
+                await session.execute(stmt)
+            await session.commit()
+
+    async def apply_rows(self, first_row: int, rows: List[List]):
+        """Строки, записанные приложением в Ledger, сразу переносятся в копию"""
+        if not self.ready:
+            return
+        async with self._sync_lock:
+            headers = self._state['headers']
+            await self._upsert_rows(first_row, rows, headers)
+            # номер последней строки двигаем, только если между ним и нашими строками нет пропуска
+            if first_row == self._state['last_row'] + 1:
+                self._state['last_row'] = first_row + len(rows) - 1
+                async with async_session() as session:
+                    await self._save_state(session, self._state['last_row'], headers)
+                    await session.commit()
+
+    async def apply_cell(self, row_number: int, header: str, value):
+        """Отметка, поставленная приложением в строке Ledger, сразу переносится в копию"""
+        if not self.ready:
+            return
+        async with async_session() as session:
+            entry = await session.get(LedgerEntry, row_number)
+            if entry is None:
+                return  # строка еще не в копии - придет с синхронизацией
+            entry.cells = {**entry.cells, header: value}
+            await session.commit()
+
+    @staticmethod
+    def _header_expr(header: str) -> str:
+        """
+        cells ->> 'заголовок' с заголовком-литералом: индекс по выражению подходит только к константе
+        (двоеточие экранируется, иначе text() примет его за параметр)
+        """
+        return "cells ->> '{}'".format(header.replace("'", "''").replace(":", "\\:"))
+
+    async def _ensure_indexes(self, headers: List[str]):
+        """Индексы по выражению cells ->> 'заголовок' для колонок выпадающих списков (один раз на заголовок)"""
+        for header in headers:
+            if header in self._indexed_headers:
+                continue
+            name = 'ix_ledger_entries_' + hashlib.md5(header.encode()).hexdigest()[:12]
+            try:
+                async with async_session() as session:
+                    await session.execute(text(
+                        f"CREATE INDEX IF NOT EXISTS {name} ON public.ledger_entries (({self._header_expr(header)}))"
+                    ))
+                    await session.commit()
+                self._indexed_headers.add(header)
+            except Exception as e:
+                # например, индекс одновременно создает другой воркер - попробуем в следующий раз
+                print(f"🟡 Индекс копии Ledger для колонки {header} не создан: {e}")
+
+    async def distinct_values(self, headers: List[str]) -> Dict[str, List[str]]:
+        """
+        Непустые уникальные значения колонок в порядке сортировки индекса (collation базы), а не в порядке
+        строк листа: вызывающий код все равно сортирует множество значений для выпадающих списков.
+
+        Каждое следующее значение - min(cells ->> 'заголовок') больше предыдущего, это одно обращение к индексу:
+        запросов столько, сколько уникальных значений, а не строк в копии
+        """
+        await self._ensure_indexes(headers)
+        result = {}
+        async with async_session() as session:
+            for header in headers:
+                expr = self._header_expr(header)
+                rows = await session.execute(text(f"""
+                    WITH RECURSIVE v(value) AS (
+                        SELECT min({expr}) FROM public.ledger_entries WHERE {expr} > ''
+                        UNION ALL
+                        SELECT (SELECT min({expr}) FROM public.ledger_entries WHERE {expr} > v.value)
+                        FROM v WHERE v.value IS NOT NULL
+                    )
+                    SELECT value FROM v WHERE value IS NOT NULL
+                """))
+                result[header] = [value for value in rows.scalars().all()]
+        return result
+
+    async def column_values(self, headers: List[str]) -> Dict[str, List[str]]:
+        """Значения колонок по порядку строк (как col_values без заголовка)"""
+        if not headers:
+            return {}
+        async with async_session() as session:
+            rows = await session.execute(
+                select(*(LedgerEntry.cells[header].as_string() for header in headers)).order_by(LedgerEntry.row_number)
+            )
+            rows = rows.all()
+        result = {}
+        for i, header in enumerate(headers):
+            values = [row[i] if row[i] is not None else '' for row in rows]
+            # как col_values: хвостовые пустые значения отбрасываются
+            while values and values[-1] == '':
+                values.pop()
+            result[header] = values
+        return result
@@ -1,10 +1,23 @@
-from sqlalchemy import select, func
+import os
+
+from cachetools import TTLCache
+from sqlalchemy import select, event, func, inspect, true
+from sqlalchemy.orm import aliased
 from fastapi.responses import JSONResponse
 
-from datetime import datetime
+from datetime import date, datetime
+from typing import Optional
 from pydantic import BaseModel, ConfigDict, field_serializer
 
-from models.models import async_session, UserAuth, UserWallet, UserReport
+from models.models import async_session, engine, rebuild_users_reports_daily, UserAuth, UserWallet, UserReportDaily
+
+# Кэш tg_id -> id пользователя: найденные держим USER_CACHE_TTL, ненайденные - USER_CACHE_NEGATIVE_TTL
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 600))
+USER_CACHE_NEGATIVE_TTL = float(os.getenv('USER_CACHE_NEGATIVE_TTL', 30))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+
+_user_ids = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_unknown_tg_ids = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_NEGATIVE_TTL)
 
 
 class WalletSchema(BaseModel):
@@ -49,33 +62,77 @@ class DailyReportSchema(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
 
+def invalidate_user_cache(tg_id):
+    """Сбрасывает закэшированный результат get_user (регистрация, смена Telegram id)"""
+    _user_ids.pop(str(tg_id), None)
+    _unknown_tg_ids.pop(str(tg_id), None)
+
+
+@event.listens_for(UserAuth, 'after_insert')
+@event.listens_for(UserAuth, 'after_update')
+@event.listens_for(UserAuth, 'after_delete')
+def _user_changed(mapper, connection, target):
+    # и новый, и прежний Telegram id (если его поменяли)
+    history = inspect(target).attrs.id_telegram.history
+    for tg_id in [target.id_telegram, *(history.deleted or ())]:
+        if tg_id:
+            invalidate_user_cache(tg_id)
+
+
 async def get_user(tg_id):  # эту проверку вызывать еще в телеграм, а возможно дальше сделать вход по паролю. если id нет ,
     # то предлагать зарегестрироваться , выдавать форму регистрации
+    tg_id = str(tg_id)
+    if tg_id in _user_ids:
+        return _user_ids[tg_id]
+    if tg_id in _unknown_tg_ids:
+        return None
+
     async with async_session() as session:
-        user = await session.scalar(
-            select(UserAuth).where(UserAuth.id_telegram == str(tg_id)))
-        user_id = user.id
-        user_fullname = user.full_name
-        if user:
-            return user_id
-        else:
-            return print("форма регистрации, добавить нового юзера")
+        user_id = await session.scalar(
+            select(UserAuth.id).where(UserAuth.id_telegram == tg_id))
+
+    if user_id is not None:
+        _user_ids[tg_id] = user_id
+        return user_id
+    _unknown_tg_ids[tg_id] = True
+    print("форма регистрации, добавить нового юзера")
+    return None
+
+
+def wallet_latest_query(user_id):
+    """
+    Последний снимок каждого токена пользователя по индексу (user_id, token, created_at DESC) без просмотра истории.
+
+    В Postgres нет skip scan, поэтому DISTINCT ON читает все снимки пользователя. Здесь токены перебираются
+    рекурсивно (следующий - min(token) больше предыдущего), и для каждого берется одна строка
+    ORDER BY created_at DESC LIMIT 1 (LATERAL): на токен - два обращения к индексу при любой глубине истории
+    """
+    tokens = (select(func.min(UserWallet.token).label('token'))
+              .where(UserWallet.user_id == user_id)
+              .cte('wallet_tokens', recursive=True))
+    following = aliased(UserWallet)
+    next_token = (select(func.min(following.token))
+                  .where(following.user_id == user_id)
+                  .where(following.token > tokens.c.token)
+                  .scalar_subquery())
+    tokens = tokens.union_all(select(next_token).where(tokens.c.token.isnot(None)))
+
+    latest = (select(UserWallet)
+              .where(UserWallet.user_id == user_id)
+              .where(UserWallet.token == tokens.c.token)
+              .order_by(UserWallet.created_at.desc())
+              .limit(1)
+              .lateral('latest_wallet'))
+    latest_wallet = aliased(UserWallet, latest)
+    return (select(latest_wallet)
+            .select_from(tokens)
+            .join(latest, true())
+            .order_by(latest_wallet.token))
 
 
 async def get_wallet_user(user_id):  # получение портфеля пользователя
     async with async_session() as session:
-        subq = (select(UserWallet.token, func.max(UserWallet.created_at).label("max_created_at"))
-                .where(UserWallet.user_id == user_id)
-                .group_by(UserWallet.token)
-                .subquery())
-
-        wallet_out = await session.execute(
-            select(UserWallet)
-            .join(subq, (UserWallet.token == subq.c.token) &
-                  (UserWallet.created_at == subq.c.max_created_at))
-            .where(UserWallet.user_id == user_id)
-            .order_by(UserWallet.token)
-        )
+        wallet_out = await session.execute(wallet_latest_query(user_id))
 
         wallet = wallet_out.scalars().all()
 
@@ -89,39 +146,45 @@ async def get_wallet_user(user_id):  # получение портфеля по
         )
 
 
-async def get_report_user(user_id):  # получение отчета пользователя
+async def rebuild_report_rollups():
+    """Пересчитывает дневные итоги с нуля (если триггер на users_reports отключали или итоги правили вручную)"""
+    async with engine.begin() as conn:
+        await conn.run_sync(rebuild_users_reports_daily)
+
+
+async def get_report_user(user_id, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                          limit: Optional[int] = None, offset: int = 0):  # получение отчета пользователя
+    """
+    Итоги отчетов пользователя по дням из users_reports_daily (их ведет триггер на users_reports)
+
+    :param date_from: Первый день (включительно)
+    :param date_to: Последний день (включительно)
+    :param limit: Сколько дней вернуть (по возрастанию даты)
+    :param offset: Сколько дней пропустить
+    """
     async with async_session() as session:
-        result = await session.execute(
-            select(UserReport)
-            .where(UserReport.user_id == user_id)
-            .order_by(UserReport.updated_at))
-
-        user_report = result.scalars().all()
-        if user_report:
-            date_full_name = user_report[0].full_name
-            # Создаем словарь для группировки по дням
-            daily_results = {}
-            for item in user_report:
-                # Обращаемся к атрибутам объекта через точку
-                date_str = item.updated_at.isoformat().split("T")[0]
-                date_obj = datetime.strptime(date_str, "%Y-%m-%d").date()
-                # Добавляем результат в соответствующую дату
-                if date_obj in daily_results:
-                    daily_results[date_obj] += item.result
-                else:
-                    daily_results[date_obj] = item.result
-
-            # Формируем итоговый список
-            result_list = [{"date": str(date), "total_result": total} for date, total in daily_results.items()]
-            # Сортируем по дате
-            result_list.sort(key=lambda x: x["date"])
-            #result_list += [date_full_name]
-
-            # Сериализация через Pydantic
-            serialized = [DailyReportSchema.model_validate(r).model_dump() for r in result_list]
-
-            # Возвращаем с явным указанием кодировки
-            return JSONResponse(
-                content=serialized,
-                media_type="application/json; charset=utf-8"
-            )
\ No newline at end of file
+        query = (select(UserReportDaily.day, UserReportDaily.total_result)
+                 .where(UserReportDaily.user_id == user_id)
+                 .order_by(UserReportDaily.day))
+        if date_from is not None:
+            query = query.where(UserReportDaily.day >= date_from)
+        if date_to is not None:
+            query = query.where(UserReportDaily.day <= date_to)
+        if offset:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+
+        result_list = [
+            {"date": day.isoformat(), "total_result": total}
+            for day, total in (await session.execute(query)).all()
+        ]
+
+        # Сериализация через Pydantic
+        serialized = [DailyReportSchema.model_validate(r).model_dump() for r in result_list]
+
+        # Возвращаем с явным указанием кодировки
+        return JSONResponse(
+            content=serialized,
+            media_type="application/json; charset=utf-8"
+        )
@@ -0,0 +1,368 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from cachetools import TTLCache
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from models.models import async_session, IdempotencyKey, SheetJob, WORKER_ID
+from service.request_stats import RequestTrace, start_request_stats
+
+
+load_dotenv(find_dotenv())
+
+SHEET_JOBS_MAX_ATTEMPTS = int(os.getenv('SHEET_JOBS_MAX_ATTEMPTS', 5))
+SHEET_JOBS_BATCH = int(os.getenv('SHEET_JOBS_BATCH', 50))
+# Как часто (сек) проверять очередь без новых заданий (повторы по расписанию, задания после рестарта)
+SHEET_JOBS_POLL_INTERVAL = float(os.getenv('SHEET_JOBS_POLL_INTERVAL', 5))
+# Как часто (сек) воркер отмечает, что еще выполняет взятые задания, и через сколько без отметок
+# задание считается брошенным (воркер остановлен или завис) и возвращается в очередь
+SHEET_JOBS_HEARTBEAT_INTERVAL = float(os.getenv('SHEET_JOBS_HEARTBEAT_INTERVAL', 10))
+SHEET_JOBS_STALE_AFTER = float(os.getenv('SHEET_JOBS_STALE_AFTER', 60))
+# Как часто (сек) wait проверяет статус в базе, пока задание выполняет другой воркер
+SHEET_JOBS_WAIT_POLL_INTERVAL = float(os.getenv('SHEET_JOBS_WAIT_POLL_INTERVAL', 0.5))
+# Сколько (сек) повтор запроса с тем же Idempotency-Key возвращает исходный результат
+IDEMPOTENCY_KEY_TTL = float(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 3600))
+# Сколько ключей и результатов держать в памяти (остальные находятся в базе)
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000))
+
+# handler(payload, progress, save_progress) -> результат задания (JSON)
+JobHandler = Callable[[dict, dict, Callable[[], Awaitable[None]]], Awaitable[dict]]
+
+
+class IdempotencyKeyMismatch(ValueError):
+    """Ключ идемпотентности уже использован с другим телом запроса"""
+
+
+def _payload_hash(payload: dict) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+class SheetJobQueue:
+    """
+    Очередь заданий на запись в Google Sheets в таблице sheet_jobs.
+
+    - enqueue сохраняет задание в базе и сразу возвращает его id;
+    - фоновый обработчик берет подошедшие задания пачкой и запускает их в порядке поступления
+      (строки Ledger получают номера в этом же порядке через RowWriteBatcher);
+    - задания берутся одним UPDATE ... FOR UPDATE SKIP LOCKED ... RETURNING, поэтому с несколькими
+      воркерами каждое задание выполняет один воркер; он отмечается в heartbeat_at, а задания без отметок
+      дольше SHEET_JOBS_STALE_AFTER возвращаются в очередь;
+    - handler отмечает выполненные шаги в progress и сохраняет их через save_progress,
+      при повторе после ошибки или рестарта эти шаги пропускаются;
+    - ошибки повторяются с растущей задержкой, после max_attempts задание помечается failed;
+    - задание с ключом идемпотентности создается один раз: повтор с тем же ключом получает
+      id исходного задания (ключи - в TTLCache и таблице idempotency_keys, результаты - в TTLCache);
+      если исходное задание завершилось failed, повтор создает новое задание и ключ переходит к нему,
+      повтор с другим телом запроса - IdempotencyKeyMismatch.
+    """
+
+    def __init__(self, kind: str, handler: JobHandler, max_attempts: int = SHEET_JOBS_MAX_ATTEMPTS):
+        self.kind = kind
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self._waiters: Dict[int, List[asyncio.Future]] = {}
+        self._job_by_key = TTLCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_KEY_TTL)
+        self._finished = TTLCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_KEY_TTL)  # job_id -> итоговый статус
+        self._traces = TTLCache(maxsize=1000, ttl=60)  # job_id -> внешние обращения последней попытки
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def enqueue(self, payload: dict, idempotency_key: Optional[str] = None) -> Tuple[int, bool]:
+        """
+        Сохраняет задание
+
+        :param idempotency_key: Ключ повтора запроса; если задание с этим ключом уже есть и не завершилось
+            ошибкой, новое не создается
+        :return: id задания и признак, что задание создано этим вызовом
+        :raises IdempotencyKeyMismatch: ключ уже использован с другим payload
+        """
+        payload_hash = _payload_hash(payload)
+        if idempotency_key is not None and idempotency_key in self._job_by_key:
+            job_id, bound_hash = self._job_by_key[idempotency_key]
+            if bound_hash != payload_hash:
+                raise IdempotencyKeyMismatch(f"Ключ {idempotency_key} уже использован с другим телом запроса")
+            # задание с ошибкой не отдаем повтору: ключ перейдет к новому заданию (решает база)
+            if (self._finished.get(job_id) or {}).get('status') != 'failed':
+                return job_id, False
+
+        async with async_session() as session:
+            job = SheetJob(kind=self.kind, payload=payload, progress={})
+            session.add(job)
+            await session.flush()
+            job_id = job.id
+
+            if idempotency_key is not None:
+                # ключ и задание фиксируются одной транзакцией; просроченный ключ переходит к новому заданию
+                now = datetime.utcnow()
+                stmt = insert(IdempotencyKey).values(
+                    scope=self.kind, key=idempotency_key, job_id=job_id, created_at=now, payload_hash=payload_hash
+                )
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[IdempotencyKey.scope, IdempotencyKey.key],
+                    set_={'job_id': job_id, 'created_at': now, 'payload_hash': payload_hash},
+                    where=IdempotencyKey.created_at < now - timedelta(seconds=IDEMPOTENCY_KEY_TTL)
+                ).returning(IdempotencyKey.job_id)
+                claimed = (await session.execute(stmt)).scalar_one_or_none()
+                if claimed is None:
+                    # ON CONFLICT заблокировал строку ключа до конца транзакции, параллельный повтор ждет нас
+                    bound = (await session.execute(
+                        select(IdempotencyKey.job_id, IdempotencyKey.payload_hash, SheetJob.status)
+                        .join(SheetJob, SheetJob.id == IdempotencyKey.job_id)
+                        .where(IdempotencyKey.scope == self.kind)
+                        .where(IdempotencyKey.key == idempotency_key)
+                    )).one()
+                    # у ключей, созданных до появления payload_hash, тело не сверяем
+                    if bound.payload_hash is not None and bound.payload_hash != payload_hash:
+                        await session.rollback()
+                        raise IdempotencyKeyMismatch(f"Ключ {idempotency_key} уже использован с другим телом запроса")
+                    if bound.status != 'failed':
+                        await session.rollback()
+                        self._job_by_key[idempotency_key] = (bound.job_id, payload_hash)
+                        print(f"Повтор запроса {self.kind} с ключом {idempotency_key}: задание {bound.job_id}")
+                        return bound.job_id, False
+                    await session.execute(
+                        update(IdempotencyKey)
+                        .where(IdempotencyKey.scope == self.kind)
+                        .where(IdempotencyKey.key == idempotency_key)
+                        .values(job_id=job_id, created_at=now, payload_hash=payload_hash)
+                    )
+                    print(f"Повтор запроса {self.kind} с ключом {idempotency_key}: задание {bound.job_id} "
+                          f"завершилось ошибкой, создано задание {job_id}")
+
+            await session.commit()
+
+        if idempotency_key is not None:
+            self._job_by_key[idempotency_key] = (job_id, payload_hash)
+        self._wake()
+        return job_id, True
+
+    async def wait(self, job_id: int, timeout: float) -> Optional[dict]:
+        """
+        Ждет завершения задания (done или failed), None - если не завершилось за timeout.
+        Задание этого воркера будит ожидание через future, базу при этом не опрашиваем; статус в базе
+        проверяется каждые SHEET_JOBS_WAIT_POLL_INTERVAL, только пока задание выполняет другой воркер
+        """
+        if job_id in self._finished:
+            return self._finished[job_id]
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(job_id, []).append(future)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                # задание могло завершиться до того, как мы начали ждать, или на другом воркере
+                async with async_session() as session:
+                    job = await session.get(SheetJob, job_id)
+                if job is not None and job.status in ('done', 'failed'):
+                    return self._status(job)
+                if job is not None and job.status == 'running' and job.worker_id != WORKER_ID:
+                    recheck = SHEET_JOBS_WAIT_POLL_INTERVAL
+                elif job is not None and job.status == 'running':
+                    # выполняем мы; перепроверяем, только если задание успеют признать брошенным
+                    recheck = SHEET_JOBS_STALE_AFTER
+                else:
+                    # в очереди: его может взять другой воркер, который опрашивает очередь с этим интервалом
+                    recheck = SHEET_JOBS_POLL_INTERVAL
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), timeout=min(remaining, recheck))
+                except asyncio.TimeoutError:
+                    continue
+        finally:
+            waiters = self._waiters.get(job_id, [])
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._waiters.pop(job_id, None)
+
+    async def get_status(self, job_id: int) -> Optional[dict]:
+        if job_id in self._finished:
+            return self._finished[job_id]
+        async with async_session() as session:
+            job = await session.get(SheetJob, job_id)
+            return self._status(job) if job is not None else None
+
+    @staticmethod
+    def _status(job: SheetJob) -> dict:
+        return {
+            'job_id': job.id,
+            'kind': job.kind,
+            'status': job.status,
+            'progress': job.progress or {},
+            'result': job.result,
+            'attempts': job.attempts,
+            'last_error': job.last_error,
+            'created_at': job.created_at.isoformat() if job.created_at else None,
+            'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        }
+
+    def start(self):
+        """Запускает фоновый обработчик очереди"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        stale_checked_at = None
+        while True:
+            self._wakeup.clear()
+            try:
+                if stale_checked_at is None or time.monotonic() - stale_checked_at > SHEET_JOBS_HEARTBEAT_INTERVAL:
+                    await self.reset_stale()
+                    stale_checked_at = time.monotonic()
+                processed = await self.process_once()
+            except Exception as e:
+                print(f"🔴 Очередь заданий {self.kind}: {e}")
+                processed = 0
+            if processed:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=SHEET_JOBS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def reset_stale(self):
+        """
+        Задания, прерванные остановкой или зависанием воркера (нет отметок дольше SHEET_JOBS_STALE_AFTER),
+        возвращаем в очередь - они выполнятся заново, сохраненные шаги пропустятся
+        """
+        stale_before = datetime.utcnow() - timedelta(seconds=SHEET_JOBS_STALE_AFTER)
+        await self._update_where(
+            and_(
+                SheetJob.kind == self.kind,
+                SheetJob.status == 'running',
+                or_(SheetJob.heartbeat_at.is_(None), SheetJob.heartbeat_at < stale_before)
+            ),
+            status='pending'
+        )
+
+    async def process_once(self) -> int:
+        """Выполняет подошедшие задания, возвращает их количество"""
+        jobs = await self._claim()
+        if not jobs:
+            return 0
+
+        heartbeat = asyncio.create_task(self._heartbeat([job.id for job in jobs]))
+        try:
+            # задания стартуют по порядку id и дальше идут параллельно, записи в таблицу склеиваются в общие запросы
+            await asyncio.gather(*(self._apply(job) for job in jobs))
+        finally:
+            heartbeat.cancel()
+        return len(jobs)
+
+    async def _claim(self) -> List[SheetJob]:
+        """Берет подошедшие задания одним запросом: занятые другим воркером строки пропускаются (SKIP LOCKED)"""
+        now = datetime.utcnow()
+        due = (
+            select(SheetJob.id)
+            .where(SheetJob.kind == self.kind)
+            .where(SheetJob.status == 'pending')
+            .where(SheetJob.next_attempt_at <= now)
+            .order_by(SheetJob.id)
+            .limit(SHEET_JOBS_BATCH)
+            .with_for_update(skip_locked=True)
+        )
+        async with async_session() as session:
+            result = await session.execute(
+                update(SheetJob)
+                .where(SheetJob.id.in_(due.scalar_subquery()))
+                .values(status='running', worker_id=WORKER_ID, heartbeat_at=now)
+                .returning(SheetJob)
+                .execution_options(synchronize_session=False)
+            )
+            jobs = list(result.scalars().all())
+            await session.commit()
+        # RETURNING не сохраняет порядок подзапроса
+        return sorted(jobs, key=lambda job: job.id)
+
+    async def _heartbeat(self, job_ids: List[int]):
+        """Отмечает, что воркер еще выполняет взятые задания"""
+        while True:
+            await asyncio.sleep(SHEET_JOBS_HEARTBEAT_INTERVAL)
+            try:
+                await self._update_where(
+                    and_(SheetJob.id.in_(job_ids), SheetJob.status == 'running', SheetJob.worker_id == WORKER_ID),
+                    heartbeat_at=datetime.utcnow()
+                )
+            except Exception as e:
+                print(f"🟡 Очередь заданий {self.kind}: не удалось отметить выполнение: {e}")
+
+    def job_trace(self, job_id: int) -> Optional[RequestTrace]:
+        """Внешние обращения последней попытки задания (для Server-Timing запроса, который его ждал)"""
+        return self._traces.pop(job_id, None)
+
+    async def _apply(self, job: SheetJob):
+        # у каждого задания своя задача asyncio, поэтому и своя трасса обращений
+        self._traces[job.id] = start_request_stats()
+        progress = dict(job.progress or {})
+
+        async def save_progress():
+            await self._update(job.id, progress=dict(progress))
+
+        try:
+            result = await self.handler(job.payload, progress, save_progress)
+        except Exception as e:
+            attempts = job.attempts + 1
+            failed = attempts >= self.max_attempts
+            print(f"{'🔴' if failed else '🟡'} Задание {job.id} ({self.kind}) не выполнено (попытка {attempts}): {e}")
+            await self._update(
+                job.id,
+                status='failed' if failed else 'pending',
+                attempts=attempts,
+                progress=progress,
+                last_error=str(e),
+                next_attempt_at=datetime.utcnow() + timedelta(seconds=min(2 ** attempts, 300)),
+                finished_at=datetime.utcnow() if failed else None
+            )
+            if failed:
+                await self._finish(job.id)
+            return
+
+        await self._update(
+            job.id,
+            status='done',
+            attempts=job.attempts + 1,
+            progress=progress,
+            result=result,
+            last_error=None,
+            finished_at=datetime.utcnow()
+        )
+        await self._finish(job.id)
+
+    async def _finish(self, job_id: int):
+        """Запоминает итоговый статус (для повторов по ключу) и будит ждущих"""
+        status = await self.get_status(job_id)
+        self._finished[job_id] = status
+        for future in self._waiters.get(job_id, []):
+            if not future.done():
+                future.set_result(status)
+
+    async def _update(self, job_id: int, **values):
+        # задание, которое вернули в очередь как брошенное, уже может выполнять другой воркер
+        await self._update_where(and_(SheetJob.id == job_id, SheetJob.worker_id == WORKER_ID), **values)
+
+    async def _update_where(self, condition, **values):
+        async with async_session() as session:
+            await session.execute(update(SheetJob).where(condition).values(**values))
+            await session.commit()
@@ -0,0 +1,318 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import and_, exists, func, or_, select, update
+from sqlalchemy.orm import aliased
+
+from models.models import async_session, TelegramOutboxMessage, WORKER_ID
+from service.google_table_authorization import TokenBucket
+from service.request_stats import span
+from service.sheets_transaction import SheetsTransaction
+
+
+load_dotenv(find_dotenv())
+
+# Лимиты Telegram: не больше ~20 сообщений в минуту в одну группу и ~30 сообщений в секунду на бота
+TELEGRAM_CHAT_MESSAGES_PER_MINUTE = float(os.getenv('TELEGRAM_CHAT_MESSAGES_PER_MINUTE', 20))
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_MESSAGES_PER_SECOND = float(os.getenv('TELEGRAM_MESSAGES_PER_SECOND', 30))
+TELEGRAM_OUTBOX_MAX_ATTEMPTS = int(os.getenv('TELEGRAM_OUTBOX_MAX_ATTEMPTS', 5))
+TELEGRAM_OUTBOX_BATCH = int(os.getenv('TELEGRAM_OUTBOX_BATCH', 100))
+# Как часто (сек) проверять очередь, если новых сообщений не ставили (повторы по расписанию, сообщения после рестарта)
+TELEGRAM_OUTBOX_POLL_INTERVAL = float(os.getenv('TELEGRAM_OUTBOX_POLL_INTERVAL', 5))
+# Как часто (сек) воркер отмечает, что еще отправляет взятые сообщения, и через сколько без отметок
+# сообщения считаются брошенными и возвращаются в очередь
+TELEGRAM_OUTBOX_HEARTBEAT_INTERVAL = float(os.getenv('TELEGRAM_OUTBOX_HEARTBEAT_INTERVAL', 10))
+TELEGRAM_OUTBOX_STALE_AFTER = float(os.getenv('TELEGRAM_OUTBOX_STALE_AFTER', 60))
+
+
+class TelegramOutbox:
+    """
+    Исходящие сообщения в Telegram через таблицу telegram_outbox.
+
+    - enqueue сохраняет сообщение в базе и сразу возвращается, отправляет фоновый обработчик;
+    - сообщения в один чат уходят по порядку и не чаще лимита Telegram для группы;
+    - с несколькими воркерами сообщения берутся одним UPDATE ... FOR UPDATE SKIP LOCKED ... RETURNING,
+      чат, который отправляет один воркер, остальные не берут; брошенные сообщения (без отметки
+      heartbeat_at дольше TELEGRAM_OUTBOX_STALE_AFTER) возвращаются в очередь;
+    - на TelegramRetryAfter отправка в чат откладывается на указанное Telegram время (попытка не расходуется),
+      на прочие ошибки - повтор с растущей задержкой, после TELEGRAM_OUTBOX_MAX_ATTEMPTS сообщение помечается failed;
+    - отметки "✓ в чат, web" по всем отправленным сообщениям пишутся в Ledger одним запросом.
+    """
+
+    def __init__(self, bot: Bot, ledger, chat_messages_per_minute: float = TELEGRAM_CHAT_MESSAGES_PER_MINUTE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, messages_per_second: float = TELEGRAM_MESSAGES_PER_SECOND,
+                 max_attempts: int = TELEGRAM_OUTBOX_MAX_ATTEMPTS):
+        """
+        :param bot: Бот, от имени которого отправляются сообщения
+        :param ledger: GoogleSheetsService листа Ledger для отметок об отправке
+        """
+        self.bot = bot
+        self.ledger = ledger
+        self.chat_rate = chat_messages_per_minute / 60
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self._bot_bucket = TokenBucket(messages_per_second, messages_per_second)
+        self._chat_buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def enqueue(self, chat_id, text: str, ledger_row: Optional[int] = None) -> int:
+        """Ставит сообщение в очередь, возвращает его id"""
+        async with async_session() as session:
+            message = TelegramOutboxMessage(chat_id=str(chat_id), text=text, ledger_row=ledger_row)
+            session.add(message)
+            await session.commit()
+            message_id = message.id
+        self._wake()
+        return message_id
+
+    async def get_status(self, message_id: int) -> Optional[dict]:
+        async with async_session() as session:
+            message = await session.get(TelegramOutboxMessage, message_id)
+            if message is None:
+                return None
+            return {
+                'id': message.id,
+                'status': message.status,
+                'attempts': message.attempts,
+                'last_error': message.last_error,
+                'sent_at': message.sent_at.isoformat() if message.sent_at else None,
+            }
+
+    def start(self):
+        """Запускает фоновый обработчик очереди"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        stale_checked_at = None
+        while True:
+            self._wakeup.clear()
+            try:
+                if stale_checked_at is None or time.monotonic() - stale_checked_at > TELEGRAM_OUTBOX_HEARTBEAT_INTERVAL:
+                    await self.reset_stale()
+                    stale_checked_at = time.monotonic()
+                processed = await self.process_once()
+            except Exception as e:
+                print(f"🔴 Очередь Telegram: {e}")
+                processed = 0
+            if processed:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=TELEGRAM_OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_once(self) -> int:
+        """Отправляет подошедшие сообщения и ставит отметки в Ledger, возвращает сколько сообщений обработано"""
+        messages = await self._claim_messages()
+        by_chat: Dict[str, List[TelegramOutboxMessage]] = {}
+        for message in messages:
+            by_chat.setdefault(message.chat_id, []).append(message)
+        message_ids = [message.id for message in messages]
+        heartbeat = asyncio.create_task(self._heartbeat(message_ids)) if messages else None
+        try:
+            sent = await asyncio.gather(*(self._send_chat(chat_messages) for chat_messages in by_chat.values()))
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+            if messages:
+                # неотправленные (после ошибки или паузы чата) - обратно в очередь
+                await self._release(message_ids)
+        await self._flush_marks()
+        return sum(sent)
+
+    async def _claim_messages(self) -> List[TelegramOutboxMessage]:
+        """
+        Берет подошедшие сообщения одним запросом. Занятые строки пропускаются (SKIP LOCKED), а чаты,
+        которые сейчас отправляет другой воркер, не берутся, чтобы не нарушить порядок сообщений в чате.
+        Взятие сообщений идет под транзакционной advisory-блокировкой: иначе два воркера могли бы
+        одновременно взять разные сообщения одного чата
+        """
+        now = datetime.utcnow()
+        busy = aliased(TelegramOutboxMessage)
+        due = (
+            select(TelegramOutboxMessage.id)
+            .where(TelegramOutboxMessage.status == 'pending')
+            .where(TelegramOutboxMessage.next_attempt_at <= now)
+            .where(~exists().where(busy.chat_id == TelegramOutboxMessage.chat_id, busy.status == 'sending'))
+            .order_by(TelegramOutboxMessage.id)
+            .limit(TELEGRAM_OUTBOX_BATCH)
+            .with_for_update(skip_locked=True, of=TelegramOutboxMessage)
+        )
+        async with async_session() as session:
+            await session.execute(select(func.pg_advisory_xact_lock(func.hashtext('telegram_outbox:claim'))))
+            result = await session.execute(
+                update(TelegramOutboxMessage)
+                .where(TelegramOutboxMessage.id.in_(due.scalar_subquery()))
+                .values(status='sending', worker_id=WORKER_ID, heartbeat_at=now)
+                .returning(TelegramOutboxMessage)
+                .execution_options(synchronize_session=False)
+            )
+            messages = list(result.scalars().all())
+            await session.commit()
+        # RETURNING не сохраняет порядок подзапроса
+        return sorted(messages, key=lambda message: message.id)
+
+    async def _heartbeat(self, message_ids: List[int]):
+        """Отмечает, что воркер еще отправляет взятые сообщения"""
+        while True:
+            await asyncio.sleep(TELEGRAM_OUTBOX_HEARTBEAT_INTERVAL)
+            try:
+                async with async_session() as session:
+                    await session.execute(
+                        update(TelegramOutboxMessage)
+                        .where(TelegramOutboxMessage.id.in_(message_ids))
+                        .where(TelegramOutboxMessage.status == 'sending')
+                        .where(TelegramOutboxMessage.worker_id == WORKER_ID)
+                        .values(heartbeat_at=datetime.utcnow())
+                    )
+                    await session.commit()
+            except Exception as e:
+                print(f"🟡 Очередь Telegram: не удалось отметить отправку: {e}")
+
+    async def _release(self, message_ids: List[int]):
+        """Возвращает в очередь взятые этим воркером, но не отправленные сообщения"""
+        async with async_session() as session:
+            await session.execute(
+                update(TelegramOutboxMessage)
+                .where(TelegramOutboxMessage.id.in_(message_ids))
+                .where(TelegramOutboxMessage.status == 'sending')
+                .where(TelegramOutboxMessage.worker_id == WORKER_ID)
+                .values(status='pending')
+            )
+            await session.commit()
+
+    async def reset_stale(self):
+        """Сообщения воркера, который перестал отмечаться (остановлен или завис), возвращаем в очередь"""
+        stale_before = datetime.utcnow() - timedelta(seconds=TELEGRAM_OUTBOX_STALE_AFTER)
+        async with async_session() as session:
+            await session.execute(
+                update(TelegramOutboxMessage)
+                .where(TelegramOutboxMessage.status == 'sending')
+                .where(or_(TelegramOutboxMessage.heartbeat_at.is_(None), TelegramOutboxMessage.heartbeat_at < stale_before))
+                .values(status='pending')
+            )
+            await session.commit()
+
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            while len(self._chat_buckets) > 1000:
+                self._chat_buckets.popitem(last=False)
+        return bucket
+
+    async def _wait_slot(self, chat_id: str):
+        for bucket in (self._chat_bucket(chat_id), self._bot_bucket):
+            while (delay := bucket.wait_time()) > 0:
+                await asyncio.sleep(delay)
+            bucket.take()
+
+    async def _send_chat(self, messages: List[TelegramOutboxMessage]) -> int:
+        """Отправка сообщений одного чата по порядку; на первой ошибке остальные ждут следующего прохода"""
+        sent = 0
+        for message in messages:
+            await self._wait_slot(message.chat_id)
+            try:
+                with span('telegram', 'send_message'):
+                    await self.bot.send_message(chat_id=message.chat_id, text=message.text)
+            except TelegramRetryAfter as e:
+                print(f"🟡 Telegram просит подождать {e.retry_after} сек (чат {message.chat_id})")
+                # это и остальные сообщения этого чата отправятся после паузы, иначе нарушится порядок
+                await self._postpone_chat(message.chat_id, e.retry_after)
+                return sent
+            except Exception as e:
+                attempts = message.attempts + 1
+                failed = attempts >= self.max_attempts
+                print(f"{'🔴' if failed else '🟡'} Сообщение {message.id} в Telegram не отправлено "
+                      f"(попытка {attempts}): {e}")
+                await self._update(message.id, attempts=attempts, last_error=str(e),
+                                   status='failed' if failed else 'pending')
+                if not failed:
+                    await self._postpone_chat(message.chat_id, min(2 ** attempts, 300))
+                    return sent
+                continue
+
+            await self._update(
+                message.id,
+                attempts=message.attempts + 1,
+                status='sent' if message.ledger_row else 'done',
+                sent_at=datetime.utcnow(),
+                last_error=None
+            )
+            sent += 1
+        return sent
+
+    async def _postpone_chat(self, chat_id: str, seconds: float):
+        # взятые этим воркером сообщения чата тоже откладываются и возвращаются в очередь
+        async with async_session() as session:
+            await session.execute(
+                update(TelegramOutboxMessage)
+                .where(TelegramOutboxMessage.chat_id == chat_id)
+                .where(or_(
+                    TelegramOutboxMessage.status == 'pending',
+                    and_(TelegramOutboxMessage.status == 'sending', TelegramOutboxMessage.worker_id == WORKER_ID)
+                ))
+                .values(status='pending', next_attempt_at=datetime.utcnow() + timedelta(seconds=seconds))
+            )
+            await session.commit()
+
+    async def _update(self, message_id: int, **values):
+        # сообщение, которое вернули в очередь как брошенное, уже может отправлять другой воркер
+        async with async_session() as session:
+            await session.execute(
+                update(TelegramOutboxMessage)
+                .where(TelegramOutboxMessage.id == message_id)
+                .where(TelegramOutboxMessage.worker_id == WORKER_ID)
+                .values(**values)
+            )
+            await session.commit()
+
+    async def _flush_marks(self):
+        """Отметки "✓ в чат, web" по всем отправленным сообщениям - одной записью в Ledger"""
+        async with async_session() as session:
+            result = await session.execute(
+                select(TelegramOutboxMessage.id, TelegramOutboxMessage.ledger_row)
+                .where(TelegramOutboxMessage.status == 'sent')
+            )
+            pending_marks = result.all()
+        if not pending_marks:
+            return
+
+        await self.ledger.initialize()
+        sheets_tx = SheetsTransaction()
+        for _, ledger_row in pending_marks:
+            await self.ledger.mark_sending_to_chat(ledger_row, sheets_tx)
+        await sheets_tx.commit(self.ledger.spreadsheet)
+
+        async with async_session() as session:
+            await session.execute(
+                update(TelegramOutboxMessage)
+                .where(TelegramOutboxMessage.id.in_([message_id for message_id, _ in pending_marks]))
+                .values(status='done')
+            )
+            await session.commit()
+        print(f"✅ Отметки об отправке в чат записаны одним запросом: {len(pending_marks)}")
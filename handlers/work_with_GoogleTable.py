@@ -6,7 +6,13 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
-from service.google_table_authorization import GoogleSheetsManager
+from service.google_table_authorization import GoogleSheetsManager, shared_sheets_manager
+from service.snapshot_cache import SnapshotCache
+from service.shared_cache import LocalCache, shared_cache
+from service.request_stats import sheets_call
+from service.write_batcher import RowWriteBatcher
+from service.sheets_transaction import SheetsTransaction
+from handlers.ledger_mirror import LedgerMirror, LEDGER_MIRROR_ENABLED
 from gspread.utils import a1_to_rowcol, rowcol_to_a1
 import gspread
 import asyncio
@@ -15,6 +21,17 @@ from pydantic import BaseModel, field_validator
 from typing import Dict
 
 
+# Время жизни снимка Ledger для всплывающих списков (сек) и окно, в котором отдаем устаревший снимок,
+# обновляя его в фоне
+LEDGER_CACHE_TTL = float(os.getenv('LEDGER_CACHE_TTL', 60))
+LEDGER_CACHE_STALE_TTL = float(os.getenv('LEDGER_CACHE_STALE_TTL', 600))
+# Время жизни заголовков Ledger в общем кэше (сек): заголовки меняются только вручную
+LEDGER_HEADERS_TTL = float(os.getenv('LEDGER_HEADERS_TTL', 3600))
+# Окно (сек), в течение которого строки для Ledger копятся и пишутся одним запросом
+LEDGER_WRITE_WINDOW = float(os.getenv('LEDGER_WRITE_WINDOW', 0.05))
+LEDGER_WRITE_MAX_BATCH = int(os.getenv('LEDGER_WRITE_MAX_BATCH', 50))
+
+
 class SheetRowData(BaseModel):
     # Принимаем и строки и числа
     data: Dict[str, Union[str, int, float]]
@@ -42,28 +59,63 @@ class SheetRowData(BaseModel):
 
 
 class GoogleSheetsService:
-    def __init__(self):
-        self.manager = GoogleSheetsManager()
+    def __init__(self, manager: Optional[GoogleSheetsManager] = None, cache: Optional[LocalCache] = None):
+        self.manager = manager or shared_sheets_manager
+        self.cache = cache or shared_cache  # общий для воркеров кэш снимков
         self.sheet_name = 'Ledger'
         self.spreadsheet = None
         self.worksheet = None
         self._headers = []  # Храним заголовки колонок
+        self._next_row: Optional[int] = None  # Курсор следующей пустой строки Ledger
+        self._append_lock = asyncio.Lock()
+        self._write_batcher = RowWriteBatcher(
+            self._append_rows,
+            window=LEDGER_WRITE_WINDOW,
+            max_batch=LEDGER_WRITE_MAX_BATCH
+        )
+        # Копия Ledger в Postgres, из нее читаются колонки, когда она загружена
+        self.mirror = LedgerMirror(self) if LEDGER_MIRROR_ENABLED else None
+        # Снимок колонок Ledger для /api/read_GoogleTable/ и /api/table-structure
+        self._columns_cache = SnapshotCache(
+            self._load_all_columns_to_dict,
+            ttl=LEDGER_CACHE_TTL,
+            stale_ttl=LEDGER_CACHE_STALE_TTL,
+            shared=self.cache,
+            key='ledger:columns'
+        )
+        self._headers_cache = SnapshotCache(
+            self._load_headers,
+            ttl=LEDGER_HEADERS_TTL,
+            stale_ttl=0,
+            shared=self.cache,
+            key='ledger:headers'
+        )
 
     async def initialize(self):
         """Инициализация подключения к таблице"""
         if not self.spreadsheet:
             self.spreadsheet = await self.manager.get_spreadsheet()
-            self.worksheet = await self.spreadsheet.worksheet(self.sheet_name)
+            self.worksheet = await self.manager.get_worksheet(self.sheet_name)
             # Получаем и сохраняем заголовки
             self._headers = await self._get_headers()
 
 
+    async def warm_up(self):
+        """Подготовка при старте приложения: лист, заголовки, курсор записи и снимок для выпадающих списков"""
+        await self.initialize()
+        async with self._append_lock:
+            await self._ensure_next_row()
+        await self._columns_cache.get()
+
+
+    async def _load_headers(self) -> List[str]:
+        """Первая строка листа - для снимка заголовков в общем кэше"""
+        return await self._call('row_values', 1)
+
     async def _get_headers(self) -> List[str]:
-        """Получает заголовки таблицы (первая строка)"""
+        """Получает заголовки таблицы (первая строка), обычно - из общего кэша"""
         try:
-            # Получаем первую строку
-            header_row = await self.worksheet.row_values(1)
-            return header_row
+            return await self._headers_cache.get()
         except Exception as e:
             print(f"Ошибка получения заголовков: {e}")
             return []
@@ -83,11 +135,9 @@ class GoogleSheetsService:
 
             print("Данные для добавления:", row_data)
 
-            # Находим следующую пустую строку
-            next_row = await self._get_next_empty_row()
-
-            # Записываем данные в конкретную строку и колонки
-            await self._write_to_specific_row(next_row, row_data)
+            # Ставим строку в очередь записи: строки, пришедшие почти одновременно, уходят одним запросом
+            next_row = await self._write_batcher.submit(row_data)
+            self._columns_cache.invalidate()
 
             return f"✅ Данные успешно добавлены в строку {next_row}"
 
@@ -99,7 +149,7 @@ class GoogleSheetsService:
         """Находит следующую пустую строку в таблице"""
         try:
             # Получаем все данные
-            all_data = await self.worksheet.get_all_values()
+            all_data = await self._call('get_all_values')
 
             # Ищем первую полностью пустую строку
             for i, row in enumerate(all_data, 1):
@@ -113,6 +163,67 @@ class GoogleSheetsService:
             print(f"Ошибка поиска пустой строки: {e}")
             return 2  # Начинаем со второй строки если заголовок есть
 
+    async def _ensure_next_row(self):
+        """
+        Курсор следующей пустой строки: тот, что оставил последний писавший воркер, иначе - полный просмотр листа.
+        Отстающий курсор безопасен - values.append сам допишет после занятых строк
+        """
+        if self._next_row is not None:
+            return
+        try:
+            entry = await self.cache.get('ledger:next_row')
+            self._next_row = entry[0] if entry else None
+        except Exception as e:
+            print(f"🟡 Общий кэш недоступен для курсора Ledger: {e}")
+        if self._next_row is None:
+            self._next_row = await self._get_next_empty_row()
+            await self._save_shared_next_row()
+
+    async def _save_shared_next_row(self):
+        try:
+            await self.cache.set('ledger:next_row', self._next_row)
+        except Exception as e:
+            print(f"🟡 Курсор Ledger не сохранен в общий кэш: {e}")
+
+    async def _append_rows(self, rows: List[List]) -> int:
+        """
+        Дописывает строки в Ledger без чтения всего листа.
+
+        Курсор следующей пустой строки определяется полным просмотром листа один раз, дальше
+        запись идет через values.append от курсора: если строку под курсором уже кто-то заполнил
+        (например, вручную в таблице), Sheets сам допишет после занятых строк, а курсор
+        синхронизируется по фактическому номеру строки из ответа.
+
+        :return: Номер первой строки, в которую записаны данные
+        """
+        async with self._append_lock:
+            await self._ensure_next_row()
+
+            try:
+                response = await self._call('append_rows', rows, table_range=f"A{self._next_row}")
+            except Exception:
+                self._next_row = None  # при следующей записи курсор определится заново
+                raise
+
+            first_row = self._row_from_updated_range(response['updates']['updatedRange'])
+            if first_row != self._next_row:
+                print(f"Строка {self._next_row} в Ledger уже занята, данные записаны со строки {first_row}")
+            self._next_row = first_row + len(rows)
+            await self._save_shared_next_row()
+
+            if self.mirror is not None:
+                try:
+                    await self.mirror.apply_rows(first_row, rows)
+                except Exception as e:
+                    print(f"🟡 Строки {first_row}-{first_row + len(rows) - 1} не перенесены в копию Ledger: {e}")
+            return first_row
+
+    @staticmethod
+    def _row_from_updated_range(updated_range: str) -> int:
+        """Номер первой строки из диапазона ответа Sheets API (например, "'Ledger'!A10:M10" -> 10)"""
+        first_cell = updated_range.split('!')[-1].split(':')[0]
+        return a1_to_rowcol(first_cell)[0]
+
     async def _write_to_specific_row(self, row_number: int, values: List):
         """Записывает данные в конкретную строку"""
         # Формируем диапазон для записи (например, "A2:L2")
@@ -121,7 +232,7 @@ class GoogleSheetsService:
         range_name = f"{start_col}{row_number}:{end_col}{row_number}"
 
         # Записываем данные
-        await self.worksheet.update(range_name, [values])
+        await self._call('update', [values], range_name)
 
 
     async def read_column(self, column_letter: str) -> List[str]:
@@ -135,8 +246,8 @@ class GoogleSheetsService:
             await self.initialize()
 
             # Получаем все значения колонки
-            column_data = await self.worksheet.col_values(
-                gspread.utils.column_letter_to_number(column_letter)
+            column_data = await self._call(
+                'col_values', a1_to_rowcol(f'{column_letter}1')[1]
             )
 
             # Возвращаем данные без заголовка (если он есть)
@@ -161,52 +272,69 @@ class GoogleSheetsService:
 
     async def read_all_columns_to_dict(self) -> Dict[str, List[str]]:
         """
-        Чтение всех колонок и преобразование в словарь
+        Чтение всех колонок и преобразование в словарь (из кэша снимка, если он свежий)
 
         :return: Словарь {название_колонки: [значения]}
         """
         try:
-            await self.initialize()
-
-            if not self._headers:
-                self._headers = await self._get_headers()
-
-            if not self._headers:
-                return {}
+            return await self._columns_cache.get()
 
-            result = {}
-            result_where = [] # result для накапливания банков
+        except Exception as e:
+            print(f"Ошибка чтения всех колонок: {str(e)}")
+            return {}
 
-            # Читаем данные для каждой колонки, беру множество для всплывающих списков фронтбэка
-            for i, header in enumerate(self._headers, 1):
 
-                if header:  # Пропускаем пустые заголовки
+    async def _load_all_columns_to_dict(self) -> Dict[str, List[str]]:
+        """Загрузка всех колонок из Google таблицы для снимка кэша"""
+        await self.initialize()
 
-                    if header.strip() in ['Куда','Откуда']: # формируем один список банков для всплывающих подсказок  во фронте
-                        for _ in range(2):
-                            column_values = await self.worksheet.col_values(i)
-                            result_where.extend([v.strip() for v in column_values[1:] if v])
-                        result_where_sort = sorted(list(set(result_where)))
-                        result['Куда'] = result_where_sort
-                        result['Откуда'] = result_where_sort
+        if not self._headers:
+            self._headers = await self._get_headers()
 
-                    elif header.strip() in  ['Дата','Сумма','Эквивалент У.Е','USD / RUB']: result[header.strip()] = []
+        if not self._headers:
+            return {}
 
-                    else:
-                        column_values = await self.worksheet.col_values(i)
-                        # Сохраняем значения без заголовка
-                        result[header.strip()] = sorted(list(set([v.strip() for v in column_values[1:] if v]))) if len(column_values) > 1 else []
+        columns_to_read = [
+            i for i, header in enumerate(self._headers, 1)
+            if header and header.strip() not in ['Дата','Сумма','Эквивалент У.Е','USD / RUB']
+        ]
+        if self.mirror is not None and self.mirror.ready:
+            # уникальные значения считает база по копии Ledger, к Sheets API не обращаемся
+            distinct = await self.mirror.distinct_values([self._headers[i - 1].strip() for i in columns_to_read])
+            columns = {i: [self._headers[i - 1]] + distinct[self._headers[i - 1].strip()] for i in columns_to_read}
+        else:
+            # Все нужные колонки читаем одним запросом batch_get вместо col_values на каждую колонку
+            columns = await self._batch_read_columns(columns_to_read)
+
+        # формируем один список банков для всплывающих подсказок во фронте
+        result_where = sorted(set(
+            v.strip()
+            for i, header in enumerate(self._headers, 1) if header and header.strip() in ['Куда','Откуда']
+            for v in columns[i][1:] if v
+        ))
+
+        result = {}
+        # Беру множество значений колонки для всплывающих списков фронтбэка
+        for i, header in enumerate(self._headers, 1):
+
+            if header:  # Пропускаем пустые заголовки
+
+                if header.strip() in ['Куда','Откуда']:
+                    result['Куда'] = result_where
+                    result['Откуда'] = result_where
+
+                elif header.strip() in  ['Дата','Сумма','Эквивалент У.Е','USD / RUB']: result[header.strip()] = []
 
-            return result
+                else:
+                    # Сохраняем значения без заголовка
+                    result[header.strip()] = sorted(set(v.strip() for v in columns[i][1:] if v))
 
-        except Exception as e:
-            print(f"Ошибка чтения всех колонок: {str(e)}")
-            return {}
+        return result
 
 
     async def read_specific_columns(self, column_names: List[str]) -> Dict[str, List[str]]:
         """
-        Чтение только указанных колонок
+        Чтение только указанных колонок (одним запросом batch_get)
 
         :param column_names: Список названий колонок для чтения
         :return: Словарь {название_колонки: [значения]}
@@ -217,12 +345,23 @@ class GoogleSheetsService:
             if not self._headers:
                 self._headers = await self._get_headers()
 
+            col_indexes = {
+                col_name: self._headers.index(col_name) + 1
+                for col_name in column_names if col_name in self._headers
+            }
+            if self.mirror is not None and self.mirror.ready:
+                mirrored = await self.mirror.column_values([col_name.strip() for col_name in col_indexes])
+                columns = {
+                    col_index: [col_name] + mirrored[col_name.strip()] for col_name, col_index in col_indexes.items()
+                }
+            else:
+                columns = await self._batch_read_columns(list(col_indexes.values()))
+
             result = {}
 
             for col_name in column_names:
-                if col_name in self._headers:
-                    col_index = self._headers.index(col_name) + 1
-                    column_values = await self.worksheet.col_values(col_index)
+                if col_name in col_indexes:
+                    column_values = columns[col_indexes[col_name]]
                     result[col_name] = column_values[1:] if len(column_values) > 1 else [] # во фронте брать множество от значений
                 else:
                     result[col_name] = []  # Колонка не найдена
@@ -247,11 +386,11 @@ class GoogleSheetsService:
             if not self._headers:
                 self._headers = await self._get_headers()
 
-            col_index = gspread.utils.column_letter_to_number(column_letter)
+            col_index = a1_to_rowcol(f'{column_letter}1')[1]
 
             if col_index <= len(self._headers):
                 header = self._headers[col_index - 1]
-                values = await self.worksheet.col_values(col_index)
+                values = (await self._batch_read_columns([col_index]))[col_index]
 
                 return {
                     header: values[1:] if len(values) > 1 else []
@@ -263,14 +402,70 @@ class GoogleSheetsService:
             print(f"Ошибка чтения колонки с заголовком: {str(e)}")
             return {}
 
-    async def mark_balance_update(self,row):  # ставим отметку о обновлении баланса
+
+    async def _batch_read_columns(self, col_indexes: List[int]) -> Dict[int, List[str]]:
+        """
+        Читает несколько колонок за одно обращение к API (batch_get по столбцам)
+
+        :param col_indexes: Номера колонок (1, 2, 3, ...)
+        :return: Словарь {номер_колонки: [значения с заголовком]}, как у col_values
+        """
+        if not col_indexes:
+            return {}
+
+        ranges = []
+        for col_index in col_indexes:
+            column_letter = rowcol_to_a1(1, col_index)[:-1]
+            ranges.append(f"{column_letter}1:{column_letter}")
+
+        value_ranges = await self._call('batch_get', ranges, major_dimension=gspread.utils.Dimension.cols)
+
+        return {
+            col_index: (list(value_range[0]) if value_range else [])
+            for col_index, value_range in zip(col_indexes, value_ranges)
+        }
+
+
+    async def _call(self, method: str, *args, **kwargs):
+        """Обращение к листу через gspread_asyncio с учетом в счетчике запросов к Sheets API"""
+        return await sheets_call(self.worksheet, method, *args, **kwargs)
+
+    async def mark_balance_update(self, row, sheets_tx: Optional[SheetsTransaction] = None):  # ставим отметку о обновлении баланса
+        """Отметка об обновлении баланса. С sheets_tx отметка только добавляется в общую запись"""
+        if sheets_tx is not None:
+            sheets_tx.set(self.sheet_name, f'M{row}', [['✓ баланс, web']])
+            sheets_tx.after_commit(lambda: self._after_mark(row, 'M', '✓ баланс, web'))
+            return
         await self.initialize()
-        await self.worksheet.update_acell(f'M{row}', '✓ баланс, web')
+        await self._call('update_acell', f'M{row}', '✓ баланс, web')
+        self._after_mark(row, 'M', '✓ баланс, web')
         return
 
 
-    async def mark_sending_to_chat(self,row):  # ставим отметку об отправлении сообщения в чат
+    async def mark_sending_to_chat(self, row, sheets_tx: Optional[SheetsTransaction] = None):  # ставим отметку об отправлении сообщения в чат
+        """Отметка об отправке в чат. С sheets_tx отметка только добавляется в общую запись"""
+        if sheets_tx is not None:
+            sheets_tx.set(self.sheet_name, f'L{row}', [['✓ в чат, web']])
+            sheets_tx.after_commit(lambda: self._after_mark(row, 'L', '✓ в чат, web'))
+            return
         await self.initialize()
-        await self.worksheet.update_acell(f'L{row}', '✓ в чат, web')
+        await self._call('update_acell', f'L{row}', '✓ в чат, web')
+        self._after_mark(row, 'L', '✓ в чат, web')
         return
 
+
+    def _after_mark(self, row, column_letter: str, value: str):
+        """После записи отметки: сброс снимка колонок и перенос отметки в копию Ledger (в фоне)"""
+        self._columns_cache.invalidate()
+        col_index = a1_to_rowcol(f'{column_letter}1')[1]
+        if self.mirror is None or col_index > len(self._headers):
+            return
+
+        def log_error(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is not None:
+                print(f"🟡 Отметка {column_letter}{row} не перенесена в копию Ledger: {task.exception()}")
+
+        asyncio.create_task(
+            self.mirror.apply_cell(int(row), self._headers[col_index - 1].strip(), value)
+        ).add_done_callback(log_error)
+
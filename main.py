@@ -1,18 +1,30 @@
-import asyncio
+import os
+import time
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
 from pydantic import BaseModel
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
+from datetime import date
 
 
-from models.models import init_db
+from models.models import init_db, engine
 from handlers import requests as rq
+from handlers import exchange_rates_history
+from handlers.telegram_outbox import TelegramOutbox
+from handlers.sheet_jobs import IdempotencyKeyMismatch, SheetJobQueue
 from handlers.work_with_GoogleTable import GoogleSheetsService
 from handlers.balance_formation import GoogleSheetsBalanceUpdater
+from service.request_stats import current_trace, start_request_stats
+from service.sheets_transaction import SheetsTransaction
+from service.google_table_authorization import sheets_scheduler, shared_sheets_manager
+from service.exchange_rates import ExchangeRatesService
+from service.shared_cache import shared_cache
+from service.telegram_bot import BOT_MODE, bot, check_webhook_secret, feed_webhook_update, start_bot, stop_bot
+from service import metrics
 
 ######### проверка обновления
 ######### проверка обновления
@@ -21,7 +33,20 @@ from handlers.balance_formation import GoogleSheetsBalanceUpdater
 @asynccontextmanager
 async def lifespan(app_: FastAPI):
     await init_db()
+    await shared_cache.start()
+    await warm_up_google_sheets()
+    telegram_outbox.start()
+    add_to_sheet_jobs.start()
+    await start_bot()
     yield
+    await add_to_sheet_jobs.close()
+    await telegram_outbox.close()
+    await stop_bot()
+    if service_GoogleSheet_Ledger.mirror is not None:
+        await service_GoogleSheet_Ledger.mirror.close()
+    await shared_sheets_manager.close()
+    await exchange_rates_service.close()
+    await shared_cache.close()
 
 
 #app = FastAPI(title="web_app_tg", lifespan=lifespan)
@@ -36,44 +61,102 @@ app.add_middleware(
     allow_methods=["GET", "POST", "PUT", "DELETE"],
     allow_credentials=True,
     allow_headers=["*"],
+    expose_headers=["X-Sheets-Api-Calls", "Server-Timing", "X-Debug-Trace"],
 )
 
+
+metrics.instrument_engine(engine)
+
+# Отдавать ли полную трассу запроса в заголовке X-Debug-Trace (в ней тексты SQL запросов - только для отладки)
+DEBUG_TRACE_ENABLED = os.getenv('DEBUG_TRACE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Время обработки запроса в гистограмму по шаблону маршрута (/api/jobs/{job_id}, а не /api/jobs/15)"""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        metrics.http_request_duration.labels(
+            method=request.method,
+            route=route.path if route is not None else 'unmatched',
+            status=str(status)
+        ).observe(time.perf_counter() - started)
+
+
+@app.middleware("http")
+async def count_sheets_calls(request: Request, call_next):
+    """
+    Учитывает внешние обращения за запрос (Google Sheets, SQL, ЦБ РФ, Telegram) и отдает их в заголовках:
+    X-Sheets-Api-Calls - число обращений к Sheets API, Server-Timing - длительности (видно в devtools браузера),
+    X-Debug-Trace - полная трасса в JSON, если запрос пришел с заголовком X-Debug-Trace и DEBUG_TRACE_ENABLED
+    """
+    trace = start_request_stats()
+    response = await call_next(request)
+    sheets_calls = trace.sheets_calls
+    total_calls = sum(sheets_calls.values())
+    response.headers['X-Sheets-Api-Calls'] = str(total_calls)
+    response.headers['Server-Timing'] = trace.server_timing()
+    if DEBUG_TRACE_ENABLED and request.headers.get('X-Debug-Trace'):
+        response.headers['X-Debug-Trace'] = trace.debug_json()
+    if total_calls:
+        print(f"{request.method} {request.url.path}: обращений к Google Sheets API - {total_calls} {dict(sheets_calls)}")
+    return response
+
+
 service_GoogleSheet_Ledger = GoogleSheetsService()
 service_GoogleSheet_Balances = GoogleSheetsBalanceUpdater()
+exchange_rates_service = ExchangeRatesService()
+
+
+async def warm_up_google_sheets():
+    """Прогрев подключения к Google Sheets до первого запроса: авторизация, таблица, листы, структура Balances"""
+    try:
+        await shared_sheets_manager.warm_up()
+        await service_GoogleSheet_Ledger.warm_up()
+        await service_GoogleSheet_Balances.initialize()
+        if service_GoogleSheet_Ledger.mirror is not None:
+            service_GoogleSheet_Ledger.mirror.start()
+        print("✅ Google Sheets: подключение прогрето")
+    except Exception as e:
+        print(f"🟡 Не удалось прогреть Google Sheets: {e}")
 
 
 import os
 
 from dotenv import find_dotenv, load_dotenv
-from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 
 
 load_dotenv(find_dotenv())
 
-bot = Bot(token=os.getenv('TOKEN_Lora'))
-
 TELEGRAM_CHAT_ID = os.getenv('telegram_chat_id')
+# Сколько (сек) /api/add-to-sheet ждет выполнения задания, прежде чем ответить 202 с job_id
+ADD_TO_SHEET_WAIT_TIMEOUT = float(os.getenv('ADD_TO_SHEET_WAIT_TIMEOUT', 20))
 
-from aiogram import Router
+# Бот Lora, является админом в группе; где он получает обновления - см. BOT_MODE
+telegram_outbox = TelegramOutbox(bot, service_GoogleSheet_Ledger)
 
-router = Router()
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
 
+@app.get("/")
+async def root():
+    return {"message": "Привет"}
 
-# Запуск бота Lora, является админом в группе
-@app.on_event("startup")
-async def startup_event():
-    asyncio.create_task(dp.start_polling())
 
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в формате Prometheus: HTTP, Google Sheets, SQL, Telegram, ЦБ РФ"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
 
-# Глобальная переменная для хранения структуры таблицы
-table_structure = {}
 
-@app.get("/")
-async def root():
-    return {"message": "Привет"}
+@app.get("/api/sheets-scheduler")
+async def sheets_scheduler_stats():
+    """Очередь обращений к Google Sheets API: глубина очереди, запросы в работе, счетчики 429 и повторов"""
+    return sheets_scheduler.stats()
 
 from fastapi import Query
 
@@ -106,75 +189,143 @@ async def read_all_columns_to_dict():
 
 @app.get("/api/table-structure")
 async def get_table_structure():
-    """Получение структуры таблицы (колонок и возможных значений)"""
+    """Получение структуры таблицы (колонок и возможных значений) - из снимка Ledger, общего для воркеров"""
     try:
-        global table_structure
-        table_structure = await service_GoogleSheet_Ledger.read_all_columns_to_dict()
-        return table_structure
+        return await service_GoogleSheet_Ledger.read_all_columns_to_dict()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/add-to-sheet")
-async def add_to_sheet(row_data: Dict):
-    print("/api/add-to-sheet, row_data", row_data)
+async def apply_add_to_sheet(row_data: Dict, progress: Dict, save_progress) -> Dict:
+    """
+    Задание add_to_sheet: строка в Ledger, затем балансы 'Куда'/'Откуда' с отметкой в Ledger одним запросом
+
+    Номер записанной строки сохраняется в progress, поэтому повтор после ошибки балансов не дублирует строку.
+    Запись балансов атомарна (один batchUpdate), ее можно безопасно повторять.
+    """
+    # Преобразуем данные для Google Sheets
+    sheet_data = {}
+    for key, value in row_data.items():
+
+        if isinstance(value, (int, float)):
+            # Числа оставляем как есть - Google Sheets поймет
+            sheet_data[key] = value
+        else:
+            # Строки и другие типы
+            sheet_data[key] = str(value) if value is not None else ""
+
+    # 1. Добавление в Ledger
+    if 'ledger' not in progress:
+        result = await service_GoogleSheet_Ledger.add_data(sheet_data)
+        print("main, /api/add-to-sheet, sheet_data ", sheet_data)
+        if result.startswith("❌"):
+            raise RuntimeError(f"Ledger error: {result}")
+        print(f"✅ Ledger: {result}")
+        progress['ledger'] = result
+        await save_progress()
+    result = progress['ledger']
+
+    # 2. Обновление баланса: 'Куда', 'Откуда', итоги и отметка в Ledger записываются одним запросом
     try:
-        # 1. Добавление в Ledger
-        try:
-            # Преобразуем данные для Google Sheets
-            sheet_data = {}
-            for key, value in row_data.items():
-
-                if isinstance(value, (int, float)):
-                    # Числа оставляем как есть - Google Sheets поймет
-                    sheet_data[key] = value
-                else:
-                    # Строки и другие типы
-                    sheet_data[key] = str(value) if value is not None else ""
-
-            result = await service_GoogleSheet_Ledger.add_data(sheet_data)
-            print("main, /api/add-to-sheet, sheet_data ", sheet_data)
-            print(f"✅ Ledger: {result}")
-
-            # 2. Обновление баланса
-            try:
-                if row_data['Куда'] != '':
-                    transaction = {}
-                    transaction.setdefault('Валюта', sheet_data['Валюта'])
-                    transaction.setdefault('Инстанс', (sheet_data['Куда']))
-                    transaction.setdefault('Сумма', sheet_data['Сумма'])
-                    balance_updater = await service_GoogleSheet_Balances.update_balance(transaction)
-                    print(f"✅ Balance: {balance_updater}")
-
-                if row_data['Откуда'] != '':
-                    transaction = {}
-                    transaction.setdefault('Валюта', sheet_data['Валюта'])
-                    transaction.setdefault('Инстанс', (sheet_data['Откуда']))
-                    transaction.setdefault('Сумма', -sheet_data['Сумма'])
-                    balance_updater = await service_GoogleSheet_Balances.update_balance(transaction)
-                    print(f"✅ Balance: {balance_updater}")
-                number_row = result.split()[-1]
-
-                await service_GoogleSheet_Ledger.mark_balance_update(number_row)
-            except Exception as e:
-                print(f"🟡 Предупреждение Balance: {e}")
-                balance_updater = f"Balance update failed: {str(e)}"
-            return {
-                "status": "success",
-                "message": result,
-                "balance_update": balance_updater,
-                "added_data": row_data
-            }
-
-        except Exception as e:
-            print(f"🔴 Ошибка Ledger: {e}")
-            return {"status": "error", "message": f"Ledger error: {str(e)}"}
+        transactions = []
+        if row_data['Куда'] != '':
+            transaction = {}
+            transaction.setdefault('Валюта', sheet_data['Валюта'])
+            transaction.setdefault('Инстанс', (sheet_data['Куда']))
+            transaction.setdefault('Сумма', sheet_data['Сумма'])
+            transactions.append(transaction)
+
+        if row_data['Откуда'] != '':
+            transaction = {}
+            transaction.setdefault('Валюта', sheet_data['Валюта'])
+            transaction.setdefault('Инстанс', (sheet_data['Откуда']))
+            transaction.setdefault('Сумма', -sheet_data['Сумма'])
+            transactions.append(transaction)
+    except Exception as e:
+        # ошибка в данных запроса - повтор не поможет, строка в Ledger уже записана
+        print(f"🟡 Предупреждение Balance: {e}")
+        return {
+            "status": "success",
+            "message": result,
+            "balance_update": f"Balance update failed: {str(e)}",
+            "added_data": row_data
+        }
+    number_row = result.split()[-1]
+
+    sheets_tx = SheetsTransaction()
+    if number_row.isdigit():
+        await service_GoogleSheet_Ledger.mark_balance_update(number_row, sheets_tx)
+    balance_updates = await service_GoogleSheet_Balances.update_balances(transactions, sheets_tx)
+    for message in balance_updates:
+        print(f"✅ Balance: {message}")
+    failed = [message for message in balance_updates if message.startswith("❌")]
+    if failed:
+        raise RuntimeError(failed[-1])
+
+    return {
+        "status": "success",
+        "message": result,
+        "balance_update": balance_updates[-1] if balance_updates else None,
+        "added_data": row_data
+    }
+
 
+add_to_sheet_jobs = SheetJobQueue('add_to_sheet', apply_add_to_sheet)
 
+
+def _job_accepted(job_id: int) -> JSONResponse:
+    return JSONResponse(
+        status_code=202,
+        content={"status": "accepted", "job_id": job_id},
+        headers={"Location": f"/api/jobs/{job_id}"}
+    )
+
+
+@app.post("/api/add-to-sheet")
+async def add_to_sheet(row_data: Dict, request: Request, respond_async: bool = False):
+    """
+    Добавление строки в Ledger и обновление балансов через очередь заданий
+
+    С заголовком 'Prefer: respond-async' (или ?respond_async=true) сразу отвечает 202 с job_id,
+    статус - GET /api/jobs/{job_id}. Без него ждет выполнения задания и отвечает как раньше;
+    если задание не успело за ADD_TO_SHEET_WAIT_TIMEOUT, тоже отвечает 202.
+    Необязательный заголовок Idempotency-Key: повтор запроса с тем же ключом не создает новое задание
+    (кроме случая, когда исходное завершилось ошибкой); тот же ключ с другим телом - 422.
+    """
+    print("/api/add-to-sheet, row_data", row_data)
+    try:
+        # повтор с тем же Idempotency-Key получает результат исходного задания, Google Sheets не трогаем
+        job_id, _ = await add_to_sheet_jobs.enqueue(row_data, request.headers.get('Idempotency-Key'))
+    except IdempotencyKeyMismatch as e:
+        raise HTTPException(status_code=422, detail=str(e))
     except Exception as e:
         print(f"🔴 Критическая ошибка: {str(e)}")
         return {"status": "error", "message": str(e)}
 
+    if respond_async or 'respond-async' in request.headers.get('Prefer', ''):
+        return _job_accepted(job_id)
+
+    job = await add_to_sheet_jobs.wait(job_id, timeout=ADD_TO_SHEET_WAIT_TIMEOUT)
+    # обращения к Sheets выполнялись в обработчике очереди - добавляем их в трассу этого запроса
+    trace = current_trace()
+    if trace is not None:
+        trace.merge(add_to_sheet_jobs.job_trace(job_id))
+    if job is None:
+        return _job_accepted(job_id)
+    if job['status'] == 'done':
+        return job['result']
+    print(f"🔴 Ошибка: {job['last_error']}")
+    return {"status": "error", "message": job['last_error'], "job_id": job_id}
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job_status(job_id: int):
+    """Статус задания: pending, running, done, failed; выполненные шаги, результат, число попыток"""
+    job = await add_to_sheet_jobs.get_status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    return job
+
 
 @app.post("/api/update-sheet")
 async def update_balance(data: Dict[str, str]):
@@ -188,40 +339,44 @@ async def update_balance(data: Dict[str, str]):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-from fastapi import FastAPI, HTTPException
-import httpx
-import xml.etree.ElementTree as ET
-from datetime import datetime
-
-
 @app.get("/api/exchange-rates") # запрос курса валют банк РФ
-async def get_exchange_rates():
-    """Получение курсов валют от ЦБ РФ"""
-    try:
-        today = datetime.now().strftime("%d/%m/%Y")
-        url = f"http://www.cbr.ru/scripts/XML_daily.asp?date_req={today}"
-
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, timeout=10.0)
-            response.raise_for_status()
-
-            # Парсим XML
-            root = ET.fromstring(response.text)
-            rates = {}
-
-            for valute in root.findall('Valute'):
-                char_code = valute.find('CharCode').text
-                value = float(valute.find('Value').text.replace(',', '.'))
-                nominal = float(valute.find('Nominal').text)
-                rates[char_code] = value / nominal
-                print(rates[char_code])
-
-            return rates
+async def get_exchange_rates(date: Optional[date] = None, date_from: Optional[date] = None, date_to: Optional[date] = None):
+    """
+    Получение курсов валют ЦБ РФ
 
+    - без параметров - курсы на сегодня (из кэша, если уже загружены);
+    - date - курсы на дату (из базы, при отсутствии - у ЦБ с сохранением в базу);
+    - date_from/date_to - курсы за период из базы: {дата: {валюта: курс}}.
+    """
+    try:
+        if date_from or date_to:
+            if not (date_from and date_to) or date_from > date_to:
+                raise HTTPException(status_code=400, detail="Нужно указать date_from <= date_to")
+            return await exchange_rates_history.get_stored_rates(date_from, date_to)
+        if date:
+            return await exchange_rates_history.get_rates_on_date(exchange_rates_service, date)
+        return await exchange_rates_service.get_rates()
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка получения курсов: {str(e)}")
 
 
+@app.post("/api/exchange-rates/backfill", status_code=202)
+async def backfill_exchange_rates(date_from: date, background_tasks: BackgroundTasks, date_to: Optional[date] = None,
+                                  overwrite: bool = False):
+    """Запуск заполнения истории курсов за период в фоне (уже загруженные даты пропускаются)"""
+    date_to = date_to or date.today()
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="Нужно указать date_from <= date_to")
+    background_tasks.add_task(
+        exchange_rates_history.backfill_exchange_rates,
+        exchange_rates_service, date_from, date_to, overwrite=overwrite
+    )
+    return {"status": "accepted", "date_from": date_from.isoformat(), "date_to": date_to.isoformat()}
+
+
 @app.post("/api/send-to-chat")
 async def send_to_chat(data_dict: Dict[str, Any]):
     try:
@@ -233,17 +388,32 @@ async def send_to_chat(data_dict: Dict[str, Any]):
             elif type(value) != str and value != "":
                 message_text += f"` {key}: {'{:,.2f}'.format(value)}\n"
 
-        # Отправляем в Telegram
-        await bot.send_message(
-            chat_id=TELEGRAM_CHAT_ID,
-            text=message_text
-        )
-        # вставлять галочку "✓ чат"
+        # Сообщение и галочку "✓ чат" отправит очередь, ответ не ждет Telegram и Google Sheets
         number_row = int(data_dict['номер строки'])
-        await service_GoogleSheet_Ledger.mark_sending_to_chat(number_row)
-        return {"success": True, "message": "Данные отправлены в чат"}
+        outbox_id = await telegram_outbox.enqueue(TELEGRAM_CHAT_ID, message_text, number_row)
+        return {"success": True, "message": "Данные поставлены в очередь отправки в чат", "outbox_id": outbox_id}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка: {str(e)}")
 
 
+@app.get("/api/send-to-chat/{outbox_id}")
+async def send_to_chat_status(outbox_id: int):
+    """Статус сообщения в очереди: pending, sent (ждет отметки в Ledger), done, failed"""
+    status = await telegram_outbox.get_status(outbox_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Сообщение не найдено")
+    return status
+
+
+
+
+@app.post("/api/telegram/webhook")
+async def telegram_webhook(request: Request):
+    """Обновления бота Lora от Telegram (BOT_MODE=webhook); обрабатываются в фоне, Telegram получает ответ сразу"""
+    if BOT_MODE != 'webhook':
+        raise HTTPException(status_code=404, detail="Webhook бота выключен")
+    if not check_webhook_secret(request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+        raise HTTPException(status_code=403, detail="Неверный секрет webhook")
+    feed_webhook_update(await request.json())
+    return {"ok": True}
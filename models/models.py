@@ -1,8 +1,10 @@
 import os
+import socket
 
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, String, Numeric, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Numeric, Float, ForeignKey, DateTime, Date, Text, JSON, Index, UniqueConstraint
+from sqlalchemy import func, inspect, select, text
 from sqlalchemy.orm import relationship, DeclarativeBase
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncAttrs
 
@@ -16,6 +18,9 @@ async_session = async_sessionmaker(
             expire_on_commit=False
         )
 
+# Кто взял задание или сообщение очереди (worker_id в sheet_jobs и telegram_outbox): машина и процесс
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -31,7 +36,7 @@ class UserAuth(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     full_name  = Column(String(50))
-    id_telegram = Column(String(20),default='')
+    id_telegram = Column(String(20),default='', index=True)
     login = Column(String(50))
     password = Column(String(250))
     date = Column(DateTime,  default=datetime.utcnow)
@@ -60,6 +65,10 @@ class UserWallet(Base):
     user = relationship('UserAuth', back_populates='wallets')
 
 
+# Последний снимок каждого токена пользователя (handlers.requests.wallet_latest_query) - по индексу без просмотра всей истории
+Index('ix_users_wallets_user_token_created', UserWallet.user_id, UserWallet.token, UserWallet.created_at.desc())
+
+
 class UserReport(Base):
     __tablename__ = 'users_reports'
     __table_args__ = {'schema': 'public'}  # Явно указываем схему public
@@ -77,6 +86,200 @@ class UserReport(Base):
     user_report = relationship('UserAuth', back_populates='reports')
 
 
+Index('ix_users_reports_user_updated', UserReport.user_id, UserReport.updated_at)
+
+
+class UserReportDaily(Base):
+    """Итог отчетов пользователя за день; ведется триггером на users_reports (см. _create_report_rollup_trigger)"""
+    __tablename__ = 'users_reports_daily'
+    __table_args__ = {'schema': 'public'}
+
+    user_id = Column(Integer, ForeignKey('public.users_auth.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    total_result = Column(Numeric, nullable=False, default=0)
+    rows_count = Column(Integer, nullable=False, default=0)
+
+
+class ExchangeRate(Base):
+    __tablename__ = 'exchange_rates'
+    # уникальный индекс (дата, валюта) используется и для upsert, и для выборки по диапазону дат
+    __table_args__ = (
+        UniqueConstraint('rate_date', 'char_code', name='uq_exchange_rates_date_code'),
+        {'schema': 'public'}
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    rate_date = Column(Date, nullable=False)  # дата, на которую запрошен курс у ЦБ
+    char_code = Column(String(3), nullable=False)
+    rate = Column(Numeric, nullable=False)  # рублей за 1 единицу валюты
+    loaded_at = Column(DateTime, default=datetime.utcnow)
+
+
+class TelegramOutboxMessage(Base):
+    __tablename__ = 'telegram_outbox'
+    __table_args__ = {'schema': 'public'}
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(String, nullable=False)
+    text = Column(Text, nullable=False)
+    ledger_row = Column(Integer, nullable=True)  # строка Ledger, в которой ставится отметка "✓ в чат, web"
+    # pending - ждет отправки, sending - отправляет воркер worker_id, sent - отправлено, ждет отметки в Ledger,
+    # done - готово, failed - не отправлено
+    status = Column(String(16), nullable=False, default='pending', index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+    worker_id = Column(String(128), nullable=True)  # WORKER_ID воркера, взявшего сообщение
+    heartbeat_at = Column(DateTime, nullable=True)  # воркер жив и еще отправляет; без отметок сообщение возвращается в очередь
+
+
+class SheetJob(Base):
+    __tablename__ = 'sheet_jobs'
+    __table_args__ = {'schema': 'public'}
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(32), nullable=False)  # add_to_sheet
+    payload = Column(JSON, nullable=False)
+    # pending - ждет, running - выполняет воркер worker_id, done - выполнено, failed - не выполнено после всех попыток
+    status = Column(String(16), nullable=False, default='pending', index=True)
+    progress = Column(JSON, nullable=True)  # выполненные шаги (например, номер строки Ledger), чтобы повтор их не дублировал
+    result = Column(JSON, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    worker_id = Column(String(128), nullable=True)  # WORKER_ID воркера, взявшего задание
+    heartbeat_at = Column(DateTime, nullable=True)  # воркер жив и еще выполняет; без отметок задание возвращается в очередь
+
+
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = {'schema': 'public'}
+
+    scope = Column(String(32), primary_key=True)  # вид задания, например add_to_sheet
+    key = Column(String(255), primary_key=True)  # значение заголовка Idempotency-Key
+    job_id = Column(Integer, ForeignKey('public.sheet_jobs.id'), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    payload_hash = Column(String(64))  # sha256 тела запроса: тот же ключ с другим телом - ошибка клиента
+
+
+class LedgerEntry(Base):
+    __tablename__ = 'ledger_entries'
+    __table_args__ = {'schema': 'public'}
+
+    row_number = Column(Integer, primary_key=True)  # номер строки на листе Ledger
+    cells = Column(JSON, nullable=False)  # {заголовок колонки: значение}
+    synced_at = Column(DateTime, default=datetime.utcnow)
+
+
+class LedgerSyncState(Base):
+    __tablename__ = 'ledger_sync_state'
+    __table_args__ = {'schema': 'public'}
+
+    sheet_name = Column(String(64), primary_key=True)
+    last_row = Column(Integer, nullable=False, default=1)  # последняя строка листа, перенесенная в ledger_entries
+    headers = Column(JSON, nullable=True)
+    synced_at = Column(DateTime, default=datetime.utcnow)
+    full_synced_at = Column(DateTime, nullable=True)
+
+
+class SharedCacheEntry(Base):
+    """Общий для воркеров кэш: снимки листов Google Sheets и состояние бота (service.shared_cache)"""
+    __tablename__ = 'shared_cache'
+    __table_args__ = {'schema': 'public'}
+
+    key = Column(Text, primary_key=True)
+    value = Column(JSON, nullable=True)
+    stored_at = Column(Float, nullable=False)  # time.time() начала загрузки значения
+
+
+def _add_columns(sync_conn):
+    """create_all не добавляет новые колонки к уже существующим таблицам - добавляем их (только nullable)"""
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name, schema=table.schema):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name, schema=table.schema)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(dialect=sync_conn.dialect)
+                sync_conn.execute(text(
+                    f'ALTER TABLE {table.schema}.{table.name} ADD COLUMN IF NOT EXISTS {column.name} {column_type}'
+                ))
+
+
+# Триггер ведет users_reports_daily при вставке, правке и удалении строк users_reports - в той же транзакции,
+# поэтому итоги учитывают и строки, которые закоммитились позже строк с большим id
+_REPORT_ROLLUP_FUNCTION = """
+CREATE OR REPLACE FUNCTION public.users_reports_daily_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.updated_at IS NOT NULL THEN
+        UPDATE public.users_reports_daily
+           SET total_result = total_result - OLD.result, rows_count = rows_count - 1
+         WHERE user_id = OLD.user_id AND day = OLD.updated_at::date;
+        DELETE FROM public.users_reports_daily
+         WHERE user_id = OLD.user_id AND day = OLD.updated_at::date AND rows_count <= 0;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.updated_at IS NOT NULL THEN
+        INSERT INTO public.users_reports_daily (user_id, day, total_result, rows_count)
+        VALUES (NEW.user_id, NEW.updated_at::date, NEW.result, 1)
+        ON CONFLICT (user_id, day) DO UPDATE
+           SET total_result = users_reports_daily.total_result + EXCLUDED.total_result,
+               rows_count = users_reports_daily.rows_count + 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+_REPORT_ROLLUP_TRIGGER = """
+CREATE TRIGGER users_reports_daily_trigger
+AFTER INSERT OR DELETE OR UPDATE OF user_id, updated_at, result ON public.users_reports
+FOR EACH ROW EXECUTE FUNCTION public.users_reports_daily_apply()
+"""
+
+
+def rebuild_users_reports_daily(sync_conn):
+    """Пересчитывает дневные итоги users_reports_daily с нуля (записи в users_reports на это время ждут)"""
+    sync_conn.execute(text('LOCK TABLE public.users_reports IN SHARE ROW EXCLUSIVE MODE'))
+    sync_conn.execute(UserReportDaily.__table__.delete())
+    day = func.date(UserReport.updated_at)
+    rows = (select(UserReport.user_id, day, func.sum(UserReport.result), func.count())
+            .where(UserReport.updated_at.isnot(None))
+            .group_by(UserReport.user_id, day))
+    sync_conn.execute(
+        UserReportDaily.__table__.insert().from_select(['user_id', 'day', 'total_result', 'rows_count'], rows)
+    )
+
+
+def _create_report_rollup_trigger(sync_conn):
+    """Устанавливает триггер дневных итогов; при первой установке итоги пересчитываются по всей users_reports"""
+    if sync_conn.dialect.name != 'postgresql':
+        return
+    sync_conn.execute(text(_REPORT_ROLLUP_FUNCTION))
+    trigger_exists = text(
+        "SELECT 1 FROM pg_trigger WHERE tgname = 'users_reports_daily_trigger' "
+        "AND tgrelid = 'public.users_reports'::regclass"
+    )
+    if sync_conn.execute(trigger_exists).first():
+        return
+    rebuild_users_reports_daily(sync_conn)  # блокировка таблицы: параллельный воркер дождется и увидит триггер
+    if not sync_conn.execute(trigger_exists).first():
+        sync_conn.execute(text(_REPORT_ROLLUP_TRIGGER))
+
+
+def _create_indexes(sync_conn):
+    """create_all не добавляет новые индексы к уже существующим таблицам - создаем их отдельно"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
 async def init_db():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all) #.metadata.create_all
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all) #.metadata.create_all
+        await conn.run_sync(_add_columns)
+        await conn.run_sync(_create_indexes)
+        await conn.run_sync(_create_report_rollup_trigger)
\ No newline at end of file
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Dict, Optional
+
+import httpx
+from dotenv import find_dotenv, load_dotenv
+
+from service.request_stats import span
+from service.snapshot_cache import SnapshotCache
+
+
+load_dotenv(find_dotenv())
+
+# Адрес ЦБ РФ можно подменить локальным сервером с тем же XML (для тестов и бенчмарков)
+CBR_BASE_URL = os.getenv('CBR_BASE_URL', 'http://www.cbr.ru')
+# Сколько ждать ответ ЦБ до того, как отдать последние известные курсы (сек)
+CBR_TIMEOUT = float(os.getenv('CBR_TIMEOUT', 3))
+# Курсы на сегодня перепроверяем раз в час, курсы за прошлые даты не меняются
+EXCHANGE_RATES_TTL = float(os.getenv('EXCHANGE_RATES_TTL', 3600))
+EXCHANGE_RATES_STALE_TTL = float(os.getenv('EXCHANGE_RATES_STALE_TTL', 24 * 3600))
+EXCHANGE_RATES_CACHED_DATES = int(os.getenv('EXCHANGE_RATES_CACHED_DATES', 64))
+
+
+def parse_cbr_xml(content: bytes) -> Dict[str, float]:
+    """Разбирает XML_daily.asp ЦБ РФ в словарь {код валюты: курс в рублях за 1 единицу}"""
+    root = ET.fromstring(content)
+    rates = {}
+    for valute in root.findall('Valute'):
+        char_code = valute.find('CharCode').text
+        value = float(valute.find('Value').text.replace(',', '.'))
+        nominal = float(valute.find('Nominal').text)
+        rates[char_code] = value / nominal
+    return rates
+
+
+class ExchangeRatesService:
+    """
+    Курсы валют ЦБ РФ с кэшем по дате.
+
+    - один HTTP клиент с пулом соединений на все запросы;
+    - курсы на каждую дату кэшируются, одновременные промахи схлопываются в один запрос к ЦБ;
+    - устаревшие курсы на сегодня отдаются сразу, обновление идет в фоне;
+    - если ЦБ не ответил за CBR_TIMEOUT, отдаются последние известные курсы.
+    """
+
+    def __init__(self, base_url: str = CBR_BASE_URL, timeout: float = CBR_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        self._caches: "OrderedDict[date, SnapshotCache]" = OrderedDict()
+        self._last_rates: Optional[Dict[str, float]] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=10.0,
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5)
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def fetch_rates(self, on_date: date) -> Dict[str, float]:
+        """Запрос курсов у ЦБ на дату (без кэша)"""
+        with span('cbr', f'XML_daily {on_date.isoformat()}'):
+            response = await self._get_client().get(
+                '/scripts/XML_daily.asp',
+                params={'date_req': on_date.strftime("%d/%m/%Y")}
+            )
+            response.raise_for_status()
+        rates = parse_cbr_xml(response.content)
+        # запасной ответ get_rates отдается только на сегодня, поэтому и запоминаем только сегодняшние курсы
+        if on_date == datetime.now().date():
+            self._last_rates = rates
+        return rates
+
+    def _cache_for(self, on_date: date) -> SnapshotCache:
+        cache = self._caches.get(on_date)
+        if cache is None:
+            is_past = on_date < datetime.now().date()
+            cache = SnapshotCache(
+                lambda: self.fetch_rates(on_date),
+                ttl=float('inf') if is_past else EXCHANGE_RATES_TTL,
+                stale_ttl=EXCHANGE_RATES_STALE_TTL
+            )
+            self._caches[on_date] = cache
+            while len(self._caches) > EXCHANGE_RATES_CACHED_DATES:
+                self._caches.popitem(last=False)
+        else:
+            self._caches.move_to_end(on_date)
+        return cache
+
+    async def get_rates(self, on_date: Optional[date] = None) -> Dict[str, float]:
+        """Курсы на дату (по умолчанию - сегодня)"""
+        on_date = on_date or datetime.now().date()
+        try:
+            # запрос к ЦБ продолжится в фоне и положит курсы в кэш, даже если мы перестали ждать
+            return await asyncio.wait_for(self._cache_for(on_date).get(), timeout=self.timeout)
+        except Exception as e:
+            if self._last_rates is None or on_date != datetime.now().date():
+                raise
+            print(f"🟡 ЦБ РФ не ответил ({type(e).__name__}: {e}), отдаем последние известные курсы")
+            return self._last_rates
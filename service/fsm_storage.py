@@ -0,0 +1,43 @@
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from service.shared_cache import LocalCache
+
+
+class SharedCacheStorage(BaseStorage):
+    """
+    Состояние FSM бота в общем кэше воркеров (service.shared_cache) вместо MemoryStorage:
+    диалог продолжается, даже если следующее обновление обработает другой воркер или процесс
+    """
+
+    def __init__(self, cache: LocalCache, key_builder: Optional[KeyBuilder] = None):
+        self.cache = cache
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        cache_key = self.key_builder.build(key, 'state')
+        if state is None:
+            await self.cache.delete(cache_key)
+        else:
+            await self.cache.set(cache_key, state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        entry = await self.cache.get(self.key_builder.build(key, 'state'))
+        return entry[0] if entry else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        cache_key = self.key_builder.build(key, 'data')
+        if not data:
+            await self.cache.delete(cache_key)
+        else:
+            await self.cache.set(cache_key, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        entry = await self.cache.get(self.key_builder.build(key, 'data'))
+        return entry[0] if entry else {}
+
+    async def close(self) -> None:
+        # общий кэш закрывает его владелец (lifespan API или воркер бота)
+        pass
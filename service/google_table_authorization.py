@@ -2,7 +2,19 @@ from gspread_asyncio import AsyncioGspreadClientManager
 from google.oauth2 import service_account
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
+from collections import Counter
+from typing import Dict, Optional
+import asyncio
+import functools
+import itertools
 import os
+import random
+import time
+
+import gspread
+import requests
+
+from service.request_stats import sheets_call
 
 
 
@@ -12,13 +24,226 @@ SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
 SAMPLE_SPREADSHEET_ID = os.getenv('sample_spreadsheet_id')
 
+# Квоты Google Sheets API считаются отдельно для чтения и записи (запросов в минуту на пользователя)
+SHEETS_READS_PER_MINUTE = float(os.getenv('SHEETS_READS_PER_MINUTE', 60))
+SHEETS_WRITES_PER_MINUTE = float(os.getenv('SHEETS_WRITES_PER_MINUTE', 60))
+SHEETS_BURST = float(os.getenv('SHEETS_BURST', 10))  # сколько запросов можно отправить подряд без ожидания
+SHEETS_MAX_IN_FLIGHT = int(os.getenv('SHEETS_MAX_IN_FLIGHT', 4))  # одновременных запросов к API
+SHEETS_MAX_RETRIES = int(os.getenv('SHEETS_MAX_RETRIES', 5))
+SHEETS_BACKOFF_BASE = float(os.getenv('SHEETS_BACKOFF_BASE', 1.0))
+SHEETS_BACKOFF_MAX = float(os.getenv('SHEETS_BACKOFF_MAX', 32.0))
+# Как часто (сек) обновлять OAuth токен в фоне, чтобы он не истекал посреди запроса (токен живет час)
+SHEETS_TOKEN_REFRESH_INTERVAL = float(os.getenv('SHEETS_TOKEN_REFRESH_INTERVAL', 40 * 60))
+
+# Методы gspread, которые расходуют квоту на чтение; все остальные считаются записью
+READ_METHODS = {
+    'acell', 'batch_get', 'cell', 'col_values', 'fetch_sheet_metadata', 'find', 'findall', 'get',
+    'get_all_records', 'get_all_values', 'get_values', 'open', 'open_by_key', 'open_by_url', 'range',
+    'row_values', 'values_batch_get', 'values_get', 'worksheet', 'worksheets',
+}
+
+# Записи, которые нельзя повторять после неоднозначной ошибки (сеть, 5xx): запрос мог примениться,
+# и повтор добавит строки еще раз. Для них повторяется только 429 - его квота отклоняет до записи
+NON_IDEMPOTENT_METHODS = {
+    'add_cols', 'add_rows', 'append_row', 'append_rows', 'insert_cols', 'insert_row', 'insert_rows', 'values_append',
+}
+
+# Чем меньше число, тем раньше запрос получает слот: записи пользователя важнее чтения выпадающих списков
+WRITE_PRIORITY = 0
+READ_PRIORITY = 1
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity накопленных"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Через сколько секунд появится токен (0 - уже есть)"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class SheetsCallScheduler:
+    """
+    Планировщик обращений к Google Sheets API.
+
+    - чтение и запись ограничиваются отдельными корзинами токенов (квоты API считаются отдельно);
+    - одновременно выполняется не больше max_in_flight запросов, слоты выдаются по приоритету
+      (записи раньше чтений), внутри приоритета - по очереди;
+    - 429 и 5xx повторяются с экспоненциальной задержкой со случайным разбросом
+      (добавление строк и колонок - только 429, см. NON_IDEMPOTENT_METHODS).
+    """
+
+    def __init__(self, reads_per_minute: float = SHEETS_READS_PER_MINUTE,
+                 writes_per_minute: float = SHEETS_WRITES_PER_MINUTE, burst: float = SHEETS_BURST,
+                 max_in_flight: int = SHEETS_MAX_IN_FLIGHT, max_retries: int = SHEETS_MAX_RETRIES):
+        self.buckets = {
+            'read': TokenBucket(reads_per_minute / 60, burst),
+            'write': TokenBucket(writes_per_minute / 60, burst),
+        }
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self._queue = []  # ожидающие запросы: [приоритет, номер, вид]
+        self._seq = itertools.count()
+        self._cond = None
+        self.throttled = Counter()  # сколько раз API ответил 429, по видам запросов
+        self.retries = Counter()  # сколько повторов сделано (429, 5xx, сетевые ошибки)
+        self.waited = Counter()  # сколько запросов ждали токен или слот
+
+    def stats(self) -> dict:
+        """Состояние планировщика: глубина очереди, выполняющиеся запросы, счетчики троттлинга"""
+        return {
+            'queue_depth': len(self._queue),
+            'queue_depth_by_kind': dict(Counter(kind for _, _, kind in self._queue)),
+            'in_flight': self.in_flight,
+            'throttled': dict(self.throttled),
+            'retries': dict(self.retries),
+            'waited': dict(self.waited),
+        }
+
+    @staticmethod
+    def kind_of(method_name: str) -> str:
+        return 'read' if method_name in READ_METHODS else 'write'
+
+    async def acquire(self, kind: str, priority: int):
+        """Ждет токен квоты и свободный слот"""
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        entry = [priority, next(self._seq), kind]
+        self._queue.append(entry)
+        waited = False
+        try:
+            async with self._cond:
+                while True:
+                    wait = self._try_grant(entry)
+                    if wait == 0:
+                        return
+                    waited = True
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            if waited:
+                self.waited[kind] += 1
+            if entry in self._queue:  # запрос отменили, пока он ждал
+                self._queue.remove(entry)
+
+    def _try_grant(self, entry: list) -> Optional[float]:
+        """
+        Выдает слот, если entry - первый по приоритету запрос, который можно выполнить сейчас.
+
+        :return: 0 - слот выдан, иначе сколько ждать до следующей проверки (None - до уведомления)
+        """
+        if self.in_flight >= self.max_in_flight:
+            return None
+        for candidate in sorted(self._queue):
+            bucket = self.buckets[candidate[2]]
+            wait = bucket.wait_time()
+            if wait > 0:
+                if candidate is entry:
+                    return wait
+                continue  # у этого вида запросов квота исчерпана, пропускаем вперед другой вид
+            if candidate is not entry:
+                return None  # первым должен пройти более приоритетный запрос
+            bucket.take()
+            self._queue.remove(entry)
+            self.in_flight += 1
+            self._cond.notify_all()
+            return 0
+        return None
+
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Экспоненциальная задержка со случайным разбросом (full jitter)"""
+        delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+
+# Один планировщик на процесс: квота Google общая для всех сервисов
+sheets_scheduler = SheetsCallScheduler()
+
+
+class ScheduledGspreadClientManager(AsyncioGspreadClientManager):
+    """
+    AsyncioGspreadClientManager, который вместо глобальной очереди с паузой gspread_delay между
+    вызовами пропускает запросы через SheetsCallScheduler (квоты, приоритеты, повторы)
+    """
+
+    def __init__(self, credentials_fn, scheduler: SheetsCallScheduler = sheets_scheduler, **kwargs):
+        super().__init__(credentials_fn, **kwargs)
+        self.scheduler = scheduler
+
+    async def _call(self, method, *args, **kwargs):
+        kwargs.pop('api_call_count', None)
+        kind = self.scheduler.kind_of(method.__name__)
+        priority = WRITE_PRIORITY if kind == 'write' else READ_PRIORITY
+        fn = functools.partial(method, *args, **kwargs)
+        # после ошибки сети или 5xx неизвестно, применился ли запрос - повторяем только идемпотентные
+        retry_ambiguous = method.__name__ not in NON_IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(kind, priority)
+            try:
+                await self.before_gspread_call(method, args, kwargs)
+                return await asyncio.get_running_loop().run_in_executor(None, fn)
+            except gspread.exceptions.APIError as e:
+                code = e.response.status_code
+                # 4xx, кроме 429, - ошибки запроса, повторять бессмысленно
+                if (400 <= code <= 499 and code != 429) or attempt >= self.scheduler.max_retries:
+                    raise
+                if code != 429 and not retry_ambiguous:
+                    raise
+                if code == 429:
+                    self.scheduler.throttled[kind] += 1
+                retry_after = e.response.headers.get('Retry-After')
+                delay = self.scheduler.backoff(attempt, float(retry_after) if retry_after and retry_after.isdigit() else None)
+            except requests.RequestException:
+                if attempt >= self.scheduler.max_retries or not retry_ambiguous:
+                    raise
+                delay = self.scheduler.backoff(attempt)
+            finally:
+                await self.scheduler.release()
+
+            self.scheduler.retries[kind] += 1
+            print(f"Google Sheets: повтор {method.__name__} через {delay:.1f} с (попытка {attempt + 1})")
+            await asyncio.sleep(delay)
+            attempt += 1
 
 
 class GoogleSheetsManager:
+    """
+    Подключение к таблице. Один экземпляр на процесс (shared_sheets_manager): авторизация,
+    открытая таблица и листы переиспользуются всеми сервисами
+    """
+
     def __init__(self):
-        self.client_manager = AsyncioGspreadClientManager(
+        self.client_manager = ScheduledGspreadClientManager(
             lambda: self._get_credentials()
         )
+        self._spreadsheet = None
+        self._worksheets: Dict[str, object] = {}
+        self._open_lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
 
     def _get_credentials(self):
         """Получение credentials из переменных окружения"""
@@ -71,7 +296,46 @@ class GoogleSheetsManager:
         return await self.client_manager.authorize()
 
     async def get_spreadsheet(self):
-        client = await self.get_client()
-        return await client.open_by_key(SAMPLE_SPREADSHEET_ID)
+        """Открытая таблица (open_by_key выполняется один раз на процесс)"""
+        if self._spreadsheet is None:
+            async with self._open_lock:
+                if self._spreadsheet is None:
+                    client = await self.get_client()
+                    self._spreadsheet = await sheets_call(client, 'open_by_key', SAMPLE_SPREADSHEET_ID)
+        return self._spreadsheet
+
+    async def get_worksheet(self, title: str):
+        """Лист таблицы по названию (запрашивается один раз на процесс)"""
+        if title not in self._worksheets:
+            spreadsheet = await self.get_spreadsheet()
+            self._worksheets[title] = await sheets_call(spreadsheet, 'worksheet', title)
+        return self._worksheets[title]
+
+    async def warm_up(self):
+        """Авторизация и открытие таблицы заранее (при старте приложения) + фоновое обновление токена"""
+        await self.get_spreadsheet()
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_token_loop())
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    async def _refresh_token_loop(self):
+        """Обновляет OAuth токен открытой таблицы до истечения, чтобы запрос пользователя не ждал обновления"""
+        while True:
+            await asyncio.sleep(SHEETS_TOKEN_REFRESH_INTERVAL)
+            try:
+                # в gspread 6 Spreadsheet.client - это HTTPClient, login() обновляет токен и заголовок Authorization
+                http_client = self._spreadsheet.ss.client
+                await asyncio.get_running_loop().run_in_executor(None, http_client.login)
+                print("Google Sheets: токен обновлен")
+            except Exception as e:
+                print(f"Google Sheets: ошибка обновления токена: {e}")
+
+
+# Общее подключение для всех сервисов процесса
+shared_sheets_manager = GoogleSheetsManager()
 
 
@@ -0,0 +1,82 @@
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Histogram, generate_latest
+from sqlalchemy import event
+
+from service.request_stats import add_span_listener, record_span
+
+
+# Границы корзин (сек): от быстрых SQL запросов до медленных ответов Sheets API с повторами
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+http_request_duration = Histogram(
+    'http_request_duration_seconds', 'Время обработки HTTP запроса',
+    ['method', 'route', 'status'], buckets=LATENCY_BUCKETS
+)
+sheets_call_duration = Histogram(
+    'sheets_call_duration_seconds', 'Время обращения к Google Sheets API (с ожиданием квоты и повторами)',
+    ['method', 'outcome'], buckets=LATENCY_BUCKETS
+)
+db_query_duration = Histogram(
+    'db_query_duration_seconds', 'Время выполнения SQL запроса',
+    ['statement'], buckets=LATENCY_BUCKETS
+)
+telegram_send_duration = Histogram(
+    'telegram_send_duration_seconds', 'Время отправки сообщения в Telegram',
+    ['outcome'], buckets=LATENCY_BUCKETS
+)
+cbr_fetch_duration = Histogram(
+    'cbr_fetch_duration_seconds', 'Время запроса курсов у ЦБ РФ',
+    ['outcome'], buckets=LATENCY_BUCKETS
+)
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+
+def render() -> bytes:
+    """Все метрики в текстовом формате Prometheus"""
+    return generate_latest()
+
+
+def _observe_span(kind: str, name: str, duration: float, outcome: str):
+    """Каждое внешнее обращение из трассы запроса попадает в гистограмму своего вида"""
+    if kind == 'sheets':
+        sheets_call_duration.labels(method=name, outcome=outcome).observe(duration)
+    elif kind == 'sql':
+        db_query_duration.labels(statement=_statement_kind(name)).observe(duration)
+    elif kind == 'telegram':
+        telegram_send_duration.labels(outcome=outcome).observe(duration)
+    elif kind == 'cbr':
+        cbr_fetch_duration.labels(outcome=outcome).observe(duration)
+
+
+add_span_listener(_observe_span)
+
+
+def _statement_kind(statement: str) -> str:
+    """Вид SQL запроса для метки (SELECT, INSERT, ...), чтобы число рядов метрики не зависело от текста запросов"""
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else 'UNKNOWN'
+
+
+def instrument_engine(engine):
+    """Подписывается на события движка SQLAlchemy: каждый запрос попадает в трассу HTTP запроса и в db_query_duration"""
+    sync_engine = getattr(engine, 'sync_engine', engine)
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        record_span('sql', ' '.join(statement.split()), started, time.perf_counter() - started)
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def _error(exception_context):
+        # запрос с ошибкой не доходит до after_cursor_execute - снимаем его отметку времени
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('query_started'):
+            started = conn.info['query_started'].pop()
+            record_span('sql', ' '.join((exception_context.statement or '').split()), started,
+                        time.perf_counter() - started, 'error')
@@ -0,0 +1,140 @@
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, List, Optional
+
+
+# Сколько отдельных обращений показывать в Server-Timing (остальные входят только в итог по виду)
+SERVER_TIMING_MAX_ENTRIES = 20
+# Сколько обращений попадает в отладочную трассу
+DEBUG_TRACE_MAX_SPANS = 100
+
+# Названия видов внешних обращений для Server-Timing (заголовок допускает только ASCII)
+SPAN_KINDS = {
+    'sheets': 'Google Sheets',
+    'sql': 'SQL',
+    'cbr': 'CBR',
+    'telegram': 'Telegram',
+}
+
+
+class RequestTrace:
+    """Внешние обращения в рамках одного HTTP запроса (или задания): вид, название, начало и длительность"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sheets_calls = Counter()  # обращения к Google Sheets API по методам gspread
+        self.spans: List[dict] = []
+
+    def add(self, kind: str, name: str, started: float, duration: float, outcome: str):
+        self.spans.append({
+            'kind': kind,
+            'name': name,
+            'start_ms': round((started - self.started) * 1000, 1),
+            'duration_ms': round(duration * 1000, 1),
+            'outcome': outcome,
+        })
+
+    def merge(self, other: Optional['RequestTrace']):
+        """Добавляет обращения, выполненные для этого запроса в другой задаче (например, в очереди заданий)"""
+        if other is None:
+            return
+        shift_ms = (other.started - self.started) * 1000
+        self.sheets_calls.update(other.sheets_calls)
+        self.spans.extend({**s, 'start_ms': round(s['start_ms'] + shift_ms, 1)} for s in other.spans)
+
+    def server_timing(self) -> str:
+        """
+        Значение заголовка Server-Timing: итог по каждому виду обращений, затем сами обращения по порядку
+        (например, 'sheets;dur=812.4;desc="Google Sheets x2", sheets.1;dur=530.1;desc="append_rows", ...')
+        """
+        entries = []
+        for kind, title in SPAN_KINDS.items():
+            spans = [s for s in self.spans if s['kind'] == kind]
+            if spans:
+                total = sum(s['duration_ms'] for s in spans)
+                entries.append(f'{kind};dur={total:.1f};desc="{title} x{len(spans)}"')
+        numbers = Counter()
+        for s in self.spans[:SERVER_TIMING_MAX_ENTRIES]:
+            numbers[s['kind']] += 1
+            entries.append(f'{s["kind"]}.{numbers[s["kind"]]};dur={s["duration_ms"]:.1f};desc={_quote(s["name"])}')
+        entries.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(entries)
+
+    def debug_json(self) -> str:
+        """Отладочная трасса запроса одной строкой JSON (для заголовка ответа)"""
+        return json.dumps({
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+            'sheets_calls': dict(self.sheets_calls),
+            'spans': self.spans[:DEBUG_TRACE_MAX_SPANS],
+            'truncated': max(len(self.spans) - DEBUG_TRACE_MAX_SPANS, 0),
+        }, ensure_ascii=True)
+
+
+def _quote(text: str) -> str:
+    # в заголовке допустимы только ASCII символы
+    text = text[:60].replace('\\', '\\\\').replace('"', '\\"')
+    return '"' + text.encode('ascii', 'backslashreplace').decode('ascii') + '"'
+
+
+_trace: ContextVar[Optional[RequestTrace]] = ContextVar('request_trace', default=None)
+# Подписчики на завершенные обращения (метрики), вызываются и вне HTTP запросов
+_span_listeners: List[Callable[[str, str, float, str], None]] = []
+
+
+def start_request_stats() -> RequestTrace:
+    """Начинает учет внешних обращений для текущего запроса (или задания)"""
+    trace = RequestTrace()
+    _trace.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _trace.get()
+
+
+def add_span_listener(listener: Callable[[str, str, float, str], None]):
+    """Подписка на каждое завершенное обращение: listener(вид, название, длительность в сек, ok/error)"""
+    _span_listeners.append(listener)
+
+
+def record_span(kind: str, name: str, started: float, duration: float, outcome: str = 'ok'):
+    """Учитывает одно внешнее обращение: в трассе текущего запроса и у подписчиков"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(kind, name, started, duration, outcome)
+    for listener in _span_listeners:
+        listener(kind, name, duration, outcome)
+
+
+@contextmanager
+def span(kind: str, name: str):
+    """
+    Замер внешнего обращения
+
+    with span('telegram', 'send_message'):
+        ...
+    """
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        record_span(kind, name, started, time.perf_counter() - started, outcome)
+
+
+def count_sheets_call(method: str):
+    """Учитывает одно обращение к Google Sheets API"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.sheets_calls[method] += 1
+
+
+async def sheets_call(target, method: str, *args, **kwargs):
+    """Вызывает метод gspread_asyncio (worksheet/spreadsheet) с учетом в счетчике и трассе запроса"""
+    count_sheets_call(method)
+    with span('sheets', method):
+        return await getattr(target, method)(*args, **kwargs)
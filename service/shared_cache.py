@@ -0,0 +1,307 @@
+import asyncio
+import fcntl
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import asynccontextmanager, closing
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from dotenv import find_dotenv, load_dotenv
+
+
+load_dotenv(find_dotenv())
+
+# Где воркеры API хранят общие снимки листов и состояние бота:
+# - local - в памяти процесса (как раньше, для одного воркера);
+# - sqlite - в файле SQLite, общем для воркеров на одной машине;
+# - postgres - в таблице shared_cache, сброс снимков у других воркеров через LISTEN/NOTIFY.
+SHARED_CACHE_BACKENDS = ('local', 'sqlite', 'postgres')
+SHARED_CACHE_BACKEND = os.getenv('SHARED_CACHE_BACKEND', 'local').lower()
+SHARED_CACHE_SQLITE_PATH = os.getenv('SHARED_CACHE_SQLITE_PATH', '/tmp/tg_app_shared_cache.sqlite3')
+# Как часто (сек) воркеры с SQLite проверяют журнал сбросов
+SHARED_CACHE_POLL_INTERVAL = float(os.getenv('SHARED_CACHE_POLL_INTERVAL', 1))
+SHARED_CACHE_CHANNEL = 'shared_cache'
+
+# Колбэк сброса: (ключ или None - сбросить все, время сброса по time.time())
+InvalidationListener = Callable[[Optional[str], float], None]
+
+
+class LocalCache:
+    """
+    Общий кэш в памяти процесса. Он же задает интерфейс для остальных бэкендов:
+
+    - get/set - значение (JSON) и время, с которого оно актуально (time.time() начала загрузки);
+    - invalidate - удаляет значения старше времени сброса и сообщает о сбросе остальным воркерам;
+    - lock - блокировка, общая для всех воркеров (одна загрузка листа и один писатель Balances).
+    """
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex  # свои сбросы, вернувшиеся из общего канала, пропускаем
+        self._values: Dict[str, Tuple[str, float]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._listeners: List[InvalidationListener] = []
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def add_listener(self, listener: InvalidationListener):
+        """Подписка на сбросы, сделанные другими воркерами"""
+        self._listeners.append(listener)
+
+    def _notify_listeners(self, key: Optional[str], at: float):
+        for listener in self._listeners:
+            try:
+                listener(key, at)
+            except Exception as e:
+                print(f"🟡 Общий кэш: ошибка обработки сброса {key}: {e}")
+
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        entry = self._values.get(key)
+        # значения хранятся как JSON, как и в остальных бэкендах: вызывающий получает свою копию
+        return (json.loads(entry[0]), entry[1]) if entry else None
+
+    async def set(self, key: str, value: Any, stored_at: Optional[float] = None):
+        self._values[key] = (json.dumps(value, ensure_ascii=False), stored_at or time.time())
+
+    async def delete(self, key: str):
+        self._values.pop(key, None)
+
+    async def invalidate(self, key: str, at: Optional[float] = None):
+        at = at or time.time()
+        entry = self._values.get(key)
+        if entry and entry[1] < at:
+            del self._values[key]
+
+    @asynccontextmanager
+    async def lock(self, name: str):
+        async with self._locks.setdefault(name, asyncio.Lock()):
+            yield
+
+
+class SQLiteCache(LocalCache):
+    """
+    Общий кэш в файле SQLite для воркеров на одной машине.
+
+    Запросы к файлу выполняются в потоке; о сбросах воркеры узнают из журнала invalidations,
+    который проверяют раз в SHARED_CACHE_POLL_INTERVAL; блокировки - flock на файлах рядом с базой.
+    """
+
+    def __init__(self, path: str = SHARED_CACHE_SQLITE_PATH):
+        super().__init__()
+        self.path = path
+        self._last_invalidation_id = 0
+        self._task: Optional[asyncio.Task] = None
+        self._execute_sync('PRAGMA journal_mode=WAL')  # читатели не ждут писателя
+        self._execute_sync(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)'
+        )
+        self._execute_sync(
+            'CREATE TABLE IF NOT EXISTS invalidations '
+            '(id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, key TEXT NOT NULL, at REAL NOT NULL)'
+        )
+
+    def _execute_sync(self, sql: str, params: tuple = ()) -> list:
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            return conn.execute(sql, params).fetchall()
+
+    async def _execute(self, sql: str, params: tuple = ()) -> list:
+        return await asyncio.to_thread(self._execute_sync, sql, params)
+
+    async def start(self):
+        if self._task is None:
+            rows = await self._execute('SELECT COALESCE(MAX(id), 0) FROM invalidations')
+            self._last_invalidation_id = rows[0][0]
+            self._task = asyncio.create_task(self._poll_invalidations())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _poll_invalidations(self):
+        while True:
+            try:
+                rows = await self._execute(
+                    'SELECT id, origin, key, at FROM invalidations WHERE id > ? ORDER BY id',
+                    (self._last_invalidation_id,)
+                )
+                for invalidation_id, origin, key, at in rows:
+                    self._last_invalidation_id = invalidation_id
+                    if origin != self.origin:
+                        self._notify_listeners(key, at)
+            except Exception as e:
+                print(f"🟡 Общий кэш SQLite: не удалось прочитать журнал сбросов: {e}")
+            await asyncio.sleep(SHARED_CACHE_POLL_INTERVAL)
+
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        rows = await self._execute('SELECT value, stored_at FROM cache WHERE key = ?', (key,))
+        return (json.loads(rows[0][0]), rows[0][1]) if rows else None
+
+    async def set(self, key: str, value: Any, stored_at: Optional[float] = None):
+        await self._execute(
+            'INSERT INTO cache (key, value, stored_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value, stored_at = excluded.stored_at',
+            (key, json.dumps(value, ensure_ascii=False), stored_at or time.time())
+        )
+
+    async def delete(self, key: str):
+        await self._execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    async def invalidate(self, key: str, at: Optional[float] = None):
+        at = at or time.time()
+        await self._execute('DELETE FROM cache WHERE key = ? AND stored_at < ?', (key, at))
+        await self._execute('INSERT INTO invalidations (origin, key, at) VALUES (?, ?, ?)', (self.origin, key, at))
+        # журнал нужен только воркерам, которые еще не прочитали последние сбросы
+        await self._execute('DELETE FROM invalidations WHERE at < ?', (at - 3600,))
+
+    @asynccontextmanager
+    async def lock(self, name: str):
+        # сначала внутри процесса, затем между процессами (flock без ожидания в потоке)
+        async with super().lock(name):
+            with open(f'{self.path}.{name.replace(":", "_")}.lock', 'a') as lock_file:
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        await asyncio.sleep(0.05)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class PostgresCache(LocalCache):
+    """
+    Общий кэш в таблице shared_cache.
+
+    Сбросы рассылаются через NOTIFY в одной транзакции с удалением значения; каждый воркер держит
+    отдельное соединение с LISTEN. После разрыва этого соединения воркер сбрасывает все свои снимки,
+    так как мог пропустить уведомления. Блокировки - pg_advisory_xact_lock на отдельном соединении.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _on_notification(self, connection, pid, channel, payload: str):
+        message = json.loads(payload)
+        if message['origin'] != self.origin:
+            self._notify_listeners(message['key'], message['at'])
+
+    async def _listen(self):
+        from models.models import engine
+
+        while True:
+            raw = None
+            try:
+                raw = await engine.raw_connection()
+                connection = raw.driver_connection
+                lost = asyncio.Event()
+                connection.add_termination_listener(lambda _: lost.set())
+                await connection.add_listener(SHARED_CACHE_CHANNEL, self._on_notification)
+                print("✅ Общий кэш Postgres: подписка на сбросы (LISTEN)")
+                await lost.wait()
+                print("🟡 Общий кэш Postgres: соединение LISTEN потеряно")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"🟡 Общий кэш Postgres: не удалось подписаться на сбросы: {e}")
+            finally:
+                if raw is not None:
+                    try:
+                        raw.invalidate()  # соединение с LISTEN не возвращаем в общий пул
+                    except Exception:
+                        pass
+            # пока подписки не было, уведомления могли потеряться - сбрасываем все
+            self._notify_listeners(None, time.time())
+            await asyncio.sleep(5)
+
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        from models.models import async_session, SharedCacheEntry
+
+        async with async_session() as session:
+            entry = await session.get(SharedCacheEntry, key)
+            return (entry.value, entry.stored_at) if entry else None
+
+    async def set(self, key: str, value: Any, stored_at: Optional[float] = None):
+        from sqlalchemy.dialects.postgresql import insert
+        from models.models import async_session, SharedCacheEntry
+
+        stmt = insert(SharedCacheEntry).values(key=key, value=value, stored_at=stored_at or time.time())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SharedCacheEntry.key],
+            set_={'value': stmt.excluded.value, 'stored_at': stmt.excluded.stored_at}
+        )
+        async with async_session() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+    async def delete(self, key: str):
+        from sqlalchemy import delete
+        from models.models import async_session, SharedCacheEntry
+
+        async with async_session() as session:
+            await session.execute(delete(SharedCacheEntry).where(SharedCacheEntry.key == key))
+            await session.commit()
+
+    async def invalidate(self, key: str, at: Optional[float] = None):
+        from sqlalchemy import delete, func, select
+        from models.models import async_session, SharedCacheEntry
+
+        at = at or time.time()
+        payload = json.dumps({'origin': self.origin, 'key': key, 'at': at})
+        async with async_session() as session:
+            await session.execute(
+                delete(SharedCacheEntry).where(SharedCacheEntry.key == key, SharedCacheEntry.stored_at < at)
+            )
+            # уведомление уходит при commit, вместе с удалением
+            await session.execute(select(func.pg_notify(SHARED_CACHE_CHANNEL, payload)))
+            await session.commit()
+
+    @asynccontextmanager
+    async def lock(self, name: str):
+        from sqlalchemy import func, select
+        from models.models import engine
+
+        async with super().lock(name):
+            # блокировка на время транзакции: снимается при ее завершении, даже если соединение оборвалось
+            async with engine.connect() as conn:
+                await conn.execute(select(func.pg_advisory_xact_lock(func.hashtext(name))))
+                yield
+
+
+def create_shared_cache(backend: str = SHARED_CACHE_BACKEND) -> LocalCache:
+    if backend == 'local':
+        return LocalCache()
+    if backend == 'sqlite':
+        return SQLiteCache()
+    if backend == 'postgres':
+        return PostgresCache()
+    raise ValueError(f"SHARED_CACHE_BACKEND должен быть одним из {', '.join(SHARED_CACHE_BACKENDS)}, получено: {backend}")
+
+
+# Общий кэш процесса: снимки листов Ledger/Balances и состояние бота (FSM)
+shared_cache = create_shared_cache()
@@ -0,0 +1,57 @@
+from typing import Callable, Dict, List
+
+from gspread.utils import absolute_range_name
+
+from service.request_stats import count_sheets_call, span
+
+
+class SheetsTransaction:
+    """
+    Набор изменений ячеек на нескольких листах одной таблицы.
+
+    Изменения копятся локально и записываются одним запросом spreadsheets.values.batchUpdate:
+    либо применяются все, либо (при ошибке запроса) ни одно.
+    """
+
+    def __init__(self, value_input_option: str = 'USER_ENTERED'):
+        self.value_input_option = value_input_option
+        self._changes: Dict[str, dict] = {}  # абсолютный диапазон -> изменение, повторная запись заменяет прежнюю
+        self._after_commit: List[Callable[[], None]] = []
+
+    def __len__(self):
+        return len(self._changes)
+
+    def set(self, sheet_name: str, range_name: str, values: List[List]):
+        """Добавляет запись значений в диапазон листа (например, 'Balances', 'C5', [[100]])"""
+        full_range = absolute_range_name(sheet_name, range_name)
+        self._changes[full_range] = {'range': full_range, 'values': values}
+
+    def after_commit(self, callback: Callable[[], None]):
+        """Регистрирует действие, которое выполнится после успешной записи"""
+        self._after_commit.append(callback)
+
+    def merge(self, other: 'SheetsTransaction'):
+        """Переносит к себе изменения и действия после записи другой транзакции (ее изменения - поверх наших)"""
+        self._changes.update(other._changes)
+        self._after_commit.extend(other._after_commit)
+
+    async def commit(self, spreadsheet):
+        """
+        Записывает все изменения одним запросом
+
+        :param spreadsheet: AsyncioGspreadSpreadsheet таблицы, в которой лежат листы
+        """
+        if self._changes:
+            body = {
+                'valueInputOption': self.value_input_option,
+                'data': list(self._changes.values())
+            }
+            count_sheets_call('values_batch_update')
+            # gspread_asyncio не оборачивает values_batch_update, вызываем через его менеджер (очередь и повторы)
+            with span('sheets', 'values_batch_update'):
+                await spreadsheet.agcm._call(spreadsheet.ss.values_batch_update, body)
+            self._changes = {}
+
+        for callback in self._after_commit:
+            callback()
+        self._after_commit = []
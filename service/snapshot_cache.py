@@ -0,0 +1,113 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+
+class SnapshotCache:
+    """
+    Кэш снимка данных таблицы в памяти процесса.
+
+    - пока снимок моложе ttl, он отдаётся из памяти без обращений к Google Sheets;
+    - в окне ttl + stale_ttl отдаётся старый снимок, а обновление запускается в фоне (stale-while-revalidate);
+    - после invalidate() следующий запрос ждёт свежую загрузку;
+    - параллельные промахи кэша схлопываются в одну загрузку.
+
+    С общим кэшем (shared, key) снимок делят все воркеры: при промахе сначала берется снимок,
+    загруженный другим воркером, загрузку из таблицы ведет один воркер под общей блокировкой,
+    а invalidate() сбрасывает снимок у всех.
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[Any]], ttl: float = 60.0, stale_ttl: float = 600.0,
+                 shared=None, key: Optional[str] = None):
+        self._loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._value: Any = None
+        self._loaded_at: Optional[float] = None
+        self._version = 0  # увеличивается при invalidate, чтобы не сохранить снимок, прочитанный до записи
+        self._task: Optional[asyncio.Task] = None
+        self._task_version = -1
+        self._shared = shared
+        self.key = key
+        self._invalidated_at = 0.0  # time.time() последнего сброса: более старые общие снимки не берем
+        if shared is not None:
+            shared.add_listener(self._on_shared_invalidate)
+
+    async def get(self) -> Any:
+        """Возвращает снимок из памяти или загружает его"""
+        if self._loaded_at is not None:
+            age = time.monotonic() - self._loaded_at
+            if age < self.ttl:
+                return self._value
+            if age < self.ttl + self.stale_ttl:
+                self._ensure_task()  # обновляем в фоне, отдаем то, что есть
+                return self._value
+
+        # shield: отмена одного запроса не должна отменять общую загрузку
+        return await asyncio.shield(self._ensure_task())
+
+    def invalidate(self):
+        """Сбрасывает снимок после записи в таблицу (с общим кэшем - у всех воркеров)"""
+        self._invalidate_local(time.time())
+        if self._shared is not None:
+            task = asyncio.get_running_loop().create_task(self._shared.invalidate(self.key, self._invalidated_at))
+            task.add_done_callback(self._log_error)
+
+    def _invalidate_local(self, at: float):
+        self._version += 1
+        self._loaded_at = None
+        self._invalidated_at = max(self._invalidated_at, at)
+
+    def _on_shared_invalidate(self, key: Optional[str], at: float):
+        if key is None or key == self.key:
+            self._invalidate_local(at)
+
+    def _ensure_task(self) -> asyncio.Task:
+        if self._task is None or self._task.done() or self._task_version != self._version:
+            self._task_version = self._version
+            self._task = asyncio.create_task(self._load(self._version))
+            self._task.add_done_callback(self._log_error)
+        return self._task
+
+    async def _load(self, version: int) -> Any:
+        if self._shared is None:
+            value = await self._loader()
+            loaded_at = time.monotonic()
+        else:
+            value, loaded_at = await self._load_shared()
+        if version == self._version:
+            self._value = value
+            self._loaded_at = loaded_at
+        return value
+
+    async def _load_shared(self):
+        """Снимок другого воркера, если он свежий и загружен после последнего сброса, иначе загрузка из таблицы"""
+        loaded = False
+        try:
+            async with self._shared.lock(f'snapshot:{self.key}'):
+                entry = await self._shared.get(self.key)
+                if entry is not None:
+                    value, stored_at = entry
+                    age = time.time() - stored_at
+                    if stored_at >= self._invalidated_at and age < self.ttl:
+                        return value, time.monotonic() - max(age, 0)
+
+                started = time.time()
+                loaded = True
+                value = await self._loader()
+                try:
+                    await self._shared.set(self.key, value, stored_at=started)
+                except Exception as e:
+                    print(f"🟡 Снимок {self.key} не сохранен в общий кэш: {e}")
+                return value, time.monotonic() - (time.time() - started)
+        except Exception as e:
+            if loaded:
+                raise
+            # общий кэш недоступен - загружаем снимок только для этого воркера
+            print(f"🟡 Общий кэш недоступен для {self.key}: {e}")
+            return await self._loader(), time.monotonic()
+
+    @staticmethod
+    def _log_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Ошибка обновления снимка кэша: {task.exception()}")
@@ -0,0 +1,123 @@
+import asyncio
+import hmac
+import os
+from typing import Optional, Set
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+from dotenv import find_dotenv, load_dotenv
+
+from service.fsm_storage import SharedCacheStorage
+from service.shared_cache import shared_cache
+
+
+load_dotenv(find_dotenv())
+
+# Где получает обновления бот Lora:
+# - off (по умолчанию) - бот обновления не получает, как раньше (отправка сообщений в чат работает во всех режимах);
+# - polling - long polling в процессе API (только с одним воркером uvicorn; снимает зарегистрированный webhook);
+# - webhook - Telegram присылает обновления на POST /api/telegram/webhook, API можно запускать в N воркеров;
+# - worker - long polling в отдельном процессе (python bot_worker.py), API обновления не получает.
+BOT_MODES = ('off', 'polling', 'webhook', 'worker')
+BOT_MODE = os.getenv('BOT_MODE', 'off').lower()
+if BOT_MODE not in BOT_MODES:
+    raise ValueError(f"BOT_MODE должен быть одним из {', '.join(BOT_MODES)}, получено: {BOT_MODE}")
+
+# Для режима webhook: публичный адрес маршрута (регистрируется при старте) и секрет из заголовка Telegram
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+if BOT_MODE == 'webhook' and not TELEGRAM_WEBHOOK_SECRET:
+    # без секрета любой, кто знает адрес, может прислать боту поддельное обновление
+    raise ValueError("Для BOT_MODE=webhook нужен TELEGRAM_WEBHOOK_SECRET")
+# Другой адрес Bot API (локальный сервер Bot API или заглушка в бенчмарках), по умолчанию - api.telegram.org
+TELEGRAM_API_BASE = os.getenv('TELEGRAM_API_BASE')
+
+bot = Bot(
+    token=os.getenv('TOKEN_Lora'),
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE)) if TELEGRAM_API_BASE else None
+)
+
+router = Router()
+# состояние диалогов - в общем кэше: его видят все воркеры API и отдельный процесс бота
+storage = SharedCacheStorage(shared_cache)
+dp = Dispatcher(storage=storage)
+dp.include_router(router)
+
+# Обновления из webhook обрабатываются в фоне, ссылки на задачи держим до их завершения
+_update_tasks: Set[asyncio.Task] = set()
+_polling_task: Optional[asyncio.Task] = None
+
+
+async def start_polling():
+    """Long polling в текущем event loop (режим polling) - в фоне, до stop_bot"""
+    global _polling_task
+    # пока у бота зарегистрирован webhook, getUpdates отвечает ошибкой
+    await bot.delete_webhook()
+    _polling_task = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+    print("✅ Бот Lora: long polling в процессе API")
+
+
+async def set_webhook():
+    """Регистрация webhook (режим webhook). Без TELEGRAM_WEBHOOK_URL считаем, что он уже зарегистрирован"""
+    if not TELEGRAM_WEBHOOK_URL:
+        print("🟡 Бот Lora: TELEGRAM_WEBHOOK_URL не задан, webhook не регистрируем")
+        return
+    await bot.set_webhook(
+        TELEGRAM_WEBHOOK_URL,
+        secret_token=TELEGRAM_WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    print(f"✅ Бот Lora: webhook {TELEGRAM_WEBHOOK_URL}")
+
+
+async def start_bot():
+    """Запуск получения обновлений в процессе API по BOT_MODE"""
+    try:
+        if BOT_MODE == 'polling':
+            await start_polling()
+        elif BOT_MODE == 'webhook':
+            await set_webhook()
+        else:
+            print(f"Бот Lora: BOT_MODE={BOT_MODE}, в процессе API обновления не получаем")
+    except Exception as e:
+        print(f"🔴 Не удалось запустить бота Lora: {e}")
+
+
+async def stop_bot():
+    global _polling_task
+    if _polling_task is not None:
+        _polling_task.cancel()
+        try:
+            await _polling_task
+        except asyncio.CancelledError:
+            pass
+        _polling_task = None
+    if _update_tasks:
+        await asyncio.gather(*_update_tasks, return_exceptions=True)
+    await bot.session.close()
+
+
+def check_webhook_secret(secret: Optional[str]) -> bool:
+    """Заголовок X-Telegram-Bot-Api-Secret-Token совпадает с секретом, заданным при регистрации webhook"""
+    if not TELEGRAM_WEBHOOK_SECRET:
+        return False  # без секрета обновления не принимаем
+    return secret is not None and hmac.compare_digest(secret, TELEGRAM_WEBHOOK_SECRET)
+
+
+def feed_webhook_update(data: dict):
+    """
+    Обработка обновления из webhook в фоне: Telegram сразу получает ответ,
+    а обработчики бота не задерживают ответ webhook
+    """
+    update = Update.model_validate(data, context={'bot': bot})
+    task = asyncio.create_task(dp.feed_update(bot, update))
+    _update_tasks.add(task)
+    task.add_done_callback(_update_done)
+
+
+def _update_done(task: asyncio.Task):
+    _update_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"🔴 Бот Lora: ошибка обработки обновления: {task.exception()}")
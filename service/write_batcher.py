@@ -0,0 +1,62 @@
+import asyncio
+from typing import Awaitable, Callable, List, Tuple
+
+
+class RowWriteBatcher:
+    """
+    Очередь отложенной записи строк (write-behind).
+
+    Строки, пришедшие в течение короткого окна, записываются в таблицу одним запросом.
+    Номера строк выдаются по порядку постановки в очередь: первая строка пачки получает
+    номер, который вернула запись, следующие - по возрастанию. Каждый вызывающий получает
+    номер своей строки (или исключение, если запись пачки не удалась).
+    """
+
+    def __init__(self, flush_rows: Callable[[List[List]], Awaitable[int]], window: float = 0.05, max_batch: int = 50):
+        """
+        :param flush_rows: Корутина записи пачки строк, возвращает номер первой записанной строки
+        :param window: Сколько секунд копить строки перед записью
+        :param max_batch: Максимум строк в одном запросе
+        """
+        self._flush_rows = flush_rows
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: List[Tuple[List, asyncio.Future]] = []
+        self._task = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    async def submit(self, row: List) -> int:
+        """Ставит строку в очередь и ждет номер строки, в которую она записана"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        try:
+            await asyncio.sleep(self.window)
+            # пока пишется одна пачка, следующие строки копятся и уходят следующим запросом
+            while self._pending:
+                batch = self._pending[:self.max_batch]
+                self._pending = self._pending[self.max_batch:]
+                await self._flush(batch)
+        finally:
+            self._task = None
+
+    async def _flush(self, batch: List[Tuple[List, asyncio.Future]]):
+        try:
+            first_row = await self._flush_rows([row for row, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        print(f"Записано строк одним запросом: {len(batch)}, начиная со строки {first_row}")
+        for i, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(first_row + i)
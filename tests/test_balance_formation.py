@@ -0,0 +1,176 @@
+"""
+Обновление листа Balances на таблице в памяти (benchmarks.fake_sheets).
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+
+from benchmarks.fake_sheets import CURRENCIES, INSTANCES, FakeSheetsManager, make_spreadsheet
+from handlers.balance_formation import GoogleSheetsBalanceUpdater
+from service.shared_cache import LocalCache
+from service.sheets_transaction import SheetsTransaction
+
+
+def make_updater():
+    spreadsheet = make_spreadsheet(10)
+    updater = GoogleSheetsBalanceUpdater(manager=FakeSheetsManager(spreadsheet), cache=LocalCache())
+    return spreadsheet, updater
+
+
+def cell(spreadsheet, instance: str, currency: str) -> str:
+    """Значение ячейки Balances по названию строки (колонка 'Инстанс') и валюте (строка валют)"""
+    rows = spreadsheet.sheets['Balances'].rows
+    header_row = next(i for i, row in enumerate(rows) if 'Инстанс' in row)
+    col = rows[header_row + 1].index(currency)
+    row = next(row for row in rows if len(row) > 1 and row[1] == instance)
+    return row[col] if col < len(row) else ''
+
+
+def test_new_instance_does_not_shift_other_changes_of_the_batch():
+    """Вставка строки нового инстанса не должна сдвигать адреса уже подготовленных изменений"""
+    spreadsheet, updater = make_updater()
+
+    async def scenario():
+        await updater.initialize()
+        return await updater.update_balances([
+            {'Инстанс': 'Наличные', 'Валюта': 'RUB', 'Сумма': 100},
+            {'Инстанс': 'Новый банк', 'Валюта': 'RUB', 'Сумма': -100},
+        ], SheetsTransaction())
+
+    messages = asyncio.run(scenario())
+
+    assert all(message.startswith('✅') for message in messages), messages
+    assert cell(spreadsheet, 'Наличные', 'RUB') == '1 000 100,00'
+    assert cell(spreadsheet, 'Новый банк', 'RUB') == '-100,00'
+    for instance in INSTANCES:
+        if instance != 'Наличные':
+            assert cell(spreadsheet, instance, 'RUB') == '1 000 000,00', instance
+    # сумма не изменилась: +100 и -100
+    assert cell(spreadsheet, 'Всего', 'RUB') == '7 000 000,00'
+    assert cell(spreadsheet, 'Всего', 'USD') == '7 000 000,00'
+
+
+def test_new_currency_and_instance_in_one_batch():
+    """Новая колонка валюты и новая строка в одной записи: значения попадают в свои ячейки"""
+    spreadsheet, updater = make_updater()
+
+    async def scenario():
+        await updater.initialize()
+        return await updater.update_balances([
+            {'Инстанс': 'Счет ИП', 'Валюта': 'RUB', 'Сумма': 50},
+            {'Инстанс': 'Новый банк', 'Валюта': 'CNY', 'Сумма': 30},
+            {'Инстанс': 'Наличные', 'Валюта': 'CNY', 'Сумма': -30},
+        ], SheetsTransaction())
+
+    messages = asyncio.run(scenario())
+
+    assert all(message.startswith('✅') for message in messages), messages
+    assert cell(spreadsheet, 'Счет ИП', 'RUB') == '1 000 050,00'
+    assert cell(spreadsheet, 'Новый банк', 'CNY') == '30,00'
+    assert cell(spreadsheet, 'Наличные', 'CNY') == '-30,00'
+    assert cell(spreadsheet, 'Всего', 'RUB') == '7 000 050,00'
+    assert cell(spreadsheet, 'Всего', 'CNY') == '0,00'
+    for currency in CURRENCIES:
+        assert cell(spreadsheet, 'Наличные', currency) == '1 000 000,00', currency
+
+
+def test_failed_transaction_drops_the_whole_job():
+    """Задание с ошибкой не пишет ни балансы, ни изменения других листов: повтор не зачтет сумму дважды"""
+    spreadsheet, updater = make_updater()
+
+    async def scenario():
+        await updater.initialize()
+        sheets_tx = SheetsTransaction()
+        sheets_tx.set('Ledger', 'M2', [['✓ баланс, web']])
+        return await updater.update_balances([
+            {'Инстанс': 'Наличные', 'Валюта': 'RUB', 'Сумма': 100},
+            {'Инстанс': 'Счет ИП', 'Валюта': 'RUB', 'Сумма': 'сто'},
+        ], sheets_tx)
+
+    messages = asyncio.run(scenario())
+
+    assert all(message.startswith('❌') for message in messages), messages
+    assert cell(spreadsheet, 'Наличные', 'RUB') == '1 000 000,00'
+    assert cell(spreadsheet, 'Всего', 'RUB') == '7 000 000,00'
+    assert spreadsheet.sheets['Ledger'].rows[1][12] == '✓ баланс'
+    assert spreadsheet.calls['values_batch_update'] == 0
+
+
+def test_concurrent_jobs_share_one_write():
+    """Задания, пришедшие во время записи, уходят следующим писателем одним запросом вместе с их sheets_tx"""
+    spreadsheet, updater = make_updater()
+    spreadsheet.latency = 0.01
+    committed = []
+
+    async def job(i: int):
+        sheets_tx = SheetsTransaction()
+        sheets_tx.set('Ledger', f'M{i + 2}', [['✓ баланс, web']])
+        sheets_tx.after_commit(lambda: committed.append(i))
+        return await updater.update_balances([
+            {'Инстанс': 'Наличные', 'Валюта': 'RUB', 'Сумма': 10},
+            {'Инстанс': 'Счет ИП', 'Валюта': 'RUB', 'Сумма': -10},
+        ], sheets_tx)
+
+    async def scenario():
+        await updater.initialize()
+        return await asyncio.gather(*(job(i) for i in range(5)))
+
+    results = asyncio.run(scenario())
+
+    assert all(message.startswith('✅') for messages in results for message in messages), results
+    assert cell(spreadsheet, 'Наличные', 'RUB') == '1 000 050,00'
+    assert cell(spreadsheet, 'Счет ИП', 'RUB') == '999 950,00'
+    assert cell(spreadsheet, 'Всего', 'RUB') == '7 000 000,00'
+    assert sorted(committed) == list(range(5))
+    assert all(spreadsheet.sheets['Ledger'].rows[i + 1][12] == '✓ баланс, web' for i in range(5))
+    # задания не пишутся каждое своим запросом
+    assert spreadsheet.calls['values_batch_update'] < 5
+
+
+def test_padded_currency_adds_one_column_and_bad_job_fails_alone():
+    """' CNY ' и 'CNY' в одной записи - одна новая колонка; задание с ошибкой не мешает остальным"""
+    spreadsheet, updater = make_updater()
+
+    async def scenario():
+        await updater.initialize()
+        loop = asyncio.get_running_loop()
+        jobs = [
+            ([{'Инстанс': 'Наличные', 'Валюта': ' CNY ', 'Сумма': 30}], None, loop.create_future()),
+            ([{'Инстанс': 'Счет ИП', 'Валюта': 'RUB', 'Сумма': 'сто'}], None, loop.create_future()),
+            ([{'Инстанс': 'Счет ИП', 'Валюта': 'CNY', 'Сумма': -30}], None, loop.create_future()),
+        ]
+        # все три задания уходят одним писателем
+        updater._pending.extend(jobs)
+        await updater._drain()
+        return [job[2].result() for job in jobs]
+
+    first, bad, third = asyncio.run(scenario())
+
+    assert first[0].startswith('✅') and third[0].startswith('✅'), (first, third)
+    assert bad[0].startswith('❌'), bad
+    currencies = spreadsheet.sheets['Balances'].rows
+    header_row = next(i for i, row in enumerate(currencies) if 'Инстанс' in row) + 1
+    assert [c.strip() for c in currencies[header_row]].count('CNY') == 1
+    assert cell(spreadsheet, 'Наличные', 'CNY') == '30,00'
+    assert cell(spreadsheet, 'Счет ИП', 'CNY') == '-30,00'
+    assert cell(spreadsheet, 'Счет ИП', 'RUB') == '1 000 000,00'
+    assert cell(spreadsheet, 'Всего', 'CNY') == '0,00'
+
+
+def test_resync_checks_total_cell(capsys):
+    """Итог, поправленный в таблице вручную, замечается при чтении листа и заменяется суммой колонки"""
+    spreadsheet, updater = make_updater()
+    rows = spreadsheet.sheets['Balances'].rows
+    header_row = next(i for i, row in enumerate(rows) if 'Инстанс' in row)
+    total_row = next(row for row in rows if len(row) > 1 and row[1] == 'Всего')
+    total_row[rows[header_row + 1].index('RUB')] = '1,00'
+
+    async def scenario():
+        await updater.initialize()
+        return await updater.update_balance({'Инстанс': 'Наличные', 'Валюта': 'RUB', 'Сумма': 100})
+
+    message = asyncio.run(scenario())
+
+    assert message.startswith('✅'), message
+    assert "Итог 'Всего' по RUB в таблице (1,00) не совпадает" in capsys.readouterr().out
+    assert cell(spreadsheet, 'Всего', 'RUB') == '7 000 100,00'
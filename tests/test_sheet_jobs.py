@@ -0,0 +1,169 @@
+"""
+Очередь заданий sheet_jobs: Idempotency-Key, возврат брошенных заданий, отметки heartbeat.
+
+Очередь использует возможности Postgres (ON CONFLICT, FOR UPDATE SKIP LOCKED), поэтому тесты идут
+на отдельной базе из TEST_DATABASE_URL (например, postgresql+asyncpg://postgres@localhost/hcl_test)
+и пропускаются, если она не задана.
+
+Запуск: TEST_DATABASE_URL=... python -m pytest tests
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+if not TEST_DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL не задан", allow_module_level=True)
+
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from handlers import sheet_jobs
+from handlers.sheet_jobs import IdempotencyKeyMismatch, SheetJobQueue
+from models.models import Base, IdempotencyKey, SheetJob, WORKER_ID, _add_columns
+
+
+def run(monkeypatch, scenario):
+    """Выполняет сценарий с очередью на тестовой базе"""
+    async def main():
+        engine = create_async_engine(TEST_DATABASE_URL)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all, tables=[SheetJob.__table__, IdempotencyKey.__table__])
+            await conn.run_sync(_add_columns)
+        session_factory = async_sessionmaker(engine, expire_on_commit=False)
+        monkeypatch.setattr(sheet_jobs, 'async_session', session_factory)
+        try:
+            return await scenario(session_factory)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(main())
+
+
+def make_queue(handler=None, max_attempts: int = 1) -> SheetJobQueue:
+    async def done(payload, progress, save_progress):
+        return {'payload': payload}
+
+    # у каждого теста свой kind: задания других тестов и запусков очередь не видит
+    return SheetJobQueue(f'test_{uuid.uuid4().hex[:8]}', handler or done, max_attempts=max_attempts)
+
+
+async def get_job(session_factory, job_id: int) -> SheetJob:
+    async with session_factory() as session:
+        return await session.get(SheetJob, job_id)
+
+
+def test_idempotency_key_replays_the_same_job(monkeypatch):
+    async def scenario(session_factory):
+        queue = make_queue()
+        first = await queue.enqueue({'row': 1}, 'key-1')
+        cached = await queue.enqueue({'row': 1}, 'key-1')
+        # другой воркер (пустой кэш ключей) находит ключ в базе
+        other_worker = SheetJobQueue(queue.kind, queue.handler)
+        from_db = await other_worker.enqueue({'row': 1}, 'key-1')
+        return first, cached, from_db
+
+    first, cached, from_db = run(monkeypatch, scenario)
+
+    assert first[1] is True
+    assert cached == (first[0], False)
+    assert from_db == (first[0], False)
+
+
+def test_idempotency_key_with_other_payload_is_rejected(monkeypatch):
+    async def scenario(session_factory):
+        queue = make_queue()
+        await queue.enqueue({'row': 1}, 'key-1')
+        with pytest.raises(IdempotencyKeyMismatch):
+            await queue.enqueue({'row': 2}, 'key-1')
+        with pytest.raises(IdempotencyKeyMismatch):
+            await SheetJobQueue(queue.kind, queue.handler).enqueue({'row': 2}, 'key-1')
+
+    run(monkeypatch, scenario)
+
+
+def test_idempotency_key_of_failed_job_moves_to_new_job(monkeypatch):
+    async def fail(payload, progress, save_progress):
+        raise RuntimeError('Sheets недоступен')
+
+    async def scenario(session_factory):
+        queue = make_queue(fail)
+        failed_id, _ = await queue.enqueue({'row': 1}, 'key-1')
+        await queue.process_once()
+        retried = await queue.enqueue({'row': 1}, 'key-1')
+        replayed = await SheetJobQueue(queue.kind, queue.handler).enqueue({'row': 1}, 'key-1')
+        return failed_id, (await get_job(session_factory, failed_id)).status, retried, replayed
+
+    failed_id, failed_status, retried, replayed = run(monkeypatch, scenario)
+
+    assert failed_status == 'failed'
+    assert retried[0] != failed_id and retried[1] is True
+    assert replayed == (retried[0], False)
+
+
+def test_stale_claims_return_to_queue(monkeypatch):
+    async def scenario(session_factory):
+        queue = make_queue()
+        stale_id, _ = await queue.enqueue({'row': 1})
+        alive_id, _ = await queue.enqueue({'row': 2})
+        async with session_factory() as session:
+            long_ago = datetime.utcnow() - timedelta(seconds=sheet_jobs.SHEET_JOBS_STALE_AFTER + 1)
+            await session.execute(update(SheetJob).where(SheetJob.id == stale_id)
+                                  .values(status='running', worker_id='other:1', heartbeat_at=long_ago))
+            await session.execute(update(SheetJob).where(SheetJob.id == alive_id)
+                                  .values(status='running', worker_id='other:2', heartbeat_at=datetime.utcnow()))
+            await session.commit()
+
+        await queue.reset_stale()
+        processed = await queue.process_once()
+        return processed, await get_job(session_factory, stale_id), await get_job(session_factory, alive_id)
+
+    processed, stale, alive = run(monkeypatch, scenario)
+
+    assert processed == 1
+    assert (stale.status, stale.worker_id) == ('done', WORKER_ID)
+    assert (alive.status, alive.worker_id) == ('running', 'other:2')
+
+
+def test_heartbeat_is_updated_while_job_runs(monkeypatch):
+    monkeypatch.setattr(sheet_jobs, 'SHEET_JOBS_HEARTBEAT_INTERVAL', 0.05)
+    heartbeats = []
+
+    async def scenario(session_factory):
+        async def slow(payload, progress, save_progress):
+            for _ in range(3):
+                heartbeats.append((await get_job(session_factory, job_id)).heartbeat_at)
+                await asyncio.sleep(0.1)
+            return {}
+
+        queue = make_queue(slow)
+        job_id, _ = await queue.enqueue({'row': 1})
+        await queue.process_once()
+        return await get_job(session_factory, job_id)
+
+    job = run(monkeypatch, scenario)
+
+    assert job.status == 'done'
+    assert heartbeats[0] < heartbeats[-1]
+
+
+def test_reclaimed_job_is_not_finished_by_old_worker(monkeypatch):
+    """Задание признали брошенным и отдали другому воркеру - прежний не перезаписывает его статус"""
+    async def scenario(session_factory):
+        async def reclaimed(payload, progress, save_progress):
+            async with session_factory() as session:
+                await session.execute(update(SheetJob).where(SheetJob.id == job_id).values(worker_id='other:1'))
+                await session.commit()
+            return {}
+
+        queue = make_queue(reclaimed)
+        job_id, _ = await queue.enqueue({'row': 1})
+        await queue.process_once()
+        return await get_job(session_factory, job_id)
+
+    job = run(monkeypatch, scenario)
+
+    assert (job.status, job.worker_id) == ('running', 'other:1')
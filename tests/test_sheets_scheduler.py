@@ -0,0 +1,112 @@
+"""
+Планировщик обращений к Google Sheets API: корзина токенов, задержка повторов, какие ошибки повторяются.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+
+import gspread
+import pytest
+import requests
+
+from service import google_table_authorization as gta
+from service.google_table_authorization import ScheduledGspreadClientManager, SheetsCallScheduler, TokenBucket
+
+
+class FakeResponse:
+    """Ответ Sheets API для gspread.exceptions.APIError"""
+
+    def __init__(self, status_code: int, headers: dict = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ''
+
+    def json(self):
+        return {'error': {'code': self.status_code, 'message': 'fake', 'status': 'FAKE'}}
+
+
+def api_error(status_code: int) -> gspread.exceptions.APIError:
+    return gspread.exceptions.APIError(FakeResponse(status_code))
+
+
+def make_manager() -> ScheduledGspreadClientManager:
+    scheduler = SheetsCallScheduler(reads_per_minute=6000, writes_per_minute=6000, burst=100)
+    scheduler.backoff = lambda attempt, retry_after=None: 0
+    return ScheduledGspreadClientManager(lambda: None, scheduler=scheduler)
+
+
+def flaky(name: str, errors: list):
+    """Метод gspread с именем name: сначала бросает ошибки из errors, потом отвечает 'ok'"""
+    calls = []
+
+    def method():
+        calls.append(name)
+        if errors:
+            raise errors.pop(0)
+        return 'ok'
+
+    method.__name__ = name
+    return method, calls
+
+
+def test_token_bucket_refills_up_to_capacity(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(gta.time, 'monotonic', lambda: clock[0])
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    for _ in range(3):
+        assert bucket.wait_time() == 0
+        bucket.take()
+    assert bucket.wait_time() == pytest.approx(0.5)
+
+    clock[0] += 0.25
+    assert bucket.wait_time() == pytest.approx(0.25)
+
+    # за долгий простой копится не больше capacity
+    clock[0] += 60
+    assert bucket.wait_time() == 0
+    assert bucket.tokens == 3
+
+
+def test_backoff_grows_to_max_and_respects_retry_after(monkeypatch):
+    monkeypatch.setattr(gta.random, 'uniform', lambda low, high: high)
+    scheduler = SheetsCallScheduler()
+
+    assert scheduler.backoff(0) == gta.SHEETS_BACKOFF_BASE
+    assert scheduler.backoff(3) == min(gta.SHEETS_BACKOFF_MAX, gta.SHEETS_BACKOFF_BASE * 8)
+    assert scheduler.backoff(30) == gta.SHEETS_BACKOFF_MAX
+    assert scheduler.backoff(0, retry_after=gta.SHEETS_BACKOFF_BASE + 5) == gta.SHEETS_BACKOFF_BASE + 5
+
+
+def test_non_idempotent_write_is_retried_only_on_429():
+    manager = make_manager()
+
+    insert_row, calls = flaky('insert_row', [api_error(429)])
+    assert asyncio.run(manager._call(insert_row)) == 'ok'
+    assert len(calls) == 2
+    assert manager.scheduler.throttled['write'] == 1
+
+    # после 5xx и ошибки сети строка могла добавиться - повтор добавил бы ее второй раз
+    insert_row, calls = flaky('insert_row', [api_error(503)])
+    with pytest.raises(gspread.exceptions.APIError):
+        asyncio.run(manager._call(insert_row))
+    assert len(calls) == 1
+
+    append_rows, calls = flaky('append_rows', [requests.ConnectionError()])
+    with pytest.raises(requests.ConnectionError):
+        asyncio.run(manager._call(append_rows))
+    assert len(calls) == 1
+
+
+def test_idempotent_calls_are_retried_on_5xx_but_not_on_4xx():
+    manager = make_manager()
+
+    get_all_values, calls = flaky('get_all_values', [api_error(500), requests.ConnectionError()])
+    assert asyncio.run(manager._call(get_all_values)) == 'ok'
+    assert len(calls) == 3
+    assert manager.scheduler.retries['read'] == 2
+
+    update, calls = flaky('update', [api_error(400)])
+    with pytest.raises(gspread.exceptions.APIError):
+        asyncio.run(manager._call(update))
+    assert len(calls) == 1
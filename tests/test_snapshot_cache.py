@@ -0,0 +1,83 @@
+"""
+Кэш снимка данных таблицы (SnapshotCache): ttl, stale-while-revalidate, сброс во время загрузки.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+
+from service.snapshot_cache import SnapshotCache
+
+
+class Loader:
+    """Загрузка снимка: возвращает 'v1', 'v2', ...; с gate ждет, пока тест ее отпустит"""
+
+    def __init__(self, gated: bool = False):
+        self.calls = 0
+        self.gate = asyncio.Event() if gated else None
+
+    async def __call__(self):
+        self.calls += 1
+        value = f'v{self.calls}'
+        if self.gate is not None:
+            await self.gate.wait()
+        return value
+
+
+def test_concurrent_misses_share_one_load():
+    async def scenario():
+        loader = Loader()
+        cache = SnapshotCache(loader, ttl=60)
+        values = await asyncio.gather(*(cache.get() for _ in range(5)))
+        return values, await cache.get(), loader.calls
+
+    values, again, calls = asyncio.run(scenario())
+
+    assert values == ['v1'] * 5
+    assert again == 'v1'
+    assert calls == 1
+
+
+def test_stale_snapshot_is_served_while_refreshing():
+    async def scenario():
+        loader = Loader()
+        cache = SnapshotCache(loader, ttl=0.02, stale_ttl=60)
+        first = await cache.get()
+        await asyncio.sleep(0.03)
+        stale = await cache.get()  # не ждет загрузку, она идет в фоне
+        await asyncio.sleep(0.01)
+        return first, stale, await cache.get(), loader.calls
+
+    first, stale, fresh, calls = asyncio.run(scenario())
+
+    assert (first, stale, fresh) == ('v1', 'v1', 'v2')
+    assert calls == 2
+
+
+def test_snapshot_loaded_before_invalidate_is_not_kept():
+    """Загрузка, начатая до записи в таблицу, не должна попасть в кэш после invalidate"""
+    async def scenario():
+        loader = Loader(gated=True)
+        cache = SnapshotCache(loader, ttl=60)
+        before_write = asyncio.create_task(cache.get())
+        await asyncio.sleep(0)
+        cache.invalidate()
+        loader.gate.set()
+        # ожидавший до записи получает свою загрузку, но кэш ее не сохраняет
+        return await before_write, await cache.get(), loader.calls
+
+    old, new, calls = asyncio.run(scenario())
+
+    assert old == 'v1'
+    assert new == 'v2'
+    assert calls == 2
+
+
+def test_invalidate_forces_next_get_to_wait_for_fresh_load():
+    async def scenario():
+        loader = Loader()
+        cache = SnapshotCache(loader, ttl=60, stale_ttl=60)
+        await cache.get()
+        cache.invalidate()
+        return await cache.get()
+
+    assert asyncio.run(scenario()) == 'v2'
@@ -0,0 +1,64 @@
+"""
+Отложенная запись строк Ledger пачками (RowWriteBatcher): номера строк и ошибки записи.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+
+from service.write_batcher import RowWriteBatcher
+
+
+class FakeLedger:
+    """Лист, который дописывает строки в конец и возвращает номер первой записанной"""
+
+    def __init__(self, next_row: int = 2, fail_times: int = 0):
+        self.next_row = next_row
+        self.fail_times = fail_times
+        self.batches = []
+
+    async def flush_rows(self, rows):
+        if self.fail_times:
+            self.fail_times -= 1
+            raise RuntimeError('API недоступен')
+        self.batches.append(rows)
+        first_row, self.next_row = self.next_row, self.next_row + len(rows)
+        return first_row
+
+
+def test_rows_get_numbers_in_submit_order_in_one_request():
+    ledger = FakeLedger(next_row=10)
+    batcher = RowWriteBatcher(ledger.flush_rows, window=0.01)
+
+    async def scenario():
+        return await asyncio.gather(*(batcher.submit([f'строка {i}']) for i in range(5)))
+
+    assert asyncio.run(scenario()) == [10, 11, 12, 13, 14]
+    assert ledger.batches == [[[f'строка {i}'] for i in range(5)]]
+
+
+def test_batches_are_split_by_max_batch():
+    ledger = FakeLedger()
+    batcher = RowWriteBatcher(ledger.flush_rows, window=0.01, max_batch=2)
+
+    async def scenario():
+        return await asyncio.gather(*(batcher.submit([i]) for i in range(5)))
+
+    assert asyncio.run(scenario()) == [2, 3, 4, 5, 6]
+    assert [len(batch) for batch in ledger.batches] == [2, 2, 1]
+    assert batcher.queue_depth == 0
+
+
+def test_failed_batch_fails_its_rows_only():
+    ledger = FakeLedger(fail_times=1)
+    batcher = RowWriteBatcher(ledger.flush_rows, window=0.01)
+
+    async def scenario():
+        failed = await asyncio.gather(*(batcher.submit([i]) for i in range(3)), return_exceptions=True)
+        # следующая пачка пишется как обычно и получает первые свободные номера
+        written = await batcher.submit(['после ошибки'])
+        return failed, written
+
+    failed, written = asyncio.run(scenario())
+
+    assert all(isinstance(result, RuntimeError) and str(result) == 'API недоступен' for result in failed)
+    assert written == 2